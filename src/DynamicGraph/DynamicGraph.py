@@ -25,22 +25,88 @@
 that follow a power law distribution.
 """
 
+import os
+import sys
+import math
+import json
+import zlib
+import struct
+import time
 import random
+import functools
+from array import array
 import numpy as np
-import scipy.stats
-from collections import deque
+import scipy.sparse
+import scipy.sparse.csgraph
+from collections import OrderedDict
+from collections.abc import KeysView
+from types import MappingProxyType
 
-def power_law(xmin, xmax):
-    u"""Returns a scipy.stats._distn_infrastructure.rv_sample object
-        :param xmin: the min value of in the sample
+@functools.lru_cache(maxsize=128)
+def power_law_cdf(exponent, xmax):
+    u"""Returns the CDF of a powerlaw distribution over [1, xmax] as a
+        read-only numpy array, cached so it is only computed once for every
+        shape used by the graphs.
+        :param exponent: the exponent of the power law
         :param xmax: the max value of in the sample
-        it generate the probabilidy of the value in range of [xmin, xman]
-        following a powerlaw distrubution
     """
-    y = np.arange(1, xmax + 1, dtype='float32')
-    prob_mass_func =  1/y**xmin
-    prob_mass_func /= prob_mass_func.sum()
-    return scipy.stats.rv_discrete(values=(range(1, xmax + 1), prob_mass_func))
+    y = np.arange(1, xmax + 1, dtype='float64')
+    prob_mass_func = 1/y**exponent
+    cdf = np.cumsum(prob_mass_func / prob_mass_func.sum())
+    cdf[-1] = 1.0
+    cdf.setflags(write=False)
+    return cdf
+
+class PowerLawSampler():
+    u"""Returns a reusable sampler of integers in the range of [1, xmax]
+        following a powerlaw distribution. Samples are handed out from
+        pre-drawn blocks by an inverse-CDF lookup. Every graph keeps its own
+        samplers, so the blocks left by one graph are not drawn by the next.
+       :param exponent: the exponent of the power law
+       :param xmax: the max value of in the sample
+       :param block_size: the number of samples pre-drawn at a time
+    """
+    def __init__(self, exponent, xmax, block_size=1024):
+        self.cdf = power_law_cdf(exponent, xmax)
+        self.exponent = exponent
+        self.xmax = xmax
+        self.block_size = block_size
+        self._block = []
+
+    def draw(self):
+        u"""Returns a single sample, refilling the pre-drawn block if it is
+            exhausted.
+        """
+        if not self._block:
+            self._block = self.draw_many(self.block_size).tolist()
+        return self._block.pop()
+
+    def draw_many(self, size):
+        u"""Returns a numpy array of samples drawn in one inverse-CDF lookup.
+            :param size: the number of samples
+        """
+        u = np.random.random_sample(size)
+        return np.searchsorted(self.cdf, u, side='right') + 1
+
+def timed(phase):
+    u"""Returns a decorator of the graph methods reporting the seconds of
+        every call as a phase to the observe function of the graph. It costs
+        one attribute check when the graph has none, see
+        ProbGraph.timePhases.
+        :param phase: the name of the phase.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.observe is None:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.observe(phase, time.perf_counter() - start)
+        return wrapper
+    return decorate
 
 class GraphNode():
     u"""Returns a class of Node in the graph.
@@ -66,6 +132,1656 @@ class GraphNode():
         return len(self.neighbours) > 0
 
 
+class AdjacencyDict(dict):
+    u"""Returns the default adjacency of a graph, a dict of neighbour lists
+        keyed by node. It shares its methods with CompactAdjacency so the
+        graph can use either storage.
+    """
+    def add_nodes(self, nodes):
+        for v in nodes:
+            self[v] = []
+
+    def degree(self, v):
+        return len(self[v])
+
+    def link(self, a, b):
+        self[a].append(b)
+        self[b].append(a)
+
+    def link_many(self, src, tgt):
+        for a, b in zip(src.tolist(), tgt.tolist()):
+            self[a].append(b)
+            self[b].append(a)
+
+    def unlink(self, a, b):
+        self[a].remove(b)
+
+    def drop(self, v):
+        self[v] = []
+
+    def nbytes(self):
+        u"""Returns a shallow estimate of the bytes held by the dict, the
+            neighbour lists and their int objects.
+        """
+        size = sys.getsizeof(self)
+        for v, row in self.items():
+            size += sys.getsizeof(v) + sys.getsizeof(row) + 28 * len(row)
+        return size
+
+
+class CompactAdjacency():
+    u"""Returns a compact adjacency stored in CSR-style int32 arrays. Every
+        node owns a slot of the indices array starting at offsets[v] with
+        room for capacity[v] neighbours, of which degrees[v] are used. A full
+        slot is moved to the end of the buffer with twice its capacity, so
+        edges are appended without rebuilding the arrays.
+       :param capacity: the number of node ids to reserve room for.
+    """
+    def __init__(self, capacity=16):
+        capacity = max(capacity, 16)
+        self.offsets = np.zeros(capacity, dtype=np.int32)
+        self.capacity = np.zeros(capacity, dtype=np.int32)
+        self.degrees = np.zeros(capacity, dtype=np.int32)
+        self.known = np.zeros(capacity, dtype=bool)
+        self.indices = np.zeros(4 * capacity, dtype=np.int32)
+        self.used = 0
+        self.garbage = 0
+        self.node_count = 0
+
+    def __getitem__(self, v):
+        if not self.__contains__(v):
+            raise KeyError(v)
+        start = self.offsets[v]
+        return self.indices[start:start + self.degrees[v]].tolist()
+
+    def __contains__(self, v):
+        return 0 <= v < len(self.known) and bool(self.known[v])
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.known).tolist())
+
+    def __len__(self):
+        return self.node_count
+
+    def get(self, v, default=None):
+        return self[v] if v in self else default
+
+    def keys(self):
+        return KeysView(self)
+
+    def row(self, v):
+        u"""Returns the neighbours of a node as an int32 view of the buffer.
+            :param v: the node.
+        """
+        start = self.offsets[v]
+        return self.indices[start:start + self.degrees[v]]
+
+    def degree(self, v):
+        return int(self.degrees[v])
+
+    def gather(self, nodes):
+        u"""Returns the neighbours of a numpy array of nodes as two aligned
+            arrays of (node, neighbour) pairs.
+            :param nodes: the nodes.
+        """
+        degrees = self.degrees[nodes].astype(np.int64)
+        rank = np.arange(degrees.sum()) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+        starts = np.repeat(self.offsets[nodes].astype(np.int64), degrees)
+        return np.repeat(nodes, degrees), self.indices[starts + rank]
+
+    def _reserve_nodes(self, size):
+        if size <= len(self.known):
+            return
+        size = max(size, 2 * len(self.known))
+        for name in ('offsets', 'capacity', 'degrees', 'known'):
+            old = getattr(self, name)
+            grown = np.zeros(size, dtype=old.dtype)
+            grown[:len(old)] = old
+            setattr(self, name, grown)
+
+    def _reserve_indices(self, size):
+        if self.used + size <= len(self.indices):
+            return
+        if self.garbage > self.used // 2:
+            self.compact()
+        if self.used + size > len(self.indices):
+            grown = np.zeros(max(self.used + size, 2 * len(self.indices)), dtype=np.int32)
+            grown[:self.used] = self.indices[:self.used]
+            self.indices = grown
+
+    def add_nodes(self, nodes):
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if not len(nodes):
+            return
+        self._reserve_nodes(int(nodes.max()) + 1)
+        self.node_count += int(np.count_nonzero(~self.known[nodes]))
+        self.known[nodes] = True
+
+    def _relocate(self, nodes, capacity):
+        u"""Move the slots of nodes to the end of the buffer with the new
+            capacity, keeping their neighbours.
+        """
+        degrees = self.degrees[nodes].astype(np.int64)
+        self._reserve_indices(int(capacity.sum()))
+        starts = self.used + np.concatenate(([0], np.cumsum(capacity)[:-1]))
+        rank = np.arange(degrees.sum()) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+        old = np.repeat(self.offsets[nodes].astype(np.int64), degrees) + rank
+        new = np.repeat(starts, degrees) + rank
+        self.indices[new] = self.indices[old]
+        self.garbage += int(self.capacity[nodes].sum())
+        self.offsets[nodes] = starts
+        self.capacity[nodes] = capacity
+        self.used += int(capacity.sum())
+
+    def link(self, a, b):
+        for v, x in ((a, b), (b, a)):
+            d = self.degrees[v]
+            if d == self.capacity[v]:
+                self._relocate(np.array([v]), np.array([max(2 * d, 2)]))
+            self.indices[self.offsets[v] + d] = x
+            self.degrees[v] = d + 1
+
+    def link_many(self, src, tgt):
+        u"""Append a batch of edges in one vectorized pass.
+            :param src: the source node of every edge.
+            :param tgt: the target node of every edge.
+        """
+        nodes = np.concatenate((src, tgt)).astype(np.int64)
+        values = np.concatenate((tgt, src)).astype(np.int32)
+        if not len(nodes):
+            return
+        counts = np.bincount(nodes, minlength=len(self.degrees))
+        need = self.degrees + counts
+        grow = np.flatnonzero(need > self.capacity)
+        if grow.size:
+            self._relocate(grow, np.maximum(np.maximum(need[grow], 2 * self.capacity[grow]), 2))
+        order = np.argsort(nodes, kind='stable')
+        nodes, values = nodes[order], values[order]
+        first = np.searchsorted(nodes, nodes, side='left')
+        self.indices[self.offsets[nodes] + self.degrees[nodes] + np.arange(len(nodes)) - first] = values
+        self.degrees += counts.astype(np.int32)
+
+    def unlink(self, a, b):
+        start, d = self.offsets[a], self.degrees[a]
+        slot = self.indices[start:start + d]
+        hit = np.flatnonzero(slot == b)
+        if not hit.size:
+            raise ValueError('%r is not a neighbour of %r' % (b, a))
+        slot[hit[0]] = slot[d - 1]
+        self.degrees[a] = d - 1
+
+    def drop(self, v):
+        self.degrees[v] = 0
+
+    def compact(self):
+        u"""Repack all the slots to drop the space left behind by moved ones.
+            :param None
+        """
+        nodes = np.flatnonzero(self.capacity)
+        capacity = self.capacity[nodes].astype(np.int64)
+        degrees = self.degrees[nodes].astype(np.int64)
+        starts = np.concatenate(([0], np.cumsum(capacity)[:-1]))
+        rank = np.arange(degrees.sum()) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+        indices = np.zeros(len(self.indices), dtype=np.int32)
+        indices[np.repeat(starts, degrees) + rank] = \
+            self.indices[np.repeat(self.offsets[nodes].astype(np.int64), degrees) + rank]
+        self.indices = indices
+        self.offsets[nodes] = starts
+        self.used = int(capacity.sum())
+        self.garbage = 0
+
+    def to_csr(self):
+        u"""Returns the adjacency as contiguous (indptr, indices) arrays.
+            :param None
+        """
+        degrees = self.degrees.astype(np.int64)
+        indptr = np.concatenate(([0], np.cumsum(degrees)))
+        rank = np.arange(indptr[-1]) - np.repeat(indptr[:-1], degrees)
+        indices = self.indices[np.repeat(self.offsets.astype(np.int64), degrees) + rank]
+        return indptr, indices
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes
+                   for name in ('offsets', 'capacity', 'degrees', 'known', 'indices'))
+
+
+class DisjointSet():
+    u"""Returns a union-find over node ids with path compression and union by
+        size, so the connected components are kept up to date as edges are
+        added. Arrays are indexed by node id and grown on demand.
+       :param capacity: the number of node ids to reserve room for.
+    """
+    def __init__(self, capacity=16):
+        self.parent = array('i', range(capacity))
+        self.size = array('i', [1]) * capacity
+
+    def __len__(self):
+        return len(self.parent)
+
+    def reserve(self, capacity):
+        if capacity > len(self.parent):
+            self.size.extend(array('i', [1]) * (capacity - len(self.parent)))
+            self.parent.extend(range(len(self.parent), capacity))
+
+    def find(self, v):
+        parent = self.parent
+        while parent[v] != v:
+            parent[v] = parent[parent[v]]
+            v = parent[v]
+        return v
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
+
+    def roots(self, nodes):
+        u"""Returns the roots of a numpy array of nodes, compressing the
+            paths of those nodes on the way.
+            :param nodes: the nodes to be looked up.
+        """
+        parent = np.frombuffer(self.parent, dtype=np.int32)
+        roots = parent[nodes]
+        while True:
+            up = parent[roots]
+            if np.array_equal(up, roots):
+                break
+            roots = up
+        parent[nodes] = roots
+        return roots
+
+    def union_many(self, src, tgt):
+        u"""Merge the components of a batch of edges in one vectorized pass.
+            The components touched by the batch are labelled together with
+            scipy.sparse.csgraph and every group is hung under its largest
+            root.
+            :param src: the source node of every edge.
+            :param tgt: the target node of every edge.
+        """
+        if not len(src):
+            return
+        left = self.roots(np.asarray(src, dtype=np.int64))
+        right = self.roots(np.asarray(tgt, dtype=np.int64))
+        apart = left != right
+        if not apart.any():
+            return
+        left, right = left[apart], right[apart]
+        roots, inverse = np.unique(np.concatenate((left, right)), return_inverse=True)
+        merged = scipy.sparse.coo_matrix((np.ones(len(left), dtype=np.int8),
+                                          (inverse[:len(left)], inverse[len(left):])),
+                                         shape=(len(roots), len(roots)))
+        _, group = scipy.sparse.csgraph.connected_components(merged, directed=False)
+        parent = np.frombuffer(self.parent, dtype=np.int32)
+        size = np.frombuffer(self.size, dtype=np.int32)
+        sizes = size[roots]
+        order = np.lexsort((-sizes, group))
+        first = np.flatnonzero(np.diff(np.concatenate(([-1], group[order]))))
+        lead = roots[order[first]]
+        size[lead] = np.bincount(group, weights=sizes).astype(np.int32)
+        parent[roots] = lead[group]
+
+    def labels(self):
+        u"""Returns the root of every node id as a numpy array, after fully
+            compressing all the paths.
+            :param None
+        """
+        parent = np.frombuffer(self.parent, dtype=np.int32)
+        while True:
+            up = parent[parent]
+            if np.array_equal(up, parent):
+                break
+            parent[:] = up
+        return parent.copy()
+
+
+class DegreeSampler():
+    u"""Returns a degree-weighted node sampler over node ids, kept in a
+        Fenwick tree so a draw, a degree change and a node removal take
+        O(log n). It stands for the list of edge endpoints used by the
+        preferential attachment: its length is the total degree and item i
+        is the node holding the i-th endpoint, so random.choice still draws
+        a node with probability proportional to its degree.
+       :param capacity: the number of node ids to reserve room for.
+    """
+    def __init__(self, capacity=16):
+        self.weights = array('i', [0]) * capacity
+        self.tree = array('i', [0]) * (capacity + 1)
+        self.total = 0
+        self.top = 1 << max(capacity.bit_length() - 1, 0)
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.total:
+            raise IndexError('endpoint index out of range')
+        tree, n = self.tree, len(self.weights)
+        pos, step = 0, self.top
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] <= i:
+                pos = nxt
+                i -= tree[nxt]
+            step >>= 1
+        return pos
+
+    def __iter__(self):
+        weights = np.frombuffer(self.weights, dtype=np.int32)
+        return iter(np.repeat(np.arange(len(weights)), weights).tolist())
+
+    def _rebuild(self):
+        n = len(self.weights)
+        prefix = np.concatenate(([0], np.cumsum(np.frombuffer(self.weights, dtype=np.int32), dtype=np.int64)))
+        i = np.arange(1, n + 1)
+        tree = np.frombuffer(self.tree, dtype=np.int32)
+        tree[1:] = prefix[i] - prefix[i - (i & -i)]
+        self.total = int(prefix[-1])
+        self.top = 1 << max(n.bit_length() - 1, 0)
+
+    def reserve(self, capacity):
+        if capacity > len(self.weights):
+            capacity = max(capacity, 2 * len(self.weights))
+            self.weights.extend(array('i', [0]) * (capacity - len(self.weights)))
+            self.tree = array('i', [0]) * (capacity + 1)
+            self._rebuild()
+
+    def degree(self, v):
+        return self.weights[v]
+
+    def add(self, v, delta=1):
+        u"""Change the weight of a node.
+            :param v: the node.
+            :param delta: the change of its degree.
+        """
+        self.weights[v] += delta
+        self.total += delta
+        tree, n = self.tree, len(self.weights)
+        i = v + 1
+        while i <= n:
+            tree[i] += delta
+            i += i & -i
+
+    def add_many(self, nodes, delta=1):
+        u"""Change the weights of a batch of nodes, rebuilding the tree in one
+            vectorized pass when the batch is large.
+            :param nodes: the nodes, repeated once per change.
+            :param delta: the change for every item.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if len(nodes) * 16 < len(self.weights):
+            for v in nodes.tolist():
+                self.add(v, delta)
+            return
+        weights = np.frombuffer(self.weights, dtype=np.int32)
+        weights += (np.bincount(nodes, minlength=len(weights)) * delta).astype(np.int32)
+        self._rebuild()
+
+    def discard(self, v):
+        u"""Remove a node from the sampler.
+            :param v: the node.
+        """
+        if self.weights[v]:
+            self.add(v, -self.weights[v])
+
+    def locate(self, positions):
+        u"""Returns the nodes holding a numpy array of endpoint positions, by
+            walking down the tree for all of them at once.
+            :param positions: the positions, each in [0, len(self)).
+        """
+        tree, n = np.frombuffer(self.tree, dtype=np.int32), len(self.weights)
+        rest = np.asarray(positions, dtype=np.int64).copy()
+        pos = np.zeros(len(rest), dtype=np.int64)
+        step = self.top
+        while step:
+            nxt = pos + step
+            ahead = np.flatnonzero(nxt <= n)
+            down = ahead[tree[nxt[ahead]] <= rest[ahead]]
+            rest[down] -= tree[nxt[down]]
+            pos[down] = nxt[down]
+            step >>= 1
+        return pos
+
+    def draw(self):
+        return self[random.randrange(self.total)]
+
+    def draw_many(self, size):
+        return self.locate(np.random.randint(0, self.total, size))
+
+    def nbytes(self):
+        return self.weights.buffer_info()[1] * self.weights.itemsize + \
+            self.tree.buffer_info()[1] * self.tree.itemsize
+
+
+class EdgeSet():
+    u"""Returns an edge store keyed by the canonical (min, max) pair of every
+        edge. Edges are kept in a dense int32 array in insertion order and a
+        removed edge is replaced by the last one, so membership, insertion
+        and deletion take constant time. Every edge has an id that is stable
+        while it is in the set. The key index is built on first use.
+       :param capacity: the number of edges to reserve room for.
+    """
+    def __init__(self, capacity=16):
+        capacity = max(capacity, 16)
+        self.edges = np.zeros((capacity, 2), dtype=np.int32)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.positions = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+        self.next_id = 0
+        self.free_ids = []
+        self._index = None
+
+    @staticmethod
+    def key(a, b):
+        a, b = int(a), int(b)
+        return (a << 32) | b if a < b else (b << 32) | a
+
+    @property
+    def index(self):
+        u"""The dict of canonical edge keys to edge ids."""
+        if self._index is None:
+            edges = self.array().astype(np.int64)
+            keys = (edges.min(axis=1) << 32) | edges.max(axis=1)
+            self._index = dict(zip(keys.tolist(), self.ids[:self.size].tolist()))
+        return self._index
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for start in range(0, self.size, 65536):
+            yield from map(tuple, self.edges[start:min(start + 65536, self.size)].tolist())
+
+    def __getitem__(self, i):
+        return tuple(self.array()[i].tolist())
+
+    def __contains__(self, pair):
+        return self.key(pair[0], pair[1]) in self.index
+
+    def _reserve(self, size):
+        if self.size + size > len(self.edges):
+            capacity = max(self.size + size, 2 * len(self.edges))
+            self.edges = np.resize(self.edges, (capacity, 2))
+            self.ids = np.resize(self.ids, capacity)
+
+    def _takeIds(self, count):
+        reused = self.free_ids[len(self.free_ids) - min(count, len(self.free_ids)):]
+        del self.free_ids[len(self.free_ids) - len(reused):]
+        ids = np.concatenate((np.array(reused, dtype=np.int64),
+                              np.arange(self.next_id, self.next_id + count - len(reused))))
+        self.next_id += count - len(reused)
+        if self.next_id > len(self.positions):
+            self.positions = np.resize(self.positions, max(self.next_id, 2 * len(self.positions)))
+        return ids
+
+    def add(self, pair, check=True):
+        u"""Add an edge and returns its id, or -1 if the edge is already in
+            the set or is a self loop.
+            :param pair: the edge to be added.
+            :param check: look the edge up before adding it.
+        """
+        a, b = pair[0], pair[1]
+        if a == b or (check and self.key(a, b) in self.index):
+            return -1
+        self._reserve(1)
+        if self.free_ids:
+            eid = self.free_ids.pop()
+        else:
+            eid = self._takeIds(1)[0]
+        self.edges[self.size] = (a, b)
+        self.ids[self.size] = eid
+        self.positions[eid] = self.size
+        self.size += 1
+        if self._index is not None:
+            self._index[self.key(a, b)] = int(eid)
+        return int(eid)
+
+    def append(self, pair):
+        self.add(pair)
+
+    def add_many(self, src, tgt, check=True):
+        u"""Add a batch of edges and returns the ids of the added ones.
+            :param src: the source node of every edge.
+            :param tgt: the target node of every edge.
+            :param check: drop the edges already in the set or repeated in
+            the batch.
+        """
+        src, tgt = np.asarray(src, dtype=np.int64), np.asarray(tgt, dtype=np.int64)
+        keys = (np.minimum(src, tgt) << 32) | np.maximum(src, tgt)
+        if check:
+            index = self.index
+            fresh = np.array([k not in index for k in keys.tolist()], dtype=bool).reshape(-1)
+            fresh &= src != tgt
+            _, first = np.unique(keys, return_index=True)
+            once = np.zeros(len(keys), dtype=bool)
+            once[first] = True
+            fresh &= once
+            src, tgt, keys = src[fresh], tgt[fresh], keys[fresh]
+        count = len(src)
+        self._reserve(count)
+        ids = self._takeIds(count)
+        self.edges[self.size:self.size + count, 0] = src
+        self.edges[self.size:self.size + count, 1] = tgt
+        self.ids[self.size:self.size + count] = ids
+        self.positions[ids] = np.arange(self.size, self.size + count)
+        self.size += count
+        if self._index is not None:
+            self._index.update(zip(keys.tolist(), ids.tolist()))
+        return ids
+
+    def discard(self, pair):
+        u"""Remove an edge by moving the last edge into its place. Returns
+            the id of the removed edge, or -1 if it is not in the set.
+            :param pair: the edge to be removed.
+        """
+        eid = self.index.pop(self.key(pair[0], pair[1]), -1)
+        if eid < 0:
+            return -1
+        i = self.positions[eid]
+        self.size -= 1
+        if i != self.size:
+            self.edges[i] = self.edges[self.size]
+            self.ids[i] = self.ids[self.size]
+            self.positions[self.ids[i]] = i
+        self.free_ids.append(eid)
+        return eid
+
+    def remove(self, pair):
+        eid = self.discard(pair)
+        if eid < 0:
+            raise ValueError('%r not in edges' % (pair,))
+        return eid
+
+    def array(self):
+        return self.edges[:self.size]
+
+    def edge_ids(self):
+        return self.ids[:self.size]
+
+    def nbytes(self):
+        size = self.edges.nbytes + self.ids.nbytes + self.positions.nbytes
+        if self._index is not None:
+            size += sys.getsizeof(self._index) + 64 * len(self._index)
+        return size
+
+
+class GraphStats():
+    u"""Returns the statistics of a graph kept up to date by its changes:
+        the histograms of the degrees of the nodes and of the sizes of the
+        connected components as dicts of counts, the largest component size
+        and the sums behind the maximum likelihood power-law exponent of the
+        degrees, alpha = 1 + n / sum(ln(2 d)) over the n linked nodes. Every
+        change reports the values it removes and the values it adds, so the
+        reads take constant time.
+       :param None
+    """
+    def __init__(self):
+        self.degrees = {}
+        self.components = {}
+        self.largest = 0
+        self.linked = 0
+        self.log_degrees = 0.0
+
+    @classmethod
+    def of(cls, degrees, sizes):
+        u"""Returns the statistics of the degrees of all the nodes and the
+            sizes of all the components of a graph.
+            :param degrees: the degree of every node.
+            :param sizes: the size of every component.
+        """
+        stats = cls()
+        stats.changeDegrees((), degrees)
+        stats.changeComponents((), sizes)
+        return stats
+
+    @staticmethod
+    def _count(histogram, values, delta):
+        if len(values) < 64:
+            pairs = [(int(v), 1) for v in values]
+        else:
+            values, counts = np.unique(np.asarray(values), return_counts=True)
+            pairs = zip(values.tolist(), counts.tolist())
+        for value, count in pairs:
+            count = histogram.get(value, 0) + delta * count
+            if count:
+                histogram[value] = count
+            else:
+                del histogram[value]
+
+    @staticmethod
+    def _logs(degrees):
+        if len(degrees) < 64:
+            return sum(math.log(2 * d) for d in degrees if d > 0), sum(1 for d in degrees if d > 0)
+        degrees = np.asarray(degrees, dtype=np.float64)
+        degrees = degrees[degrees > 0]
+        return float(np.log(2 * degrees).sum()), len(degrees)
+
+    def changeDegrees(self, old, new):
+        u"""Replace the degrees of some nodes.
+            :param old: the degrees of the nodes changed or removed.
+            :param new: the degrees of the nodes changed or added.
+        """
+        self._count(self.degrees, old, -1)
+        self._count(self.degrees, new, 1)
+        (removed, unlinked), (added, linked) = self._logs(old), self._logs(new)
+        self.log_degrees += added - removed
+        self.linked += linked - unlinked
+
+    def changeComponents(self, old, new):
+        u"""Replace the sizes of some components.
+            :param old: the sizes of the components merged, split or removed.
+            :param new: the sizes of the components they became.
+        """
+        self._count(self.components, old, -1)
+        self._count(self.components, new, 1)
+        if len(new):
+            self.largest = max(self.largest, int(max(new)))
+        if self.largest and self.largest not in self.components:
+            self.largest = max(self.components, default=0)
+
+    def exponent(self):
+        u"""Returns the fitted power-law exponent of the degrees, or None for
+            a graph without edges.
+            :param None
+        """
+        return 1 + self.linked / self.log_degrees if self.log_degrees > 0 else None
+
+    def summary(self):
+        u"""Returns the statistics as a dict of plain values, the histograms
+            as sorted [value, count] pairs.
+            :param None
+        """
+        return {'nodes': sum(self.degrees.values()), 'linked_nodes': self.linked,
+                'components': sum(self.components.values()), 'largest_component': self.largest,
+                'power_law_exponent': self.exponent(),
+                'degree_histogram': sorted([d, c] for d, c in self.degrees.items()),
+                'component_histogram': sorted([s, c] for s, c in self.components.items())}
+
+
+class QueryCache():
+    u"""Returns a bounded cache of query results keyed by the query and its
+        arguments, valid for the version of the graph they were computed at.
+        The least recently used results are evicted over max_entries. With
+        per_component a result can be scoped to the connected component it
+        was computed from: it then stays valid across versions until that
+        component changes, so changes elsewhere do not flush it.
+       :param max_entries: the max number of results kept.
+       :param per_component: keep the results scoped to a component.
+    """
+    def __init__(self, max_entries=1024, per_component=True):
+        self.max_entries = max_entries
+        self.per_component = per_component
+        self.entries = OrderedDict()
+        self.scopes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, version):
+        u"""Returns the result of a query at a version, or None on a miss.
+            :param key: the query and its arguments.
+            :param version: the version of the graph.
+        """
+        entry = self.entries.get(key)
+        if entry is None or (entry[1] is None and entry[0] != version):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[2]
+
+    def put(self, key, version, value, scope=None):
+        u"""Keep the result of a query at a version.
+            :param key: the query and its arguments.
+            :param version: the version of the graph.
+            :param value: the result, not None.
+            :param scope: the component id the result depends on alone.
+        """
+        if not self.per_component:
+            scope = None
+        self._drop(key)
+        self.entries[key] = (version, scope, value)
+        if scope is not None:
+            self.scopes.setdefault(scope, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[1] is not None:
+            keys = self.scopes[entry[1]]
+            keys.discard(key)
+            if not keys:
+                del self.scopes[entry[1]]
+
+    def scoped(self):
+        return bool(self.scopes)
+
+    def invalidate(self, scopes):
+        u"""Drop the results scoped to components about to change.
+            :param scopes: the component ids.
+        """
+        for scope in scopes:
+            for key in self.scopes.pop(scope, ()):
+                del self.entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.scopes.clear()
+
+    def nbytes(self):
+        u"""Returns a shallow estimate of the bytes held by the results: the
+            numpy arrays they are or hold, else their own size.
+            :param None
+        """
+        size = 0
+        for _, _, value in self.entries.values():
+            for item in (value.values() if isinstance(value, dict) else [value]):
+                if isinstance(item, np.ndarray):
+                    size += item.nbytes
+                elif callable(getattr(item, 'nbytes', None)):
+                    size += item.nbytes()
+                else:
+                    size += sys.getsizeof(item)
+        return size
+
+    def stats(self):
+        u"""Returns the number of results kept, the bound and the hits,
+            misses, evictions and invalidations so far.
+            :param None
+        """
+        return {'entries': len(self.entries), 'max_entries': self.max_entries, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+class MutationJournal():
+    u"""Returns an append-only log of (op, src, tgt) records of the changes
+        of a graph. Readers ask for the records since their cursor; over
+        limit records the oldest half is dropped.
+       :param limit: the max number of records kept.
+    """
+    ADD_NODE, DEL_NODE, ADD_EDGE, DEL_EDGE, MOVE_NODE = range(5)
+
+    def __init__(self, limit=1 << 20):
+        self.ops = array('b')
+        self.src = array('i')
+        self.tgt = array('i')
+        self.base = 0
+        self.limit = limit
+        self.token = '%08x' % random.getrandbits(32)
+
+    def __len__(self):
+        return len(self.ops)
+
+    @property
+    def cursor(self):
+        return self.base + len(self.ops)
+
+    def record(self, op, src, tgt=0):
+        self.ops.append(op)
+        self.src.append(src)
+        self.tgt.append(tgt)
+        self._trim()
+
+    def record_many(self, op, src, tgt=None):
+        u"""Append a batch of records of the same operation.
+            :param op: the operation of every record.
+            :param src: the nodes, or the source node of every edge.
+            :param tgt: the target node of every edge.
+        """
+        src = np.asarray(src, dtype=np.int32)
+        tgt = np.zeros(len(src), dtype=np.int32) if tgt is None else np.asarray(tgt, dtype=np.int32)
+        self.ops.frombytes(np.full(len(src), op, dtype=np.int8).tobytes())
+        self.src.frombytes(src.tobytes())
+        self.tgt.frombytes(tgt.tobytes())
+        self._trim()
+
+    def _trim(self):
+        if len(self.ops) > self.limit:
+            drop = len(self.ops) - self.limit // 2
+            del self.ops[:drop], self.src[:drop], self.tgt[:drop]
+            self.base += drop
+
+    def since(self, cursor):
+        u"""Returns the (op, src, tgt) arrays of the records after a cursor, or
+            None if they are not kept any more.
+            :param cursor: the cursor seen by the reader.
+        """
+        if not self.base <= cursor <= self.cursor:
+            return None
+        start = cursor - self.base
+        return (np.frombuffer(self.ops, dtype=np.int8)[start:].copy(),
+                np.frombuffer(self.src, dtype=np.int32)[start:].astype(np.int64),
+                np.frombuffer(self.tgt, dtype=np.int32)[start:].astype(np.int64))
+
+    def nbytes(self):
+        return sum(a.buffer_info()[1] * a.itemsize for a in (self.ops, self.src, self.tgt))
+
+
+class CSRAdjacency():
+    u"""Returns a read-only adjacency over node ids stored as CSR arrays, the
+        neighbours of v being indices[indptr[v]:indptr[v + 1]].
+       :param indptr: the int64 offsets of every node id and the end.
+       :param indices: the int32 neighbours of all the nodes.
+    """
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __getitem__(self, v):
+        return self.row(v).tolist()
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def row(self, v):
+        return self.indices[self.indptr[v]:self.indptr[v + 1]]
+
+    def degree(self, v):
+        return int(self.indptr[v + 1] - self.indptr[v])
+
+    def gather(self, nodes):
+        u"""Returns the neighbours of nodes back to back and the degree of
+            every node, without a Python loop.
+            :param nodes: the int64 array of nodes.
+        """
+        starts = self.indptr[nodes]
+        degrees = self.indptr[nodes + 1] - starts
+        offsets = np.arange(degrees.sum()) + np.repeat(starts - np.cumsum(degrees) + degrees, degrees)
+        return self.indices[offsets], degrees
+
+    def distances(self, sources, max_depth=None, batch=False):
+        u"""Returns the hops from the sources to every node id by a level
+            synchronous bfs, as an int32 array with -1 for the nodes not
+            reached. All the sources start one search, or with batch every
+            source starts its own and the answer is a (sources, nodes) array
+            searched at once. A level gathers the neighbours of the whole
+            frontier from the CSR arrays.
+            :param sources: the nodes at 0 hops.
+            :param max_depth: the max hops searched, None for no limit.
+            :param batch: answer one search per source.
+        """
+        node_num = len(self)
+        sources = np.asarray(sources, dtype=np.int64).reshape(-1)
+        rows = len(sources) if batch else 1
+        hops = np.full(rows * node_num, -1, dtype=np.int32)
+        frontier = np.unique(sources + (np.arange(rows, dtype=np.int64) * node_num if batch else 0))
+        hops[frontier] = 0
+        depth = 0
+        while len(frontier) and (max_depth is None or depth < max_depth):
+            depth += 1
+            row, nodes = np.divmod(frontier, node_num)
+            neighbours, degrees = self.gather(nodes)
+            cells = neighbours + np.repeat(row * node_num, degrees)
+            frontier = np.unique(cells[hops[cells] == -1])
+            hops[frontier] = depth
+        return hops.reshape(rows, node_num) if batch else hops
+
+    @classmethod
+    def fromEdges(cls, edges, node_num):
+        u"""Returns the CSR adjacency of an (m, 2) array of undirected edges.
+            :param edges: the edges.
+            :param node_num: the number of node ids.
+        """
+        nodes = np.concatenate((edges[:, 0], edges[:, 1])).astype(np.int64)
+        values = np.concatenate((edges[:, 1], edges[:, 0])).astype(np.int32)
+        order = np.argsort(nodes, kind='stable')
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(nodes, minlength=node_num))))
+        return cls(indptr.astype(np.int64), values[order])
+
+
+class LevelOfDetail():
+    u"""Returns a view of a graph in at most budget nodes and super-nodes.
+        The largest components are shown while the budget lasts, the last
+        one by its top degree nodes and a periphery super-node (-65 - c).
+        The others are grouped by size into super-nodes (-1 - k for 2 ** k
+        up to 2 ** (k + 1) - 1 nodes).
+       :param nodes: the node ids.
+       :param degrees: the degrees of the nodes.
+       :param components: the component ids of the nodes.
+       :param sizes: the component sizes of the nodes.
+       :param src: the edge sources.
+       :param tgt: the edge targets.
+       :param budget: the max number of nodes and super-nodes shown.
+       :param small: the size up to which components are always collapsed.
+       :param positions: the (x, y) positions of the nodes, or None.
+    """
+    periphery = -65
+    missing = np.iinfo(np.int64).min
+
+    def __init__(self, nodes, degrees, components, sizes, src, tgt, budget, small=16, positions=None):
+        self.nodes = np.asarray(nodes, dtype=np.int64)
+        self.degrees = np.asarray(degrees, dtype=np.int32)
+        self.components = np.asarray(components, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.src = np.asarray(src, dtype=np.int64)
+        self.tgt = np.asarray(tgt, dtype=np.int64)
+        self.budget = budget
+        self.small = small
+        self.positions = positions
+        self.kept = self._select()
+        ids = np.where(self.kept, self.nodes, -1 - np.log2(np.maximum(self.sizes, 1)).astype(np.int64))
+        if self.partial is not None:
+            ids[~self.kept & (self.components == self.partial)] = self.periphery - self.partial
+        self.ids = ids
+        # The id every node id is shown with
+        self.display = np.full(int(self.nodes.max()) + 1 if len(self.nodes) else 0, self.missing, dtype=np.int64)
+        self.display[self.nodes] = ids
+        self._view = None
+
+    @classmethod
+    def of(cls, graph, budget, small=16):
+        u"""Returns the LevelOfDetail of a ProbGraph or a GraphSnapshot.
+            :param graph: the graph.
+            :param budget: the max number of nodes and super-nodes shown.
+            :param small: the size up to which components are collapsed.
+        """
+        columns = graph.getColumns()
+        return cls(columns['V'], columns['degrees'], graph.getComponentIds(columns['V']),
+                   graph.getComponentSizes(columns['V']), columns['src'], columns['tgt'], budget, small,
+                   graph.getPositions(columns['V']))
+
+    def _select(self):
+        # The whole components and the top nodes of a partial one shown
+        self.partial = None
+        if len(self.nodes) <= self.budget:
+            return np.ones(len(self.nodes), dtype=bool)
+        roots, counts = np.unique(self.components, return_counts=True)
+        remaining = self.budget - len(np.unique(np.log2(counts).astype(np.int64)))
+        shown, take = [], 0
+        for i in np.lexsort((roots, -counts)):
+            if counts[i] <= self.small or remaining < 2:
+                break
+            if counts[i] <= remaining:
+                shown.append(roots[i])
+                remaining -= counts[i]
+            else:
+                self.partial, take = int(roots[i]), remaining - 1
+                break
+        kept = np.isin(self.components, shown)
+        if self.partial is not None:
+            members = np.flatnonzero(self.components == self.partial)
+            kept[members[np.argsort(-self.degrees[members], kind='stable')[:take]]] = True
+        return kept
+
+    def __len__(self):
+        return len(np.unique(self.ids))
+
+    def view(self):
+        u"""Returns the int32 columns of the view: the nodes and super-nodes
+            shown, with their sizes and positions, and the edges between them
+            with their weights. It is cached and must not be changed.
+            :param None
+        """
+        if self._view is None:
+            self._view = self._aggregate()
+        return self._view
+
+    def _aggregate(self):
+        shown = np.unique(self.ids)
+        dense = np.searchsorted(shown, self.display)
+        a, b = dense[self.src], dense[self.tgt]
+        inner = a == b
+        low, high = np.minimum(a[~inner], b[~inner]), np.maximum(a[~inner], b[~inner])
+        pairs, weights = np.unique(low * len(shown) + high, return_counts=True)
+        collapsed = ~self.kept
+        supers, index, members = np.unique(self.ids[collapsed], return_inverse=True, return_counts=True)
+        span = int(self.components.max()) + 1 if len(self.nodes) else 1
+        components = np.unique(index * span + self.components[collapsed]) // span
+        view = {
+            'V': self.nodes[self.kept], 'degrees': self.degrees[self.kept],
+            'super': supers, 'super_nodes': members,
+            'super_components': np.bincount(components, minlength=len(supers)),
+            'super_edges': np.bincount(np.searchsorted(supers, shown[a[inner]]), minlength=len(supers)),
+            'src': shown[pairs // len(shown)], 'tgt': shown[pairs % len(shown)], 'weight': weights,
+        }
+        if self.positions is not None:
+            view['x'], view['y'] = self.positions[self.kept, 0], self.positions[self.kept, 1]
+            for axis, key in enumerate(('super_x', 'super_y')):
+                sums = np.bincount(index, weights=self.positions[collapsed, axis], minlength=len(supers))
+                view[key] = np.round(sums / np.maximum(members, 1)).astype(np.int32)
+        return view
+
+    def count(self, nodes):
+        u"""Returns the nodes of a list that are shown and the number of the
+            others in every super-node, in the order of view()['super'].
+            :param nodes: the node ids.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        nodes = nodes[nodes < len(self.display)]
+        ids = self.display[nodes]
+        nodes, ids = nodes[ids != self.missing], ids[ids != self.missing]
+        supers = np.unique(self.ids[~self.kept])
+        hidden = ids < 0
+        return nodes[~hidden], np.bincount(np.searchsorted(supers, ids[hidden]), minlength=len(supers))
+
+    def expand(self, super_id, offset=0, limit=None):
+        u"""Returns the int32 columns of a page of the nodes of a super-node
+            with their edges, every end with its id in the view, and the
+            offset of the next page or None. Raises KeyError if the view has
+            no such super-node.
+            :param super_id: the id of the super-node.
+            :param offset: the offset of the page.
+            :param limit: the max number of nodes of a page, the budget if
+            None.
+        """
+        limit = limit or self.budget
+        members = np.flatnonzero(self.ids == super_id) if super_id < 0 else []
+        if not len(members):
+            raise KeyError(super_id)
+        if super_id <= self.periphery:
+            members = members[np.argsort(-self.degrees[members], kind='stable')]
+            page = members[offset:offset + limit]
+            end = offset + len(page)
+            following = end if end < len(members) else None
+        else:
+            # Whole components, the largest first, as many as the page holds
+            members = members[np.lexsort((self.nodes[members], self.components[members], -self.sizes[members]))]
+            starts = np.flatnonzero(np.r_[True, np.diff(self.components[members]) != 0])
+            ends = np.r_[starts[1:], len(members)]
+            if offset >= len(starts):
+                page, following = members[:0], None
+            else:
+                last = max(int(np.searchsorted(ends, starts[offset] + limit, side='right')), offset + 1)
+                page = members[starts[offset]:ends[last - 1]]
+                following = last if last < len(starts) else None
+        inside = np.zeros(len(self.display), dtype=bool)
+        inside[self.nodes[page]] = True
+        edges = inside[self.src] | inside[self.tgt]
+        src, tgt = self.src[edges], self.tgt[edges]
+        columns = {'V': self.nodes[page], 'degrees': self.degrees[page], 'src': src, 'tgt': tgt,
+                   'src_view': self.display[src], 'tgt_view': self.display[tgt]}
+        if self.positions is not None:
+            columns['x'], columns['y'] = self.positions[page, 0], self.positions[page, 1]
+        return columns, following
+
+    def nbytes(self):
+        arrays = [self.nodes, self.degrees, self.components, self.sizes, self.src, self.tgt, self.kept, self.ids,
+                  self.display] + list((self._view or {}).values())
+        if self.positions is not None:
+            arrays.append(self.positions)
+        return sum(value.nbytes for value in arrays)
+
+
+class ForceLayout():
+    u"""Returns a force-directed layout of the components of a graph, with
+        int32 (x, y) positions and missing for the nodes not placed. In a
+        large component a node is pushed by a few random nodes of it at
+        every iteration. New nodes start next to their placed neighbours,
+        which do not move.
+       :param iterations: the iterations of the components laid out alone.
+       :param refinements: the iterations of the nodes placed next to others.
+       :param samples: the nodes repelling a node of a large component.
+       :param exact: the size up to which components repel pair by pair.
+       :param edge_length: the length of the edges.
+       :param seed: the seed of the random positions, None for any.
+    """
+    missing = np.iinfo(np.int32).min
+
+    def __init__(self, iterations=40, refinements=10, samples=8, exact=32, edge_length=64, seed=None):
+        self.iterations = iterations
+        self.refinements = refinements
+        self.samples = samples
+        self.exact = exact
+        self.edge_length = edge_length
+        self.random = np.random.default_rng(seed)
+
+    def place(self, positions, nodes, src, tgt, components):
+        u"""Place nodes in an array of positions, in place.
+            :param positions: the (n, 2) int32 positions of every node id.
+            :param nodes: the nodes to place, none of them placed.
+            :param src: the sources of the edges.
+            :param tgt: the targets of the edges.
+            :param components: the function returning the component ids of
+            an array of nodes.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if not len(nodes):
+            return
+        placed = positions[:, 0] != self.missing
+        pending = np.zeros(len(positions), dtype=bool)
+        pending[nodes] = True
+        touching = pending[src] | pending[tgt]
+        src = np.asarray(src[touching], dtype=np.int64)
+        tgt = np.asarray(tgt[touching], dtype=np.int64)
+        ends, others = np.concatenate((src, tgt)), np.concatenate((tgt, src))
+        xy = np.zeros((len(positions), 2))
+        xy[placed] = positions[placed]
+        known = placed.copy()
+        attached = []
+        while True:
+            # Level by level from the placed nodes, at the mean of the
+            # neighbours placed so far
+            reach = known[ends] & ~known[others]
+            if not reach.any():
+                break
+            targets, index = np.unique(others[reach], return_inverse=True)
+            counts = np.bincount(index)
+            for axis in (0, 1):
+                xy[targets, axis] = np.bincount(index, weights=xy[ends[reach], axis]) / counts
+            xy[targets] += self.random.normal(0, self.edge_length / 2.0, (len(targets), 2))
+            known[targets] = True
+            attached.append(targets)
+        if attached:
+            attached = np.concatenate(attached)
+            around = np.union1d(attached, ends[np.isin(others, attached)])
+            self._relax(xy, around, ~placed[around], components(around), src, tgt, self.refinements)
+        alone = nodes[~known[nodes]]
+        if len(alone):
+            groups = np.unique(components(alone), return_inverse=True)[1]
+            sizes = np.bincount(groups)
+            spread = self.edge_length * np.sqrt(sizes)[groups] / 2
+            xy[alone] = self.random.normal(0, 1, (len(alone), 2)) * spread[:, None]
+            linked = sizes[groups] > 1
+            if linked.any():
+                inner = np.unique(groups[linked], return_inverse=True)[1]
+                self._relax(xy, alone[linked], np.ones(len(inner), dtype=bool), inner, src, tgt, self.iterations)
+                self._scale(xy, alone[linked], inner, src, tgt)
+            if not linked.all():
+                # The isolated nodes go in a square grid packed as one
+                single = alone[~linked]
+                side = int(np.ceil(np.sqrt(len(single))))
+                xy[single, 0] = np.arange(len(single)) % side * self.edge_length
+                xy[single, 1] = np.arange(len(single)) // side * self.edge_length
+                groups[~linked] = len(sizes)
+                groups = np.unique(groups, return_inverse=True)[1]
+            self._pack(xy, alone, groups, positions[placed])
+        positions[nodes] = np.round(xy[nodes])
+
+    @staticmethod
+    def _pairs(starts, sizes):
+        # Every pair (i < j) of the positions within blocks of consecutive ones
+        total = int(sizes.sum())
+        first = np.repeat(starts, sizes) + np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        after = np.repeat(starts + sizes, sizes) - first - 1
+        a = np.repeat(first, after)
+        b = a + 1 + np.arange(int(after.sum())) - np.repeat(np.cumsum(after) - after, after)
+        return a, b
+
+    def _relax(self, xy, nodes, movable, groups, src, tgt, iterations):
+        u"""Move some nodes by the forces between them, cooling down.
+            :param xy: the float positions of every node id.
+            :param nodes: the nodes.
+            :param movable: the mask of the nodes that move.
+            :param groups: the component ids of the nodes.
+            :param src: the sources of the edges, those not between two of
+            the nodes being left out.
+            :param tgt: the targets of the edges.
+            :param iterations: the number of iterations.
+        """
+        count, length = len(nodes), float(self.edge_length)
+        # Numbered by component, so every component is a block
+        order = np.argsort(groups, kind='stable')
+        nodes, movable = nodes[order], movable[order]
+        _, starts, sizes = np.unique(groups[order], return_index=True, return_counts=True)
+        group = np.repeat(np.arange(len(sizes)), sizes)
+        small = sizes <= self.exact
+        pair_a, pair_b = self._pairs(starts[small], sizes[small])
+        sampled = np.flatnonzero(~small[group])
+        first, size = starts[group[sampled]], sizes[group[sampled]]
+        local = np.full(len(xy), -1, dtype=np.int64)
+        local[nodes] = np.arange(count)
+        inside = (local[src] >= 0) & (local[tgt] >= 0)
+        edge_a, edge_b = local[src[inside]], local[tgt[inside]]
+        x, y = xy[nodes, 0].copy(), xy[nodes, 1].copy()
+        # The step of a node cools down from a quarter of its component
+        members = sizes[group].astype(np.float64)
+        reach = length * (np.sqrt(members) + 1) / 4
+        scale = (size - 1.0) / self.samples
+        # The partners of the sampled nodes, shifted by a random offset at
+        # every iteration instead of drawn again
+        offsets = self.random.integers(0, size[:, None], (len(sampled), self.samples))
+        for step in range(iterations):
+            # Repulsion of length ** 2 / distance
+            force_x, force_y = np.zeros(count), np.zeros(count)
+            dx, dy = x[pair_a] - x[pair_b], y[pair_a] - y[pair_b]
+            push = length ** 2 / (dx * dx + dy * dy + 1.0)
+            force_x += np.bincount(pair_a, weights=dx * push, minlength=count) - \
+                np.bincount(pair_b, weights=dx * push, minlength=count)
+            force_y += np.bincount(pair_a, weights=dy * push, minlength=count) - \
+                np.bincount(pair_b, weights=dy * push, minlength=count)
+            if len(sampled):
+                partners = first[:, None] + (offsets + int(self.random.integers(0, 1 << 30))) % size[:, None]
+                dx, dy = x[sampled][:, None] - x[partners], y[sampled][:, None] - y[partners]
+                push = length ** 2 / (dx * dx + dy * dy + 1.0)
+                force_x[sampled] += (dx * push).sum(axis=1) * scale
+                force_y[sampled] += (dy * push).sum(axis=1) * scale
+            # Attraction of distance ** 2 / length
+            dx, dy = x[edge_b] - x[edge_a], y[edge_b] - y[edge_a]
+            pull = np.sqrt(dx * dx + dy * dy) / length
+            force_x += np.bincount(edge_a, weights=dx * pull, minlength=count) - \
+                np.bincount(edge_b, weights=dx * pull, minlength=count)
+            force_y += np.bincount(edge_a, weights=dy * pull, minlength=count) - \
+                np.bincount(edge_b, weights=dy * pull, minlength=count)
+            # Gravity keeps the nodes of a component together
+            force_x += (np.bincount(group, weights=x)[group] / members - x) * 0.05
+            force_y += (np.bincount(group, weights=y)[group] / members - y) * 0.05
+            magnitude = np.sqrt(force_x * force_x + force_y * force_y) + 1e-9
+            move = np.minimum(magnitude, reach * (1 - step / float(iterations)) + 1) / magnitude * movable
+            x += force_x * move
+            y += force_y * move
+        xy[nodes, 0], xy[nodes, 1] = x, y
+
+    def _scale(self, xy, nodes, groups, src, tgt):
+        u"""Scale the components laid out alone around their centres for a
+            geometric mean of the lengths of their edges of edge_length,
+            which repulsion leaves longer in trees and stars.
+            :param xy: the float positions of every node id.
+            :param nodes: the nodes of the components.
+            :param groups: the component index of every node, from 0.
+            :param src: the sources of the edges.
+            :param tgt: the targets of the edges.
+        """
+        local = np.full(len(xy), -1, dtype=np.int64)
+        local[nodes] = np.arange(len(nodes))
+        inside = (local[src] >= 0) & (local[tgt] >= 0)
+        ends = local[src[inside]]
+        logs = np.log(np.sqrt(((xy[src[inside]] - xy[tgt[inside]]) ** 2).sum(axis=1)) + 1e-9)
+        count = groups.max() + 1
+        edges = np.bincount(groups[ends], minlength=count)
+        scale = np.ones(count)
+        has = edges > 0
+        scale[has] = self.edge_length / np.exp(np.bincount(groups[ends], weights=logs, minlength=count)[has] / edges[has])
+        at = xy[nodes]
+        sizes = np.bincount(groups, minlength=count)
+        centres = np.stack([np.bincount(groups, weights=at[:, axis], minlength=count) for axis in (0, 1)], axis=1) \
+            / sizes[:, None]
+        xy[nodes] = centres[groups] + (at - centres[groups]) * scale[groups][:, None]
+
+    def _pack(self, xy, nodes, groups, placed):
+        u"""Move the components laid out alone into rows of boxes under the
+            placed nodes, largest first.
+            :param xy: the float positions of every node id.
+            :param nodes: the nodes of the components.
+            :param groups: the component index of every node, from 0.
+            :param placed: the positions of the placed nodes.
+        """
+        at = xy[nodes]
+        order = np.argsort(groups, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(groups[order]) != 0])
+        low = np.minimum.reduceat(at[order], starts)
+        high = np.maximum.reduceat(at[order], starts)
+        gap = float(self.edge_length)
+        boxes = high - low + gap
+        if len(placed):
+            left, top = float(placed[:, 0].min()), float(placed[:, 1].max()) + gap
+            width = max(float(placed[:, 0].max()) - left, np.sqrt((boxes[:, 0] * boxes[:, 1]).sum()))
+        else:
+            left, top = 0.0, 0.0
+            width = np.sqrt((boxes[:, 0] * boxes[:, 1]).sum())
+        # The tallest first, a new row at every width along the boxes in a
+        # line, so the last box of a row may stick out by less than itself
+        tallest = np.lexsort((boxes[:, 0], -boxes[:, 1]))
+        along = np.cumsum(boxes[tallest, 0]) - boxes[tallest, 0]
+        rows = (along // width).astype(np.int64)
+        firsts = np.flatnonzero(np.r_[True, np.diff(rows) != 0])
+        heights = boxes[tallest[firsts], 1]
+        row = np.cumsum(np.r_[True, np.diff(rows) != 0]) - 1
+        corners = np.empty_like(low)
+        corners[tallest, 0] = left + along - along[firsts][row]
+        corners[tallest, 1] = top + (np.cumsum(heights) - heights)[row]
+        xy[nodes] = at - low[groups] + corners[groups]
+
+
+class GraphSnapshot():
+    u"""Returns a read-only graph frozen into flat numpy arrays: the node
+        list, alive flags, CSR adjacency, edges, degrees and component labels
+        and any extra arrays of derived graphs. The arrays can be views of a
+        shared memory segment or a mapped file, packed after a JSON header
+        with every array aligned to 64 bytes.
+       :param arrays: the dict of arrays by name.
+       :param meta: the dict of plain values describing the graph.
+    """
+    magic = b'DGSNAP01'
+    alignment = 64
+
+    def __init__(self, arrays, meta):
+        self.arrays = arrays
+        self.meta = meta
+        self.V = arrays['V']
+        self.alive = arrays['alive']
+        self.labels = arrays['labels']
+        self.neighbours = CSRAdjacency(arrays['indptr'], arrays['indices'])
+        self.isolated_nodes = arrays['isolated']
+        self.version = meta.get('version', 0)
+        self.epoch = meta.get('epoch')
+        self.positions = arrays.get('positions')
+        self._component_cache = None
+        self._component_sizes = None
+        self._details = {}
+        for name in meta.get('attributes', []):
+            setattr(self, name, arrays[name] if name in arrays else meta[name])
+
+    def _layout(self):
+        entries, offset = [], 0
+        for name, value in self.arrays.items():
+            entries.append([name, value.dtype.str, list(value.shape), offset])
+            offset += -(-value.nbytes // self.alignment) * self.alignment
+        header = json.dumps({'meta': self.meta, 'arrays': entries}).encode('utf-8')
+        start = -(-(len(self.magic) + 4 + len(header)) // self.alignment) * self.alignment
+        return header, start, start + offset
+
+    def nbytes(self):
+        return self._layout()[2]
+
+    def pack_into(self, buffer):
+        u"""Write the header and the arrays into a writable buffer of at least
+            nbytes() bytes.
+            :param buffer: the buffer.
+        """
+        header, start, _ = self._layout()
+        view = np.frombuffer(buffer, dtype=np.uint8)
+        view[:len(self.magic)] = np.frombuffer(self.magic, dtype=np.uint8)
+        view[len(self.magic):len(self.magic) + 4] = np.frombuffer(struct.pack('<I', len(header)), dtype=np.uint8)
+        view[len(self.magic) + 4:len(self.magic) + 4 + len(header)] = np.frombuffer(header, dtype=np.uint8)
+        offset = start
+        for value in self.arrays.values():
+            raw = np.ascontiguousarray(value).view(np.uint8).reshape(-1)
+            view[offset:offset + len(raw)] = raw
+            offset += -(-value.nbytes // self.alignment) * self.alignment
+
+    @classmethod
+    def frombuffer(cls, buffer):
+        u"""Returns a snapshot whose arrays are read-only views of a buffer
+            written by pack_into, without copying them.
+            :param buffer: the buffer.
+        """
+        raw = np.frombuffer(buffer, dtype=np.uint8)
+        magic = bytes(raw[:len(cls.magic)])
+        if magic != cls.magic:
+            if magic[:-2] == cls.magic[:-2]:
+                raise ValueError('unsupported graph snapshot version %s' % magic[-2:].decode('ascii', 'replace'))
+            raise ValueError('not a graph snapshot')
+        length = struct.unpack('<I', bytes(raw[len(cls.magic):len(cls.magic) + 4]))[0]
+        header = json.loads(bytes(raw[len(cls.magic) + 4:len(cls.magic) + 4 + length]).decode('utf-8'))
+        start = -(-(len(cls.magic) + 4 + length) // cls.alignment) * cls.alignment
+        arrays = {}
+        for name, dtype, shape, offset in header['arrays']:
+            value = np.ndarray(shape, dtype=np.dtype(dtype), buffer=raw, offset=start + offset)
+            value.flags.writeable = False
+            arrays[name] = value
+        return cls(arrays, header['meta'])
+
+    def save(self, path):
+        u"""Write the snapshot to a file. The file is written next to the path
+            and renamed over it, so readers never see a partial file.
+            :param path: the path of the file.
+        """
+        partial = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            mapped = np.memmap(partial, dtype=np.uint8, mode='w+', shape=(self.nbytes(),))
+            self.pack_into(mapped)
+            mapped.flush()
+            del mapped
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        u"""Returns the snapshot saved in a file. With mmap the arrays are
+            views of the mapped file, so opening it reads only the header and
+            the pages of the arrays are read when they are used. Otherwise the
+            file is read into memory.
+            :param path: the path of the file.
+            :param mmap: map the file instead of reading it.
+        """
+        if mmap:
+            return cls.frombuffer(np.memmap(path, dtype=np.uint8, mode='r'))
+        with open(path, 'rb') as handle:
+            return cls.frombuffer(handle.read())
+
+    def hasNode(self, v):
+        return 0 <= v < len(self.alive) and self.alive[v] == 1
+
+    def getCursor(self):
+        return self.meta.get('cursor')
+
+    def getTag(self):
+        return '%s-%d' % (self.epoch, self.version)
+
+    def getStats(self):
+        u"""Returns the statistics of the graph, see ProbGraph.getStats: the
+            ones saved with the snapshot, else computed from its arrays."""
+        stats = self.meta.get('stats')
+        if stats is None:
+            labels = self.labels[self.V]
+            sizes = np.bincount(labels)
+            stats = GraphStats.of(self.arrays['degrees'][self.V], sizes[sizes > 0]).summary()
+        return dict(stats, edges=len(self.arrays['edges']))
+
+    def getMutations(self, cursor):
+        u"""A snapshot keeps no journal, so readers always need a keyframe."""
+        return None
+
+    def _edgeArray(self):
+        return self.arrays['edges']
+
+    def getEdges(self):
+        return self.arrays['edges'].tolist()
+
+    def getColumns(self):
+        u"""Returns the nodes, their degrees and the edge endpoints as int32
+            numpy arrays (V, degrees, src, tgt).
+            :param None
+        """
+        edges = self.arrays['edges']
+        return {
+            'V': self.V,
+            'degrees': self.arrays['degrees'][self.V],
+            'src': np.ascontiguousarray(edges[:, 0]),
+            'tgt': np.ascontiguousarray(edges[:, 1]),
+        }
+
+    @property
+    def connected_components(self):
+        u"""The list of all connected components with more than one node."""
+        if self._component_cache is None:
+            nodes = self.V.astype(np.int64)
+            roots = self.labels[nodes]
+            order = np.argsort(roots, kind='stable')
+            nodes, roots = nodes[order], roots[order]
+            bounds = np.flatnonzero(np.diff(roots)) + 1
+            self._component_cache = [component.tolist() for component in np.split(nodes, bounds)
+                                     if len(component) > 1]
+        return self._component_cache
+
+    def getComponents(self):
+        return self.connected_components
+
+    def getComponentId(self, v):
+        return int(self.labels[v])
+
+    def getComponentSize(self, v):
+        return int(self.getComponentSizes([v])[0])
+
+    def getComponentIds(self, nodes):
+        return self.labels[np.asarray(nodes, dtype=np.int64)].astype(np.int64)
+
+    def getComponentSizes(self, nodes):
+        if self._component_sizes is None:
+            self._component_sizes = np.bincount(self.labels[self.V], minlength=len(self.labels))
+        return self._component_sizes[self.getComponentIds(nodes)]
+
+    def getPositions(self, nodes):
+        if self.positions is None:
+            return None
+        return self.positions[np.asarray(nodes, dtype=np.int64)]
+
+    def bfsearch(self, start_node):
+        u"""A bfs from a start node. It returns every visited node with its
+            edge degree and its number of hops from the start node.
+            :param start_node: the node started searching by bfs.
+        """
+        hops = self.neighbours.distances([start_node])
+        nodes = np.flatnonzero(hops >= 0)
+        nodes = nodes[np.argsort(hops[nodes], kind='stable')]
+        degrees = self.neighbours.indptr[nodes + 1] - self.neighbours.indptr[nodes]
+        return dict((v, [d, h]) for v, d, h in zip(nodes.tolist(), degrees.tolist(), hops[nodes].tolist()))
+
+    def getDistances(self, sources, max_depth=None, batch=False):
+        u"""Returns the hops from the sources to every node id, -1 if not
+            reached. See CSRAdjacency.distances.
+            :param sources: the nodes at 0 hops.
+            :param max_depth: the max hops searched, None for no limit.
+            :param batch: answer one search per source.
+        """
+        return self.neighbours.distances(sources, max_depth, batch)
+
+    def getLevelOfDetail(self, budget, small=16):
+        u"""Returns the LevelOfDetail of the graph in at most budget nodes.
+            :param budget: the max number of nodes and super-nodes shown.
+            :param small: the size up to which components are collapsed.
+        """
+        if (budget, small) not in self._details:
+            self._details[budget, small] = LevelOfDetail.of(self, budget, small)
+        return self._details[budget, small]
+
+
+class MutationLog():
+    u"""Returns an append-only file of the changes made through the public
+        methods of a graph, one binary batch record per call, so a graph can
+        be rebuilt after its worker is gone. Every record is a header of the
+        body length, the crc32 of the body, the sequence number and the
+        operation, then a body of int32 arrays: their lengths and their
+        values. Random choices are logged by their outcome, so replaying the
+        records rebuilds the same graph. compact() saves the graph as a base
+        GraphSnapshot next to the log and empties the log. A torn record at
+        the end of the file is dropped when it is opened.
+       :param path: the path of the log, the base snapshot is path + '.snap'.
+       :param seq: the sequence number of the base snapshot.
+       :param sync: fsync the file after every record.
+    """
+    ADD, DEL_NODES, ADD_POISON, DEL_POISON, SET_POISON, SET_POSITIONS = range(6)
+    header = struct.Struct('<IIQB3x')
+
+    def __init__(self, path, seq=0, sync=False):
+        self.path = path
+        self.base_path = path + '.snap'
+        self.sync = sync
+        self.seq = seq
+        end = 0
+        for record_seq, _, _, end in self._scan():
+            self.seq = max(self.seq, record_seq)
+        self.handle = open(path, 'ab')
+        if self.handle.tell() > end:
+            self.handle.truncate(end)
+
+    def _scan(self, since=0):
+        # Yields (seq, op, arrays, end offset) up to the first torn record
+        try:
+            with open(self.path, 'rb') as handle:
+                data = handle.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        while offset + self.header.size <= len(data):
+            length, crc, seq, op = self.header.unpack_from(data, offset)
+            start, end = offset + self.header.size, offset + self.header.size + length
+            if end > len(data) or zlib.crc32(data[start:end]) != crc:
+                return
+            if seq > since:
+                count = struct.unpack_from('<I', data, start)[0]
+                lengths = struct.unpack_from('<%dI' % count, data, start + 4)
+                arrays, position = [], start + 4 + 4 * count
+                for size in lengths:
+                    arrays.append(np.frombuffer(data, dtype='<i4', count=size, offset=position))
+                    position += 4 * size
+                yield seq, op, arrays, end
+            offset = end
+
+    def append(self, op, *arrays):
+        u"""Write a record of int32 arrays and returns its sequence number.
+            :param op: the operation of the record.
+            :param arrays: the arrays of the record.
+        """
+        arrays = [np.ascontiguousarray(a, dtype='<i4') for a in arrays]
+        body = b''.join([struct.pack('<%dI' % (len(arrays) + 1), len(arrays), *map(len, arrays))] +
+                        [a.tobytes() for a in arrays])
+        self.seq += 1
+        self.handle.write(self.header.pack(len(body), zlib.crc32(body), self.seq, op) + body)
+        self.handle.flush()
+        if self.sync:
+            os.fsync(self.handle.fileno())
+        return self.seq
+
+    def records(self, since=0):
+        u"""Returns an iterator of the (seq, op, arrays) records after a
+            sequence number.
+            :param since: the sequence number already applied.
+        """
+        return ((seq, op, arrays) for seq, op, arrays, _ in self._scan(since))
+
+    def replay(self, graph, since=0):
+        u"""Apply the records after a sequence number to a graph without
+            logging them again, and returns the last sequence number applied.
+            :param graph: the graph.
+            :param since: the sequence number already in the graph.
+        """
+        log, graph.log = graph.log, None
+        try:
+            for seq, op, arrays in self.records(since):
+                graph._applyRecord(op, arrays)
+                since = seq
+        finally:
+            graph.log = log
+        return since
+
+    def compact(self, graph):
+        u"""Save a graph holding every record as the base snapshot and empty
+            the log. The snapshot keeps the sequence number it holds, so the
+            records are skipped if the log is not emptied.
+            :param graph: the graph.
+        """
+        snapshot = graph.freeze()
+        snapshot.meta['log_seq'] = self.seq
+        snapshot.save(self.base_path)
+        self.handle.truncate(0)
+
+    def restore(self, cls):
+        u"""Returns a graph of a class rebuilt from the base snapshot and the
+            records after it, logging its changes here, or None if there is
+            no base snapshot.
+            :param cls: the class of the graph.
+        """
+        try:
+            snapshot = GraphSnapshot.load(self.base_path)
+        except FileNotFoundError:
+            return None
+        graph = cls.fromSnapshot(snapshot)
+        self.seq = max(self.seq, self.replay(graph, snapshot.meta['log_seq']))
+        # Replayed changes do not bump the version as the original ones did
+        graph.epoch = '%08x' % random.getrandbits(32)
+        graph.logMutations(self)
+        return graph
+
+    def size(self):
+        return os.fstat(self.handle.fileno()).st_size
+
+    def close(self):
+        self.handle.close()
+
+    def discard(self):
+        u"""Close the log and remove its files.
+            :param None
+        """
+        self.close()
+        for path in (self.path, self.base_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
 class ProbGraph():
     u"""Returns a class of processed graph following a power-law rule of edge
         degrees for every node and size of components based on the node numbers,
@@ -79,16 +1795,48 @@ class ProbGraph():
        :param empty: If it is True, ProbGraph will be generated by nodes list
        only without any connections.
        If it is False, ProGraph will be generated from scratch.
+       :param engine: 'python' grows the graph one source node at a time.
+       'numpy' draws component sizes, degrees and attachment targets in large
+       batches and produces the edges as int32 arrays in chunks.
+       :param storage: 'dict' keeps neighbours as a dict of lists. 'compact'
+       keeps them in growable int32 arrays (CompactAdjacency). E is an EdgeSet
+       and connected_nodes a DegreeSampler with either storage.
        """
-    def __init__(self, node_num, edge_num, gamma = 3, empty = False):
+    bulk_chunk = 1 << 16
+    # The function given the phase names and seconds of the timed methods
+    observe = None
+
+    def __init__(self, node_num, edge_num, gamma = 3, empty = False, engine = 'python',
+                 storage = 'dict'):
+            if engine not in ('python', 'numpy'):
+                raise ValueError('unknown engine %r' % engine)
+            if storage not in ('dict', 'compact'):
+                raise ValueError('unknown storage %r' % storage)
+            self.engine = engine
+            self.storage = storage
             self.V = list(range(node_num))
-            self.E = []
+            self.alive = bytearray(b'\x01') * node_num
             self.temp_component = []
-            self.connected_nodes = []
-            self.connected_components = []
+            self.disjoint_set = DisjointSet(node_num)
+            self._component_cache = None
+            self.version = 0
+            self.epoch = '%08x' % random.getrandbits(32)
+            self.cache = None
+            self.stats = None
+            self.journal = None
+            self.log = None
+            self.positions = None
+            self.layout = None
             self.gamma = gamma
-            self.neighbours = {}
-            self.visited = {}
+            self.samplers = {}
+            self.E = EdgeSet()
+            self.connected_nodes = DegreeSampler(node_num)
+            if storage == 'compact':
+                self.neighbours = CompactAdjacency(node_num)
+                self.visited = None
+            else:
+                self.neighbours = AdjacencyDict()
+                self.visited = {}
             self.source = gamma
             self.isolated_nodes = []
 
@@ -97,7 +1845,6 @@ class ProbGraph():
             #############################
             if self._initialize(node_num) and not empty:
                 self._createEdges(edge_num)
-                self.updateComponents()
 
     def _initialize(self, node_num):
         u"""Generate a full connected small graph using BA model.
@@ -106,12 +1853,13 @@ class ProbGraph():
         """
         if node_num <= self.gamma:
             return False
-        for v in list(range(node_num)):
-            self.neighbours[v] = []
-            self.visited[v] = 0
+        self.neighbours.add_nodes(range(node_num))
+        if self.visited is not None:
+            for v in range(node_num):
+                self.visited[v] = 0
         init_nodes = list(range(self.gamma))
         while (len(init_nodes) > 0):
-            edge = power_law(xmin=1, xmax=self.gamma).rvs(size=1)[0]
+            edge = self._sampler(1, self.gamma).draw()
             targets = []
             while (len(targets) < edge and len(init_nodes) > 0):
                 x = random.choice(init_nodes)
@@ -120,11 +1868,7 @@ class ProbGraph():
 
             for pair in list(zip([self.source] * edge, targets)):
                 if pair[0] != pair[1]:
-                    self.neighbours.get(pair[0]).append(pair[1])
-                    self.neighbours.get(pair[1]).append(pair[0])
-                    self.E.append(pair)
-            self.connected_nodes.extend(targets)
-            self.connected_nodes.extend([self.source] * len(targets))
+                    self._link(pair)
             self.source += 1
             if self.source >= node_num:
                 break
@@ -135,10 +1879,7 @@ class ProbGraph():
             to other components.
             :param nodes: a single node of class GraphNode
         """
-        self.neighbours.get(nodes[0]).append(nodes[1])
-        self.neighbours.get(nodes[1]).append(nodes[0])
-        self.E.append((nodes[0], nodes[1]))
-        self.connected_nodes.extend(nodes)
+        self._link((nodes[0], nodes[1]))
         self.source +=2
 
     def _createNet(self, nodes):
@@ -148,7 +1889,7 @@ class ProbGraph():
         """
         self.source += len(nodes)
         while (len(nodes) > 0) and self.source < self.V[-1] + 1:
-            edge = power_law(xmin=1, xmax=len(nodes)).rvs(size=1)[0]
+            edge = self._sampler(1, len(nodes)).draw()
             targets = []
             while (len(targets) < edge and len(nodes) > 0):
                 x = random.choice(nodes)
@@ -156,21 +1897,30 @@ class ProbGraph():
                 nodes.remove(x)
             for pair in list(zip([self.source] * edge, targets)):
                 if pair[0] != pair[1]:
-                    self.neighbours.get(pair[0]).append(pair[1])
-                    self.neighbours.get(pair[1]).append(pair[0])
-                    self.E.append(pair)
-            self.connected_nodes.extend(targets)
-            self.connected_nodes.extend([self.source] * len(targets))
+                    self._link(pair)
             self.source += 1
 
+    def _sampler(self, exponent, xmax):
+        u"""Returns the PowerLawSampler of the graph for (exponent, xmax).
+            :param exponent: the exponent of the power law
+            :param xmax: the max value of in the sample
+        """
+        sampler = self.samplers.get((exponent, xmax))
+        if sampler is None:
+            sampler = self.samplers[(exponent, xmax)] = PowerLawSampler(exponent, xmax)
+        return sampler
+
+    @timed('generate')
     def _createEdges(self, edge_num):
         u"""Add new edges to a graph using BA model following a power-law
             rule of edge degrees for every node.
             :param edge_num: the max number of edges in the graph.
         """
+        if self.engine == 'numpy':
+            return self._createEdgesBulk(edge_num)
         while self.source < self.V[-1] + 1 and len(self.E) <= edge_num:
             # print("current of source", self.source)
-            iso = power_law(xmin=1, xmax=self.gamma).rvs(size=1)[0]
+            iso = self._sampler(1, self.gamma).draw()
             if self.source + iso > self.V[-1] + 1:
                 self.isolated_nodes.extend(list(range(self.source, self.V[-1] + 1)))
                 self.source = self.V[-1] + 1
@@ -187,20 +1937,685 @@ class ProbGraph():
                 continue
 
             # Add Edges to main framework
-            edge = power_law(xmin=1, xmax=self.gamma).rvs(size=1)[0]
+            edge = self._sampler(1, self.gamma).draw()
             targets = set()
             while len(targets) < edge:
-                x = random.choice(self.connected_nodes)
+                x = self.connected_nodes.draw()
                 targets.add(x)
             for pair in list(zip([self.source] * edge, targets)):
                 if pair[0] != pair[1]:
-                    self.neighbours.get(pair[0]).append(pair[1])
-                    self.neighbours.get(pair[1]).append(pair[0])
-                    self.E.append(pair)
-            self.connected_nodes.extend(targets)
-            self.connected_nodes.extend([self.source] * edge)
+                    self._link(pair)
             self.source += 1
 
+    def _createEdgesBulk(self, edge_num):
+        u"""Vectorized version of _createEdges. Components are drawn a chunk
+            at a time with the same rules: isolated nodes, pairs, _createNet
+            style clusters and nodes attached to the main framework by
+            preferential attachment. Targets are drawn by degree from the
+            sampler (connected_nodes) and from the endpoints created earlier
+            in the same chunk, which keeps the attachment exactly preferential.
+            :param edge_num: the max number of edges in the graph.
+        """
+        node_end = self.V[-1] + 1
+        edge_count = len(self.E)
+        sampler = self._sampler(1, self.gamma)
+        while self.source < node_end and edge_count <= edge_num:
+            iso = sampler.draw_many(min(self.bulk_chunk, node_end - self.source))
+
+            # Hubs of every _createNet cluster, one draw round at a time
+            net_idx = np.flatnonzero((iso > 2) & (iso < self.gamma))
+            remaining = iso[net_idx].copy()
+            hub_net, hub_take = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+            while True:
+                active = np.flatnonzero(remaining > 0)
+                if not active.size:
+                    break
+                takes = np.empty(active.size, dtype=np.int64)
+                for r in np.unique(remaining[active]):
+                    sel = remaining[active] == r
+                    takes[sel] = self._sampler(1, int(r)).draw_many(int(sel.sum()))
+                hub_net.append(active)
+                hub_take.append(takes)
+                remaining[active] -= takes
+            hub_net, hub_take = np.concatenate(hub_net), np.concatenate(hub_take)
+            order = np.argsort(hub_net, kind='stable')
+            hub_net, hub_take = hub_net[order], hub_take[order]
+            hubs = np.bincount(hub_net, minlength=len(net_idx))
+
+            # Nodes and edges used by every drawn component
+            main_idx = np.flatnonzero(iso >= self.gamma)
+            consumed = np.ones(len(iso), dtype=np.int64)
+            consumed[iso == 2] = 2
+            consumed[net_idx] = iso[net_idx] + hubs
+            degree = np.zeros(len(iso), dtype=np.int64)
+            degree[iso == 2] = 1
+            degree[net_idx] = iso[net_idx]
+            degree[main_idx] = sampler.draw_many(len(main_idx))
+            start = self.source + np.concatenate(([0], np.cumsum(consumed)))
+            edges_before = edge_count + np.concatenate(([0], np.cumsum(degree)[:-1]))
+
+            # Stop where the original loop would: out of nodes or of edges
+            cut = len(iso)
+            out_of_nodes = False
+            overflow = np.flatnonzero(start[:-1] + iso > node_end)
+            if overflow.size:
+                cut, out_of_nodes = overflow[0], True
+            over_budget = np.flatnonzero(edges_before > edge_num)
+            if over_budget.size and over_budget[0] < cut:
+                cut, out_of_nodes = over_budget[0], False
+            next_source = int(start[cut])
+            iso, degree, start = iso[:cut], degree[:cut], start[:cut]
+            hub_keep = np.repeat(net_idx < cut, hubs)
+            hubs = hubs[net_idx < cut]
+            net_idx = net_idx[net_idx < cut]
+            hub_net, hub_take = hub_net[hub_keep], hub_take[hub_keep]
+            main_idx = main_idx[main_idx < cut]
+
+            # Every hub is linked to the next hub_take leaves of its cluster
+            first_hub = np.cumsum(hubs) - hubs
+            hub_entry = net_idx[hub_net]
+            hub_node = start[hub_entry] + iso[hub_entry] + np.arange(len(hub_net)) - np.repeat(first_hub, hubs)
+            taken = np.cumsum(hub_take) - hub_take
+            leaf_first = start[hub_entry] + taken - np.repeat(taken[first_hub], hubs)
+            net_edge = np.repeat(np.arange(len(hub_take)), hub_take)
+            net_rank = np.arange(len(net_edge)) - taken[net_edge]
+
+            # Edges of pairs, clusters and main framework nodes in chunk order
+            pair_idx = np.flatnonzero(iso == 2)
+            main_degree = degree[main_idx]
+            entry = np.concatenate((pair_idx, hub_entry[net_edge], np.repeat(main_idx, main_degree)))
+            src = np.concatenate((start[pair_idx], hub_node[net_edge], np.repeat(start[main_idx], main_degree)))
+            tgt = np.concatenate((start[pair_idx] + 1, leaf_first[net_edge] + net_rank,
+                                  np.full(int(main_degree.sum()), -1, dtype=np.int64)))
+            order = np.argsort(entry, kind='stable')
+            entry, src, tgt = entry[order], src[order], tgt[order]
+            tgt = self._attachTargets(entry, src, tgt, self.connected_nodes)
+
+            # Main framework targets of a node have to be distinct
+            valid = (tgt >= 0) & (src < node_end)
+            entry, src, tgt = entry[valid], src[valid], tgt[valid]
+            order = np.lexsort((tgt, entry))
+            repeated = np.zeros(len(tgt), dtype=bool)
+            repeated[order[1:]] = (entry[order[1:]] == entry[order[:-1]]) & (tgt[order[1:]] == tgt[order[:-1]])
+            src, tgt = src[~repeated].astype(np.int32), tgt[~repeated].astype(np.int32)
+
+            self.isolated_nodes.extend(start[iso == 1].tolist())
+            self._addEdgeArrays(src, tgt)
+            edge_count += len(src)
+
+            self.source = min(next_source, node_end)
+            if out_of_nodes:
+                self.isolated_nodes.extend(range(self.source, node_end))
+                self.source = node_end
+
+    def _attachTargets(self, entry, src, tgt, ends):
+        u"""Resolve the preferential attachment targets (marked -1) of a chunk
+            of edges. Every target is a uniform draw over the endpoints as
+            they were before its source node, i.e. the old endpoints followed
+            by the two endpoints of every earlier edge in the chunk. Targets
+            that can not be drawn are left negative.
+            :param entry: the component index of every edge, sorted.
+            :param src: the source node of every edge.
+            :param tgt: the known target of every edge or -1.
+            :param ends: the DegreeSampler of the endpoints before the chunk.
+        """
+        attached = tgt < 0
+        pending = np.flatnonzero(attached)
+        if not pending.size:
+            return tgt
+        tgt = tgt.copy()
+        bound = len(ends) + 2 * np.searchsorted(entry, entry[pending], side='left')
+        tgt[pending[bound == 0]] = -2
+        pending, bound = pending[bound > 0], bound[bound > 0]
+        draw = (np.random.random_sample(len(pending)) * bound).astype(np.int64)
+
+        # A draw is an old endpoint, the source of an earlier edge, or the
+        # target of an earlier edge which may itself be a pending draw
+        pointer = np.full(len(tgt), -1, dtype=np.int64)
+        old = draw < len(ends)
+        tgt[pending[old]] = ends.locate(draw[old])
+        slot = draw[~old] - len(ends)
+        chained = pending[~old]
+        tgt[chained[slot % 2 == 1]] = src[slot[slot % 2 == 1] // 2]
+        pointer[chained[slot % 2 == 0]] = slot[slot % 2 == 0] // 2
+        unresolved = np.flatnonzero(pointer >= 0)
+        while unresolved.size:
+            ahead = pointer[unresolved]
+            jump = pointer[ahead]
+            done = jump < 0
+            tgt[unresolved[done]] = tgt[ahead[done]]
+            pointer[unresolved[done]] = -1
+            pointer[unresolved[~done]] = jump[~done]
+            unresolved = unresolved[~done]
+
+        # Draw again from the old endpoints for repeated targets of a node
+        for _ in range(3 if len(ends) else 0):
+            order = np.lexsort((tgt, entry))
+            repeated = np.zeros(len(tgt), dtype=bool)
+            repeated[order[1:]] = (entry[order[1:]] == entry[order[:-1]]) & \
+                (tgt[order[1:]] == tgt[order[:-1]])
+            repeated &= attached & (tgt >= 0)
+            if not repeated.any():
+                break
+            tgt[repeated] = ends.draw_many(int(repeated.sum()))
+        return tgt
+
+    def _link(self, pair):
+        u"""Add a single edge to the neighbours and the edge list.
+            :param pair: the edge to be added.
+        """
+        self._changed(pair)
+        if self.stats is not None:
+            degrees = (self.connected_nodes.weights[pair[0]], self.connected_nodes.weights[pair[1]])
+            sizes = [self.disjoint_set.size[root] for root in
+                     {self.disjoint_set.find(pair[0]), self.disjoint_set.find(pair[1])}]
+        self.neighbours.link(pair[0], pair[1])
+        self.E.add(pair, check=False)
+        self.connected_nodes.add(pair[0])
+        self.connected_nodes.add(pair[1])
+        if self.journal is not None:
+            self.journal.record(MutationJournal.ADD_EDGE, pair[0], pair[1])
+        self.disjoint_set.union(pair[0], pair[1])
+        if self.stats is not None:
+            self.stats.changeDegrees(degrees, (degrees[0] + 1, degrees[1] + 1))
+            if len(sizes) == 2:
+                self.stats.changeComponents(sizes, (sizes[0] + sizes[1],))
+
+    def _addEdgeArrays(self, src, tgt):
+        u"""Add a batch of edges given as two int32 arrays of endpoints.
+            :param src: the source node of every edge.
+            :param tgt: the target node of every edge.
+        """
+        self._changed(np.concatenate((src, tgt)))
+        if self.stats is not None:
+            nodes, counts = np.unique(np.concatenate((src, tgt)), return_counts=True)
+            degrees = np.frombuffer(self.connected_nodes.weights, dtype=np.int32)[nodes]
+            sizes = self._componentSizes(nodes)
+        self.neighbours.link_many(src, tgt)
+        self.disjoint_set.union_many(src, tgt)
+        self.E.add_many(src, tgt, check=False)
+        self.connected_nodes.add_many(np.concatenate((src, tgt)))
+        if self.journal is not None:
+            self.journal.record_many(MutationJournal.ADD_EDGE, src, tgt)
+        if self.stats is not None:
+            self.stats.changeDegrees(degrees, degrees + counts)
+            self.stats.changeComponents(sizes, self._componentSizes(nodes))
+
+    def _addNodes(self, nodes):
+        u"""Add new nodes without any edges.
+            :param nodes: the nodes list to be added.
+        """
+        self.V.extend(nodes)
+        self.neighbours.add_nodes(nodes)
+        if len(nodes):
+            self.disjoint_set.reserve(max(nodes) + 1)
+            self._changed(nodes)
+            self.connected_nodes.reserve(max(nodes) + 1)
+            if max(nodes) >= len(self.alive):
+                self.alive.extend(bytes(max(nodes) + 1 - len(self.alive)))
+            for v in nodes:
+                self.alive[v] = 1
+            if self.positions is not None:
+                if len(self.alive) > len(self.positions):
+                    grown = np.full((len(self.alive), 2), ForceLayout.missing, dtype=np.int32)
+                    grown[:len(self.positions)] = self.positions
+                    self.positions = grown
+                self.positions[nodes] = ForceLayout.missing
+        if self.visited is not None:
+            for v in nodes:
+                self.visited[v] = 0
+        if self.stats is not None:
+            self.stats.changeDegrees((), np.zeros(len(nodes), dtype=np.int64))
+            self.stats.changeComponents((), np.ones(len(nodes), dtype=np.int64))
+        if self.journal is not None:
+            self.journal.record_many(MutationJournal.ADD_NODE, nodes)
+
+    def hasNode(self, v):
+        u"""Returns True if the node is in the graph and not deleted.
+            :param v: the node.
+        """
+        return 0 <= v < len(self.alive) and self.alive[v] == 1
+
+    def _changed(self, nodes=()):
+        u"""Bump the version of the graph before a change, dropping the
+            cached results scoped to the components of the changed nodes.
+            :param nodes: the nodes whose components change.
+        """
+        self.version += 1
+        self._component_cache = None
+        if self.cache is not None and self.cache.scoped() and len(nodes):
+            nodes = np.asarray(nodes, dtype=np.int64)
+            nodes = nodes[nodes < len(self.disjoint_set)]
+            self.cache.invalidate(set(self.disjoint_set.roots(nodes).tolist()))
+
+    def cacheQueries(self, max_entries=1024, per_component=True):
+        u"""Start keeping the results of repeated queries in a QueryCache,
+            and returns it.
+            :param max_entries: the max number of results kept.
+            :param per_component: keep the results scoped to a component
+            across the changes of the other components.
+        """
+        if self.cache is None:
+            self.cache = QueryCache(max_entries, per_component)
+        return self.cache
+
+    def _memo(self, key, compute, scope=None):
+        u"""Returns the cached result of a query at the current version, else
+            computes and keeps it.
+            :param key: the query and its arguments.
+            :param compute: the function computing the result.
+            :param scope: the component id the result depends on alone.
+        """
+        if self.cache is None:
+            return compute()
+        value = self.cache.get(key, self.version)
+        if value is None:
+            value = compute()
+            self.cache.put(key, self.version, value, scope)
+        return value
+
+    def timePhases(self, observe):
+        u"""Start reporting the seconds taken by the phases of the graph:
+            generating edges, rebuilding components, detaching nodes,
+            searching, exporting and applying records.
+            :param observe: the function called with the phase name and the
+            seconds of every call, or None to stop.
+        """
+        self.observe = observe
+
+    def _componentSizes(self, nodes):
+        u"""Returns the sizes of the components of some nodes, each once.
+            :param nodes: the nodes.
+        """
+        roots = np.unique(self.disjoint_set.roots(np.asarray(nodes, dtype=np.int64)))
+        return np.frombuffer(self.disjoint_set.size, dtype=np.int32)[roots]
+
+    def trackStats(self):
+        u"""Start keeping a GraphStats up to date with the changes, and
+            returns it. It takes one pass over the nodes.
+            :param None
+        """
+        if self.stats is None:
+            self.stats = self._countStats()
+        return self.stats
+
+    def _countStats(self):
+        nodes = np.array(self.V, dtype=np.int64)
+        return GraphStats.of(np.frombuffer(self.connected_nodes.weights, dtype=np.int32)[nodes],
+                             self._componentSizes(nodes))
+
+    def getStats(self):
+        u"""Returns the node, edge and component counts, the largest
+            component size, the histograms of the degrees and of the
+            component sizes and the fitted power-law exponent of the degrees.
+            It takes constant time once trackStats is on, else a pass over
+            the nodes.
+            :param None
+        """
+        stats = self.stats if self.stats is not None else self._countStats()
+        return dict(stats.summary(), edges=len(self.E))
+
+    def _reach(self, start, seen):
+        u"""Returns the nodes reached by a bfs from a start node, skipping
+            and extending the set of nodes already seen.
+            :param start: the node started searching by bfs.
+            :param seen: the set of nodes already seen.
+        """
+        seen.add(start)
+        reached = [start]
+        i = 0
+        while i < len(reached):
+            for n in self.neighbours[reached[i]]:
+                if n not in seen:
+                    seen.add(n)
+                    reached.append(n)
+            i += 1
+        return reached
+
+    @timed('detach')
+    def _detachNodes(self, nodes):
+        u"""Remove nodes and all their edges from an exiting graph, keeping
+            the neighbours, the edge list, the degree sampler and the connected
+            components in sync. Only the components of the removed nodes are
+            searched again: the pieces they split into are found by a bfs
+            from the surviving neighbours and relabelled in the union-find.
+            :param nodes: the nodes to be removed, all in the graph.
+        """
+        if not nodes:
+            return
+        self._changed(nodes)
+        if self.stats is not None:
+            degrees = np.frombuffer(self.connected_nodes.weights, dtype=np.int32)[nodes]
+            sizes = self._componentSizes(nodes)
+        for v in nodes:
+            self.alive[v] = 0
+        seeds = []
+        cut = {}
+        for v in nodes:
+            for n in self.neighbours[v]:
+                if self.E.discard((v, n)) >= 0 and self.journal is not None:
+                    self.journal.record(MutationJournal.DEL_EDGE, v, n)
+                if self.alive[n]:
+                    seeds.append(n)
+                    cut[n] = cut.get(n, 0) + 1
+                    self.neighbours.unlink(n, v)
+            self.neighbours.drop(v)
+        if self.journal is not None:
+            self.journal.record_many(MutationJournal.DEL_NODE, nodes)
+        self.isolated_nodes[:] = [v for v in self.isolated_nodes if self.alive[v]]
+        self.isolated_nodes.extend(n for n in cut if not self.neighbours.degree(n))
+        self.V[:] = [v for v in self.V if self.alive[v]]
+
+        if self.stats is not None:
+            cut_degrees = np.frombuffer(self.connected_nodes.weights, dtype=np.int32)[list(cut)]
+            self.stats.changeDegrees(np.concatenate((degrees, cut_degrees)),
+                                     cut_degrees - np.array(list(cut.values()), dtype=np.int32))
+        for n, count in cut.items():
+            self.connected_nodes.add(n, -count)
+        for v in nodes:
+            self.connected_nodes.discard(v)
+            self.disjoint_set.parent[v] = v
+            self.disjoint_set.size[v] = 1
+        self._relabel(seeds)
+        if self.stats is not None:
+            self.stats.changeComponents(sizes, self._componentSizes(seeds))
+
+    def _relabel(self, seeds):
+        u"""Relabel in the union-find the pieces reached from the seeds, so
+            every piece gets its own root and size. Nodes that are not
+            reached keep their labels.
+            :param seeds: the nodes the bfs starts from.
+        """
+        disjoint_set = self.disjoint_set
+        if self.storage != 'compact':
+            seen = set()
+            for seed in seeds:
+                if seed in seen:
+                    continue
+                piece = self._reach(seed, seen)
+                for v in piece:
+                    disjoint_set.parent[v] = seed
+                disjoint_set.size[seed] = len(piece)
+            return
+
+        # Level by level over the int32 arrays, then label the pieces found
+        if not len(seeds):
+            return
+        seen = np.zeros(len(self.neighbours.degrees), dtype=bool)
+        frontier = np.unique(np.asarray(seeds, dtype=np.int64))
+        seen[frontier] = True
+        reached = [frontier]
+        while frontier.size:
+            _, ahead = self.neighbours.gather(frontier)
+            frontier = np.unique(ahead[~seen[ahead]]).astype(np.int64)
+            seen[frontier] = True
+            reached.append(frontier)
+        nodes = np.concatenate(reached)
+        src, tgt = self.neighbours.gather(nodes)
+        index = np.zeros(len(seen), dtype=np.int64)
+        index[nodes] = np.arange(len(nodes))
+        pieces = scipy.sparse.coo_matrix((np.ones(len(src), dtype=np.int8), (index[src], index[tgt])),
+                                         shape=(len(nodes), len(nodes)))
+        _, label = scipy.sparse.csgraph.connected_components(pieces, directed=False)
+        first = np.full(label.max() + 1, len(nodes), dtype=np.int64)
+        np.minimum.at(first, label, np.arange(len(nodes)))
+        roots = nodes[first]
+        np.frombuffer(disjoint_set.parent, dtype=np.int32)[nodes] = roots[label]
+        np.frombuffer(disjoint_set.size, dtype=np.int32)[roots] = np.bincount(label)
+
+    def _edgeArray(self):
+        u"""Returns the edge list as an (m, 2) numpy array.
+            :param None
+        """
+        return self.E.array()
+
+    def getEdges(self):
+        u"""Returns the edge list as a list, whatever the storage.
+            :param None
+        """
+        return self.E.array().tolist()
+
+    def getColumns(self):
+        u"""Returns the nodes, their degrees and the edge endpoints as int32
+            numpy arrays (V, degrees, src, tgt), built from the array-backed
+            storage without going through Python lists of pairs. Callers
+            get their own dict of the shared arrays.
+            :param None
+        """
+        return dict(self._memo(('getColumns',), self._columns))
+
+    @timed('columns')
+    def _columns(self):
+        nodes = np.array(self.V, dtype=np.int32)
+        edges = self.E.array()
+        return {
+            'V': nodes,
+            'degrees': np.frombuffer(self.connected_nodes.weights, dtype=np.int32)[nodes],
+            'src': np.ascontiguousarray(edges[:, 0]),
+            'tgt': np.ascontiguousarray(edges[:, 1]),
+        }
+
+    @timed('export')
+    def _exportArrays(self):
+        u"""Returns the arrays and the meta values of a GraphSnapshot of the
+            graph. Derived graphs add their own and list them in
+            meta['attributes'].
+            :param None
+        """
+        edges = self.E.array().copy()
+        adjacency = CSRAdjacency.fromEdges(edges, len(self.alive))
+        arrays = {
+            'V': np.array(self.V, dtype=np.int32),
+            'alive': np.frombuffer(self.alive, dtype=np.uint8).copy(),
+            'indptr': adjacency.indptr,
+            'indices': adjacency.indices,
+            'edges': edges,
+            'degrees': np.frombuffer(self.connected_nodes.weights, dtype=np.int32).copy(),
+            'labels': self.disjoint_set.labels(),
+            'isolated': np.array(self.isolated_nodes, dtype=np.int32),
+        }
+        if self.positions is not None:
+            arrays['positions'] = self.positions.copy()
+        meta = {'class': type(self).__name__, 'gamma': self.gamma, 'engine': self.engine,
+                'storage': self.storage, 'source': self.source, 'cursor': self.getCursor(),
+                'log_seq': None if self.log is None else self.log.seq, 'version': self.version,
+                'epoch': self.epoch, 'stats': None if self.stats is None else self.stats.summary(),
+                'attributes': []}
+        return arrays, meta
+
+    def freeze(self):
+        u"""Returns a read-only GraphSnapshot of the graph.
+            :param None
+        """
+        return GraphSnapshot(*self._exportArrays())
+
+    def _loadArrays(self, arrays, meta):
+        u"""Initialize an empty graph from the arrays and meta values of a
+            GraphSnapshot, copying them into the mutable storage.
+            :param arrays: the dict of arrays by name.
+            :param meta: the dict of plain values.
+        """
+        ProbGraph.__init__(self, 0, 0, gamma=meta['gamma'], empty=True, engine=meta['engine'],
+                           storage=meta['storage'])
+        self._addNodes(arrays['V'].tolist())
+        edges = arrays['edges']
+        self._addEdgeArrays(edges[:, 0].astype(np.int32), edges[:, 1].astype(np.int32))
+        self.isolated_nodes = arrays['isolated'].tolist()
+        self.source = meta['source']
+        if 'positions' in arrays:
+            self.positions = np.full((len(self.alive), 2), ForceLayout.missing, dtype=np.int32)
+            self.positions[:len(arrays['positions'])] = arrays['positions']
+        self.version = meta.get('version', self.version)
+        self.epoch = meta.get('epoch', self.epoch)
+        if meta['cursor'] is not None:
+            self.trackMutations()
+            self.journal.base = meta['cursor']
+
+    @classmethod
+    def fromSnapshot(cls, snapshot):
+        u"""Returns a mutable graph rebuilt from a GraphSnapshot.
+            :param snapshot: the snapshot.
+        """
+        graph = cls.__new__(cls)
+        graph._loadArrays(snapshot.arrays, snapshot.meta)
+        return graph
+
+    def save(self, path):
+        u"""Write the graph to a file as a GraphSnapshot: the nodes, edges,
+            CSR adjacency, degrees and component labels and the arrays of
+            derived graphs, each aligned after a versioned header.
+            :param path: the path of the file.
+        """
+        self.freeze().save(path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        u"""Returns the graph saved in a file. With mmap it returns a read-only
+            GraphSnapshot mapping the file, which opens in constant time and
+            reads only the pages its queries touch; pass it to fromSnapshot
+            for a graph that can change. Otherwise it returns a mutable graph.
+            :param path: the path of the file.
+            :param mmap: map the file instead of rebuilding the graph.
+        """
+        snapshot = GraphSnapshot.load(path, mmap)
+        if mmap:
+            return snapshot
+        return cls.fromSnapshot(snapshot)
+
+    def logMutations(self, log):
+        u"""Start writing the changes made through the public methods to a
+            MutationLog, and returns its sequence number.
+            :param log: the MutationLog.
+        """
+        self.log = log
+        return log.seq
+
+    def _logAdded(self, nodes, edge_count, isolated_count):
+        u"""Log the nodes, the edges after edge_count and the isolated nodes
+            after isolated_count added by a call, with the next source node.
+        """
+        if self.log is not None:
+            edges = self.E.array()[edge_count:]
+            self.log.append(MutationLog.ADD, nodes, edges[:, 0], edges[:, 1],
+                            self.isolated_nodes[isolated_count:], [self.source])
+
+    def _applyRecord(self, op, arrays):
+        u"""Apply a record of a MutationLog.
+            :param op: the operation of the record.
+            :param arrays: the int32 arrays of the record.
+        """
+        if op == MutationLog.ADD:
+            nodes, src, tgt, isolated, source = arrays
+            self._addNodes(nodes.tolist())
+            self._addEdgeArrays(src.astype(np.int32), tgt.astype(np.int32))
+            self.isolated_nodes.extend(isolated.tolist())
+            self.source = int(source[0])
+        elif op == MutationLog.DEL_NODES:
+            self._detachNodes(arrays[0].tolist())
+        elif op == MutationLog.SET_POSITIONS:
+            nodes, x, y = arrays
+            self._setPositions(nodes.astype(np.int64), np.stack((x, y), axis=1))
+        else:
+            raise ValueError('unknown log record %d' % op)
+
+    @timed('apply')
+    def applyRecords(self, records):
+        u"""Apply the MutationLog records made by a copy of the graph, in the
+            same state as the graph, and log them.
+            :param records: the list of (op, arrays) records.
+        """
+        for op, arrays in records:
+            self._applyRecord(op, arrays)
+            if self.log is not None:
+                self.log.append(op, *arrays)
+
+    def getTag(self):
+        u"""Returns a tag of the state of the graph: its version and the
+            random epoch of its line of versions, which changes when the
+            graph is rebuilt from a log. Equal tags are the same graph.
+            :param None
+        """
+        return '%s-%d' % (self.epoch, self.version)
+
+    def getCursor(self):
+        u"""Returns the cursor of the mutation journal, or None if mutations
+            are not tracked.
+            :param None
+        """
+        return None if self.journal is None else self.journal.cursor
+
+    def trackMutations(self, limit=1 << 20):
+        u"""Start recording the nodes and edges added or removed in a
+            MutationJournal, and returns its current cursor.
+            :param limit: the max number of records kept.
+        """
+        if self.journal is None:
+            self.journal = MutationJournal(limit)
+        return self.journal.cursor
+
+    def getMutations(self, cursor):
+        u"""Returns the net changes since a journal cursor as numpy arrays
+            (del_V, add_V, del_E, add_E, degrees, moved), or None if the
+            records are not kept any more. Removals are applied first.
+            :param cursor: the cursor seen by the reader.
+        """
+        records = None if self.journal is None else self.journal.since(cursor)
+        if records is None:
+            return None
+        op, src, tgt = records
+        degrees = np.frombuffer(self.connected_nodes.weights, dtype=np.int32)
+
+        def net(keys, ops, add):
+            # the first op says if the reader had it, the last if it is kept
+            if not len(keys):
+                return keys, keys
+            first_keys, first = np.unique(keys, return_index=True)
+            last_keys, last = np.unique(keys[::-1], return_index=True)
+            return first_keys[ops[first] != add], last_keys[ops[::-1][last] == add]
+
+        is_node = op <= MutationJournal.DEL_NODE
+        is_edge = (op == MutationJournal.ADD_EDGE) | (op == MutationJournal.DEL_EDGE)
+        del_nodes, add_nodes = net(src[is_node], op[is_node], MutationJournal.ADD_NODE)
+        edge_src, edge_tgt = src[is_edge], tgt[is_edge]
+        keys = (np.minimum(edge_src, edge_tgt) << 32) | np.maximum(edge_src, edge_tgt)
+        del_keys, add_keys = net(keys, op[is_edge], MutationJournal.ADD_EDGE)
+        del_edges = np.stack((del_keys >> 32, del_keys & 0xffffffff), axis=1)
+        add_edges = np.stack((add_keys >> 32, add_keys & 0xffffffff), axis=1)
+        del_edges = del_edges[~np.isin(del_edges, del_nodes).any(axis=1)]
+        alive = np.frombuffer(self.alive, dtype=np.uint8).astype(bool)
+        touched = np.unique(np.concatenate((edge_src, edge_tgt)))
+        touched = touched[alive[touched] & ~np.isin(touched, add_nodes)]
+        moved = np.unique(src[op == MutationJournal.MOVE_NODE])
+        moved = moved[alive[moved] & ~np.isin(moved, add_nodes)]
+        return {
+            'since': cursor,
+            'cursor': cursor + len(op),
+            'del_V': del_nodes,
+            'add_V': np.stack((add_nodes, degrees[add_nodes]), axis=1),
+            'del_E': del_edges,
+            'add_E': add_edges,
+            'degrees': np.stack((touched, degrees[touched]), axis=1),
+            'moved': moved,
+        }
+
+    def getMemoryUsage(self):
+        u"""Returns a shallow estimate of the bytes held by the nodes,
+            neighbours, edges, connected_nodes, journal and query cache of
+            the graph.
+            :param None
+        """
+        size = sys.getsizeof(self.V) + self.neighbours.nbytes() + self.E.nbytes() + \
+            self.connected_nodes.nbytes()
+        if self.journal is not None:
+            size += self.journal.nbytes()
+        if self.cache is not None:
+            size += self.cache.nbytes()
+        if self.visited is not None:
+            size += sys.getsizeof(self.visited)
+        if self.positions is not None:
+            size += self.positions.nbytes
+        return size
+
     def _dfsearch_recursive(self, node):
         u"""A recursive way using dfs algorithm to search nodes by
             their neighbours to return the connected list.
@@ -212,62 +2627,37 @@ class ProbGraph():
             if self.visited[neighbour] == 0:
                 self._dfsearch(neighbour)
 
-    def _dfs_non_recursive(self, nodes):
-        u"""A None recursive way using dfs algorithm to search neighbours
-            and return a full connected list.
-            :param nodes: the node list that are searched by dfs.
-        """
-        visited = {}
-        for v in nodes:
-            visited[v] = False
-        cluster = []
-        end_of_scan = nodes[0]
-        for v in nodes:
-            if not any(x != True for x in visited.values()) and cluster:
-                cluster.append(end_of_scan)
-                self.connected_components.append(cluster)
-                break
-            if not visited[v]:
-                yield v
-                visited[v] = True
-                stack = [(v, iter(self.neighbours[v]))]
-                if v != end_of_scan and cluster:
-                    cluster.append(end_of_scan)
-                    self.connected_components.append(cluster)
-                    end_of_scan = 0
-                    cluster = []
-                while stack:
-                    _, neighbourlist = stack[-1]
-                    try:
-                        neighbour = next(neighbourlist)
-                        if not visited[neighbour]:
-                            yield neighbour
-                            visited[neighbour] = True
-                            stack.append((neighbour, iter(self.neighbours[neighbour])))
-                            cluster.append(neighbour)
-                    except StopIteration:
-                        end_of_scan = v
-                        stack.pop()
-
+    @timed('components')
     def updateComponents(self):
-        u"""Generate a list of all connected components using a
-            None recursive dfs algorithm from all edges pairs
+        u"""Rebuild the union-find of all connected components from all edges
+            pairs at once. Components are otherwise kept up to date as edges
+            are added.
             :param None
         """
-        self.connected_components = []
-        for x in self._dfs_non_recursive(self.V):
-            #print("visited", x)
-            pass
-
-        ##############################################
-        # Recursive way fails at big data >= 200K nodes
-        ##############################################
-        #for left, right in self.E:
-        #    self.temp_component = []
-        #    if self.visited[left] == 0:
-        #        self._dfsearch(left)
-        #    if len(self.temp_component) > 0:
-        #        self.connected_components.append(self.temp_component)
+        self._changed()
+        if self.cache is not None:
+            self.cache.clear()
+        self.disjoint_set = DisjointSet(len(self.disjoint_set))
+        edges = self._edgeArray()
+        self.disjoint_set.union_many(edges[:, 0], edges[:, 1])
+        if self.stats is not None:
+            self.stats = None
+            self.trackStats()
+
+    @property
+    def connected_components(self):
+        u"""The list of all connected components with more than one node,
+            materialised from the union-find when the graph has changed.
+        """
+        if self._component_cache is None:
+            nodes = np.array(self.V, dtype=np.int64)
+            roots = self.disjoint_set.roots(nodes)
+            order = np.argsort(roots, kind='stable')
+            nodes, roots = nodes[order], roots[order]
+            bounds = np.flatnonzero(np.diff(roots)) + 1
+            self._component_cache = [component.tolist() for component in np.split(nodes, bounds)
+                                     if len(component) > 1]
+        return self._component_cache
 
     def getComponents(self):
         u"""Get a full list of all connected components.
@@ -275,92 +2665,179 @@ class ProbGraph():
         """
         return self.connected_components
 
+    def getComponentId(self, v):
+        u"""Returns the id of the connected component of a node, which is the
+            root of the node in the union-find.
+            :param v: the node.
+        """
+        return self.disjoint_set.find(v)
+
+    def getComponentSize(self, v):
+        u"""Returns the number of nodes in the connected component of a node.
+            :param v: the node.
+        """
+        return self.disjoint_set.size[self.disjoint_set.find(v)]
+
+    def getComponentIds(self, nodes):
+        u"""Returns the component ids of an array of nodes as a numpy array.
+            :param nodes: the nodes.
+        """
+        return self.disjoint_set.roots(np.asarray(nodes, dtype=np.int64)).astype(np.int64)
+
+    def getComponentSizes(self, nodes):
+        u"""Returns the component sizes of an array of nodes as a numpy array.
+            :param nodes: the nodes.
+        """
+        return np.frombuffer(self.disjoint_set.size, dtype=np.int32)[self.getComponentIds(nodes)]
+
+    def trackLayout(self, layout=None):
+        u"""Start keeping the positions of the nodes, laying out the whole
+            graph once, and returns them. The nodes added by addDynamic are
+            then placed next to their neighbours and the others stay where
+            they are.
+            :param layout: the ForceLayout placing the nodes, a default one
+            if None.
+        """
+        if layout is not None:
+            self.layout = layout
+        if self.positions is None:
+            self.positions = np.full((len(self.alive), 2), ForceLayout.missing, dtype=np.int32)
+            self.layoutNodes()
+        return self.positions
+
+    @timed('layout')
+    def layoutNodes(self, nodes=None):
+        u"""Place the nodes without a position and returns them. The others
+            keep theirs. With None every node is laid out again from scratch.
+            :param nodes: the nodes to place if they have no position.
+        """
+        if nodes is None:
+            self.positions[:] = ForceLayout.missing
+            nodes = self.V
+        nodes = np.asarray(nodes, dtype=np.int64)
+        nodes = nodes[self.positions[nodes, 0] == ForceLayout.missing]
+        if self.layout is None:
+            self.layout = ForceLayout()
+        edges = self.E.array()
+        self.layout.place(self.positions, nodes, edges[:, 0], edges[:, 1], self.getComponentIds)
+        self._setPositions(nodes, self.positions[nodes])
+        return nodes
+
+    def _setPositions(self, nodes, positions):
+        u"""Set the (x, y) positions of nodes, which starts keeping them.
+            :param nodes: the nodes.
+            :param positions: their int32 positions.
+        """
+        if self.positions is None:
+            self.positions = np.full((len(self.alive), 2), ForceLayout.missing, dtype=np.int32)
+        if not len(nodes):
+            return
+        self._changed()
+        self.positions[nodes] = positions
+        if self.journal is not None:
+            self.journal.record_many(MutationJournal.MOVE_NODE, nodes)
+        if self.log is not None:
+            self.log.append(MutationLog.SET_POSITIONS, nodes, positions[:, 0], positions[:, 1])
+
+    def getPositions(self, nodes):
+        u"""Returns the int32 (x, y) positions of an array of nodes, or None
+            if they are not kept. See trackLayout.
+            :param nodes: the nodes.
+        """
+        if self.positions is None:
+            return None
+        return self.positions[np.asarray(nodes, dtype=np.int64)]
+
     def addDynamic(self, node_num, edge_num):
         u"""Add new nodes list to an exiting graph in a dynamic way
             :param node_num: the number of newly added nodes.
             :param edge_num: the max number of newly added edges.
         """
         nodes = list(range(self.V[-1] + 1, self.V[-1] + 1 + node_num))
-        for v in nodes:
-            self.V.append(v)
-            self.neighbours[v] = []
-        for v in self.V:
-            self.visited[v] = 0
+        edge_count, isolated_count = len(self.E), len(self.isolated_nodes)
+        self._addNodes(nodes)
         self._createEdges(len(self.E) + edge_num)
-        self.updateComponents()
+        self._logAdded(nodes, edge_count, isolated_count)
+        if self.positions is not None:
+            self.layoutNodes(nodes)
 
     def addNodesFrom(self, nodes):
         u"""Add nodes from scrach to create graph from a node list.
             :param nodes: the nodes list to be created in the graph
         """
-        for v in nodes:
-            self.V.append(v)
-            self.neighbours[v] = []
-            self.visited[v] = 0
+        nodes = list(nodes)
+        self._addNodes(nodes)
+        self._logAdded(nodes, len(self.E), len(self.isolated_nodes))
 
     def addEdgesFrom(self, edges):
         u"""Add edges from scrach to create graph from an edge list.
             :param edges: the edges list to be created in the graph
         """
+        edge_count = len(self.E)
         for pair in edges:
-            if pair[0] != pair[1]:
-                self.neighbours.get(pair[0]).append(pair[1])
-                self.neighbours.get(pair[1]).append(pair[0])
-                self.E.append(pair)
-            self.connected_nodes.append(pair[0])
-            self.connected_nodes.append(pair[1])
+            if pair[0] != pair[1] and pair not in self.E:
+                self._link(pair)
+        self._logAdded([], edge_count, len(self.isolated_nodes))
 
     def delNodesFrom(self, nodes):
         u"""Delete nodes from an exiting graph in a dynamic way.
             :param nodes: the nodes list to be deleted from the graph
         """
-        for v in [value for value in nodes if value in self.V]:
-            self.V.remove(v)
-            self.connected_nodes[:] = (value for value in self.connected_nodes if value != v)
-            self.isolated_nodes[:] = (value for value in self.isolated_nodes if value != v)
-            for n in self.neighbours[v]:
-                self.connected_nodes.remove(n)
-                self.neighbours[n].remove(v)
-                if not self.neighbours[n]:
-                    self.isolated_nodes.append(n)
-                if (n, v) in self.E:
-                    self.E.remove((n, v))
-                else:
-                    self.E.remove((v, n))
-                self.neighbours[v] = []
-        sorted_components = sorted(self.connected_components, key=len, reverse=True)
-        p = set(nodes)
-        for i, component in enumerate(sorted_components):
-            s = set(component)
-            if len(tuple(s & p)) > 0:
-                self.connected_components.remove(component)
-                component[:] = (value for value in component if value not in list(tuple(s & p)))
-                if len(component) <= 1:
-                    continue
-                for x in self._dfs_non_recursive(component):
-                    #print("visited", x)
-                    pass
-                p -= s
-                if len(tuple(p)) == 0:
-                    break
+        nodes = [v for v in dict.fromkeys(nodes) if self.hasNode(v)]
+        self._detachNodes(nodes)
+        if self.log is not None:
+            self.log.append(MutationLog.DEL_NODES, nodes)
 
     def bfsearch(self, start_node):
         u"""A bfs algorithm to search all connected components from
-            a start node. It returns all the visited noces and the edge
-            degree.
+            a start node. It returns all the visited noces with the edge
+            degree and the number of hops from the start node, searched
+            level by level. The result is cached for the component of the
+            start node and returned as a read-only mapping.
             :param start_node: the node started searching by bfs.
         """
-        queue = deque([start_node])
-        visited_node = {}
+        scope = self.disjoint_set.find(start_node) if self.hasNode(start_node) else None
+        return self._memo(('bfsearch', start_node), lambda: MappingProxyType(self._bfsearch(start_node)), scope)
+
+    @timed('bfsearch')
+    def _bfsearch(self, start_node):
+        visited_node = {start_node: [len(self.neighbours[start_node]), 0]}
+        frontier = [start_node]
         hop_away = 0
-        while len(queue) != 0:
-            label = queue.popleft()
-            if label not in visited_node:
-                visited_node[label] = [len(self.neighbours[label]), hop_away]
-                queue += [x for x in self.neighbours[label] if x not in visited_node.keys()]
-                hop_away += 1
+        while frontier:
+            hop_away += 1
+            following = []
+            for label in frontier:
+                for x in self.neighbours[label]:
+                    if x not in visited_node:
+                        visited_node[x] = [len(self.neighbours[x]), hop_away]
+                        following.append(x)
+            frontier = following
         return visited_node
 
+    def getDistances(self, sources, max_depth=None, batch=False):
+        u"""Returns the hops from the sources to every node id, -1 if not
+            reached, over a CSR copy of the edges, as a read-only array
+            that is cached. See CSRAdjacency.distances.
+            :param sources: the nodes at 0 hops.
+            :param max_depth: the max hops searched, None for no limit.
+            :param batch: answer one search per source.
+        """
+        def compute():
+            adjacency = CSRAdjacency.fromEdges(self.E.array(), len(self.alive))
+            hops = adjacency.distances(sources, max_depth, batch)
+            hops.setflags(write=False)
+            return hops
+        return self._memo(('getDistances', tuple(sources), max_depth, batch), compute)
+
+    def getLevelOfDetail(self, budget, small=16):
+        u"""Returns the LevelOfDetail of the graph in at most budget nodes,
+            cached until the graph changes.
+            :param budget: the max number of nodes and super-nodes shown.
+            :param small: the size up to which components are collapsed.
+        """
+        return self._memo(('getLevelOfDetail', budget, small), lambda: LevelOfDetail.of(self, budget, small))
+
 if __name__ == '__main__':
 
     from datetime import datetime
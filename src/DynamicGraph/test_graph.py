@@ -30,8 +30,15 @@ from datetime import datetime
 import matplotlib.pyplot as plt
 import random
 import copy
+import os
+import sys
+import tempfile
+
+import numpy as np
 
 import DynamicGraph as DG
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from src.PoisonGrapn import PoisonGraph, SpreadSimulator, scoreRemovals
 
 class TestGeneralReturns(TestCase):
     def __init__(self, node_num, edge_num, L, K):
@@ -84,6 +91,151 @@ class TestGeneralReturns(TestCase):
         self.assertEqual(len(self.graph.connected_nodes), sum(edge_degrees),
                          "The graph after nodes deleted is not correct")
 
+    def test_seededGraph(self):
+        ##########################################################
+        # Test graphs built after the same seeds have the same
+        # edges, whatever graphs were built before them
+        ##########################################################
+        for engine in ('python', 'numpy'):
+            edges = []
+            for _ in range(2):
+                random.seed(0)
+                np.random.seed(0)
+                graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num, engine=engine)
+                graph.addDynamic(self.L, self.K)
+                edges.append(sorted(map(tuple, graph.E.array().tolist())))
+            self.assertEqual(edges[0], edges[1], "The graphs of the same seeds are not the same")
+
+    def test_bulkEngine(self):
+        ##########################################################
+        # Test the vectorized engine creates a graph with correct
+        # nodes and edges, without repeated edges or self loops
+        ##########################################################
+        graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num, engine='numpy')
+        self.assertEqual(len(graph.V), self.node_num,
+                        "The number of nodes generated is not correct")
+        self.assertTrue(len(graph.E) < self.edge_num,
+                        "The number of edges generated is not correct")
+        self.assertEqual(len(set(tuple(sorted(pair)) for pair in graph.E)), len(graph.E),
+                         "The graph has repeated edges")
+        self.assertTrue(all(pair[0] != pair[1] for pair in graph.E),
+                        "The graph has self loops")
+        self.assertEqual(len(graph.connected_nodes), 2 * len(graph.E),
+                         "The graph generated by the vectorized engine is not correct")
+
+    def test_compactStorage(self):
+        ##########################################################
+        # Test the compact storage keeps neighbours, edges and
+        # connected nodes in sync after nodes added and deleted
+        ##########################################################
+        graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num,
+                             engine='numpy', storage='compact')
+        graph.addDynamic(self.L, self.K)
+        graph.delNodesFrom(random.sample(graph.V, int(len(graph.V) * 0.1)))
+        edge_degrees = dict((v, 0) for v in graph.V)
+        for left, right in graph.E:
+            self.assertTrue(right in graph.neighbours[left] and left in graph.neighbours[right],
+                            "The neighbours of the compact storage are not correct")
+            edge_degrees[left] += 1
+            edge_degrees[right] += 1
+        for v in graph.V:
+            self.assertEqual(len(graph.neighbours[v]), edge_degrees[v],
+                             "The edge degrees of the compact storage are not correct")
+        self.assertEqual(len(graph.connected_nodes), sum(edge_degrees.values()),
+                         "The graph in compact storage is not correct")
+
+    def test_edgeSet(self):
+        ##########################################################
+        # Test repeated edges are suppressed and removed edges are
+        # gone from the edge set of the graph
+        ##########################################################
+        edges = list(self.graph.E)
+        left, right = edges[0]
+        before = len(self.graph.E)
+        self.graph.addEdgesFrom([(right, left), (left, right)])
+        self.assertEqual(len(self.graph.E), before, "The graph has repeated edges")
+        self.assertTrue((right, left) in self.graph.E, "The edge set misses an edge")
+        self.graph.delNodesFrom([left])
+        self.assertFalse((left, right) in self.graph.E, "The edge set keeps a deleted edge")
+        self.assertEqual(len(set(tuple(sorted(pair)) for pair in self.graph.E)), len(self.graph.E),
+                         "The graph has repeated edges")
+
+    def test_degreeSampler(self):
+        ##########################################################
+        # Test the weights of the preferential attachment follow
+        # the edge degrees of nodes after nodes deleted
+        ##########################################################
+        graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num)
+        graph.delNodesFrom(random.sample(graph.V, int(len(graph.V) * 0.1)))
+        for v in graph.V:
+            self.assertEqual(graph.connected_nodes.degree(v), len(graph.neighbours[v]),
+                             "The weights of the degree sampler are not correct")
+        for _ in range(100):
+            self.assertTrue(len(graph.neighbours[graph.connected_nodes.draw()]) > 0,
+                            "The degree sampler draws a node without edges")
+
+    def test_mutationJournal(self):
+        ##########################################################
+        # Test the net changes since a cursor rebuild the graph
+        # from the graph seen at the cursor
+        ##########################################################
+        graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num)
+        cursor = graph.trackMutations()
+        nodes = set(graph.V)
+        edges = set(tuple(sorted(pair)) for pair in graph.E)
+        graph.addDynamic(self.L, self.K)
+        graph.delNodesFrom(random.sample(graph.V, int(len(graph.V) * 0.1)))
+        changes = graph.getMutations(cursor)
+        nodes -= set(changes['del_V'].tolist())
+        edges = set(pair for pair in edges if nodes.issuperset(pair))
+        edges -= set(map(tuple, changes['del_E'].tolist()))
+        nodes |= set(changes['add_V'][:, 0].tolist())
+        edges |= set(map(tuple, changes['add_E'].tolist()))
+        self.assertEqual(nodes, set(graph.V), "The node changes of the journal are not correct")
+        self.assertEqual(edges, set(tuple(sorted(pair)) for pair in graph.E),
+                         "The edge changes of the journal are not correct")
+        self.assertEqual(changes['cursor'], graph.journal.cursor, "The journal cursor is not correct")
+
+    def test_saveLoad(self):
+        ##########################################################
+        # Test a saved graph opens mapped with the same nodes and
+        # components and loads back into a graph that can change
+        ##########################################################
+        path = os.path.join(tempfile.mkdtemp(), 'graph.snap')
+        self.graph.save(path)
+        snapshot = DG.ProbGraph.load(path)
+        self.assertEqual(snapshot.V.tolist(), self.graph.V, "The mapped nodes are not correct")
+        self.assertEqual(sorted(map(sorted, snapshot.getComponents())),
+                         sorted(map(sorted, self.graph.getComponents())),
+                         "The mapped components are not correct")
+        graph = DG.ProbGraph.load(path, mmap=False)
+        self.assertEqual(set(tuple(sorted(pair)) for pair in graph.E),
+                         set(tuple(sorted(pair)) for pair in self.graph.E),
+                         "The loaded edges are not correct")
+        graph.addDynamic(self.L, self.K)
+        os.remove(path)
+
+    def test_mutationLog(self):
+        ##########################################################
+        # Test a graph rebuilt from its base snapshot and its
+        # mutation log is the same graph
+        ##########################################################
+        graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num)
+        log = DG.MutationLog(os.path.join(tempfile.mkdtemp(), 'graph.log'))
+        graph.logMutations(log)
+        log.compact(graph)
+        graph.addDynamic(self.L, self.K)
+        graph.delNodesFrom(random.sample(graph.V, int(len(graph.V) * 0.1)))
+        graph.addDynamic(self.L, self.K)
+        log.close()
+        restored = DG.MutationLog(log.path).restore(DG.ProbGraph)
+        self.assertEqual(restored.V, graph.V, "The replayed nodes are not correct")
+        self.assertEqual(set(tuple(sorted(pair)) for pair in restored.E),
+                         set(tuple(sorted(pair)) for pair in graph.E),
+                         "The replayed edges are not correct")
+        self.assertEqual(restored.log.seq, 3, "The sequence number of the log is not correct")
+        restored.log.discard()
+
     def test_bfsSearch(self, doValidation=False):
         ##########################################################
         # Test a none recursive breadth first search algorithm
@@ -100,6 +252,266 @@ class TestGeneralReturns(TestCase):
                     print("The bfs returns the same result as it does from connected component", v)
                     break
 
+    def test_Components(self):
+        ##########################################################
+        # Test the connected components kept by the union-find
+        # are the nodes reached by a bfs from any of their nodes
+        ##########################################################
+        for component in self.graph.getComponents():
+            self.assertEqual(set(self.graph.bfsearch(component[0])), set(component),
+                             "The connected component is not correct")
+            self.assertEqual(self.graph.getComponentSize(component[-1]), len(component),
+                             "The size of the connected component is not correct")
+
+    def test_distances(self):
+        ##########################################################
+        # Test the level synchronous bfs: the hops of one source
+        # match bfsearch, several sources take the nearest one,
+        # max_depth stops the search and a batch answers every
+        # source on its own
+        ##########################################################
+        component = max(self.graph.getComponents(), key=len)
+        sources = random.sample(component, min(3, len(component)))
+        single = [self.graph.getDistances([v]) for v in sources]
+        visited = self.graph.bfsearch(sources[0])
+        self.assertEqual(dict((v, int(single[0][v])) for v in visited),
+                         dict((v, hops) for v, (_, hops) in visited.items()),
+                         "The hops of the bfs are not correct")
+        self.assertEqual(set(int(v) for v in (single[0] >= 0).nonzero()[0]), set(component),
+                         "The nodes reached by the bfs are not correct")
+        for v in component[:50]:
+            for u in self.graph.neighbours[v]:
+                self.assertLessEqual(abs(int(single[0][v]) - int(single[0][u])), 1,
+                                     "The hops of two neighbours differ by more than one")
+        nearest = self.graph.getDistances(sources)
+        self.assertTrue((nearest == np.min(single, axis=0)).all(),
+                        "The hops from several sources are not the nearest ones")
+        limited = self.graph.getDistances(sources, max_depth=1)
+        self.assertTrue((limited == np.where(nearest <= 1, nearest, -1)).all(),
+                        "The max depth of the bfs is not correct")
+        batch = self.graph.getDistances(sources, batch=True)
+        self.assertEqual(batch.shape, (len(sources), len(single[0])), "The shape of the batch is not correct")
+        self.assertTrue((batch == np.array(single)).all(), "The hops of the batch are not correct")
+        snapshot = self.graph.freeze()
+        self.assertTrue((snapshot.getDistances(sources, batch=True) == batch).all(),
+                        "The hops of the snapshot are not correct")
+
+    def test_queryCache(self):
+        ##########################################################
+        # Test the version counter and the query cache: repeated
+        # queries hit until the graph changes, a change in one
+        # component keeps the results of the others and the least
+        # recently used results are evicted
+        ##########################################################
+        for storage in ('dict', 'compact'):
+            graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num, storage=storage)
+            cache = graph.cacheQueries(max_entries=3)
+            version = graph.version
+            first, second = sorted(graph.getComponents(), key=len)[-2:]
+            visited = graph.bfsearch(first[0])
+            self.assertIs(graph.bfsearch(first[0]), visited, "The bfs is not cached")
+            with self.assertRaises(TypeError, msg="The cached bfs can be changed"):
+                visited[first[0]] = None
+            graph.bfsearch(second[0])
+            self.assertEqual((cache.hits, cache.misses), (1, 2), "The cache counters are not correct")
+
+            graph.delNodesFrom([second[-1]])
+            self.assertGreater(graph.version, version, "The version is not bumped by a change")
+            self.assertIs(graph.bfsearch(first[0]), visited, "A change elsewhere flushed the bfs")
+            self.assertNotIn(second[-1], graph.bfsearch(second[0]), "The changed component is still cached")
+            self.assertEqual(graph.bfsearch(second[0]), graph._bfsearch(second[0]),
+                             "The bfs of the changed component is not correct")
+
+            columns = graph.getColumns()
+            self.assertIs(graph.getColumns()['V'], columns['V'], "The columns are not cached")
+            graph.addDynamic(self.L, self.K)
+            self.assertEqual(len(graph.getColumns()['V']), len(graph.V), "The columns are not up to date")
+            for v in graph.V[:5]:
+                graph.bfsearch(v)
+            self.assertGreater(cache.evictions, 0, "The cache is not bounded")
+            self.assertLessEqual(len(cache), 3, "The cache is over its bound")
+
+    def test_graphTag(self):
+        ##########################################################
+        # Test the tag of the graph state: kept by a snapshot and
+        # a graph rebuilt from it, changed by any change and by a
+        # rebuild from the log
+        ##########################################################
+        graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num, engine='numpy')
+        tag = graph.getTag()
+        snapshot = graph.freeze()
+        self.assertEqual(snapshot.getTag(), tag, "The snapshot tag is not the graph tag")
+        self.assertEqual(DG.ProbGraph.fromSnapshot(snapshot).getTag(), tag, "The rebuilt graph tag is not kept")
+        graph.delNodesFrom(graph.V[:1])
+        self.assertNotEqual(graph.getTag(), tag, "The tag is not changed by a change")
+        path = os.path.join(tempfile.mkdtemp(), 'graph.log')
+        log = DG.MutationLog(path)
+        log.compact(graph)
+        restored = log.restore(DG.ProbGraph)
+        self.assertNotEqual(restored.getTag(), graph.getTag(), "The tag is kept by a rebuild from the log")
+        log.discard()
+
+    def test_graphStats(self):
+        ##########################################################
+        # Test the statistics kept up to date by the changes are
+        # the ones counted again from the whole graph
+        ##########################################################
+        for storage in ('dict', 'compact'):
+            graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num, storage=storage)
+            graph.trackStats()
+            graph.addDynamic(self.L, self.K)
+            graph.delNodesFrom(random.sample(graph.V, self.L))
+            graph.addEdgesFrom([tuple(random.sample(graph.V, 2)) for _ in range(10)])
+            stats = graph.getStats()
+            counted = dict(graph._countStats().summary(), edges=len(graph.E))
+            self.assertAlmostEqual(stats.pop('power_law_exponent'), counted.pop('power_law_exponent'),
+                                   msg="The power-law exponent is not correct")
+            self.assertEqual(stats, counted, "The kept statistics are not correct")
+            self.assertEqual(stats['nodes'], len(graph.V), "The node count is not correct")
+            self.assertEqual(stats['largest_component'], max(len(c) for c in graph.getComponents()),
+                             "The largest component size is not correct")
+            self.assertEqual(graph.freeze().getStats()['degree_histogram'], stats['degree_histogram'],
+                             "The snapshot statistics are not correct")
+
+    def test_timePhases(self):
+        ##########################################################
+        # Test the phases of a graph are reported while it has an
+        # observe function, and no longer once it is removed
+        ##########################################################
+        graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num)
+        phases = []
+        graph.timePhases(lambda phase, seconds: phases.append((phase, seconds)))
+        graph.addDynamic(self.L, self.K)
+        graph.updateComponents()
+        graph.delNodesFrom(random.sample(graph.V, self.L))
+        self.assertEqual([phase for phase, _ in phases], ['generate', 'components', 'detach'],
+                         "The phases reported are not correct")
+        self.assertTrue(all(seconds >= 0 for _, seconds in phases), "The seconds are not correct")
+        graph.timePhases(None)
+        graph.addDynamic(self.L, self.K)
+        self.assertEqual(len(phases), 3, "The phases are reported without an observe function")
+
+    def test_levelOfDetail(self):
+        ##########################################################
+        # Test the view of a graph over the budget holds every
+        # node and edge once, in nodes and super-nodes, and that
+        # expanding the super-nodes gives back all of its nodes
+        ##########################################################
+        graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num, storage='compact')
+        budget = self.node_num // 4
+        for lod in (graph.getLevelOfDetail(budget), graph.freeze().getLevelOfDetail(budget)):
+            view = lod.view()
+            self.assertTrue(len(view['V']) + len(view['super']) <= budget, "The view is over the budget")
+            self.assertEqual(len(view['V']) + view['super_nodes'].sum(), len(graph.V),
+                             "The nodes of the view are not correct")
+            self.assertEqual(view['weight'].sum() + view['super_edges'].sum(), len(graph.E),
+                             "The edges of the view are not correct")
+            shown = set(view['V'].tolist())
+            for super_id in view['super'].tolist():
+                offset = 0
+                while offset is not None:
+                    page, offset = lod.expand(super_id, offset, budget // 2)
+                    self.assertFalse(shown & set(page['V'].tolist()), "A node is expanded twice")
+                    shown.update(page['V'].tolist())
+            self.assertEqual(shown, set(graph.V), "The expanded nodes are not correct")
+        view = graph.getLevelOfDetail(len(graph.V)).view()
+        self.assertEqual((len(view['V']), len(view['super'])), (len(graph.V), 0),
+                         "A graph within the budget is collapsed")
+
+    def test_layout(self):
+        ##########################################################
+        # Test every node of a graph laid out gets a position,
+        # that added nodes are placed without moving the others
+        # and that the positions come back from the log records
+        ##########################################################
+        graph = DG.ProbGraph(node_num=self.node_num, edge_num=self.edge_num, storage='compact')
+        nodes = list(graph.V)
+        positions = graph.trackLayout(DG.ForceLayout(seed=0))[nodes].copy()
+        self.assertFalse((positions == DG.ForceLayout.missing).any(), "A node is not placed")
+        log = DG.MutationLog(os.path.join(tempfile.mkdtemp(), 'graph.log'))
+        graph.logMutations(log)
+        log.compact(graph)
+        cursor = graph.trackMutations()
+        graph.addDynamic(self.L, self.K)
+        log.close()
+        self.assertTrue((graph.getPositions(nodes) == positions).all(), "The nodes placed before are moved")
+        self.assertEqual(len(graph.getMutations(cursor)['moved']), 0, "The nodes placed before are moved")
+        self.assertFalse((graph.getPositions(graph.V) == DG.ForceLayout.missing).any(), "A new node is not placed")
+        restored = DG.MutationLog(log.path).restore(DG.ProbGraph)
+        self.assertTrue((restored.getPositions(graph.V) == graph.getPositions(graph.V)).all(),
+                        "The positions of the log are not correct")
+        restored.log.discard()
+
+    def _infected(self, graph, poison):
+        # The nodes of the components of the poison nodes, by bfs
+        reached = set()
+        for v in poison:
+            if v not in reached:
+                reached.update(graph.bfsearch(v))
+        return len(reached)
+
+    def test_scanPoison(self):
+        ##########################################################
+        # Test the counts of a scan against a bfs from the poison
+        # nodes, and that the Principals are the poison nodes
+        # saving the most nodes when removed, by a recount
+        # without every one of them
+        ##########################################################
+        graph = PoisonGraph(node_num=self.node_num, edge_num=self.edge_num, engine='numpy')
+        graph.addPoison(self.node_num // 20)
+        self.assertEqual(len(set(graph.InitialPoison)), self.node_num // 20, "A node is poisoned twice")
+        k = self.node_num // 200
+        infected, saved = graph.scanPoison(k)
+        poison = list(graph.InitialPoison)
+        self.assertEqual(infected, self._infected(graph, poison), "The infected count is not correct")
+        saves = dict((v, infected - self._infected(graph, [x for x in poison if x != v])) for v in poison)
+        ranked = sorted(poison, key=lambda v: (-saves[v], v))[:k]
+        self.assertEqual(graph.Principals, ranked, "The Principals are not correct")
+        self.assertEqual(saved, infected - self._infected(graph, set(poison) - set(ranked)),
+                         "The saved count is not correct")
+
+    def test_scoreRemovals(self):
+        ##########################################################
+        # Test the infected counts of removal sets of a graph and
+        # of its snapshot against a bfs from the poison nodes left,
+        # and that nodes not poisoned save nothing
+        ##########################################################
+        graph = PoisonGraph(node_num=self.node_num, edge_num=self.edge_num, engine='numpy')
+        graph.addPoison(self.node_num // 20)
+        poison = list(graph.InitialPoison)
+        healthy = random.choice([v for v in graph.V if v not in poison])
+        sets = [[], [healthy]] + [random.sample(poison, k) for k in (1, 2, 5, len(poison) // 2, len(poison))]
+        sets.append(sets[-2] + [healthy])
+        expected = [self._infected(graph, set(poison) - set(nodes)) for nodes in sets]
+        for infected in (scoreRemovals(graph, sets), scoreRemovals(graph.freeze(), sets),
+                         graph.evaluateRemovals(sets)):
+            self.assertEqual(infected.tolist(), expected, "The infected counts are not correct")
+        self.assertEqual(expected[1], expected[0], "A node not poisoned saves nodes")
+        self.assertEqual(graph.InitialPoison, poison, "The poison nodes are changed")
+
+    def test_spreadSimulator(self):
+        ##########################################################
+        # Test the infected counts of SI never go down and end on
+        # the components of the poison nodes, that SIR ends with
+        # no infected node and that a seed gives the same runs
+        ##########################################################
+        graph = PoisonGraph(node_num=self.node_num, edge_num=self.edge_num, engine='numpy')
+        graph.addPoison(self.node_num // 100)
+        reached = self._infected(graph, graph.InitialPoison)
+        steps = list(SpreadSimulator.fromGraph(graph, model='SI', beta=0.3, runs=4, seed=0).run(self.node_num))
+        infected = np.array([step['infected'] for step in steps])
+        self.assertTrue((np.diff(infected, axis=0) >= 0).all(), "The infected count of SI goes down")
+        self.assertTrue((infected[-1] == reached).all(), "SI does not infect the components of the poison nodes")
+        runs = [list(SpreadSimulator.fromGraph(graph, model='SIR', beta=0.3, gamma=0.2, runs=4, seed=1)
+                     .run(self.node_num)) for _ in range(2)]
+        self.assertTrue((runs[0][-1]['infected'] == 0).all(), "SIR ends with infected nodes")
+        self.assertTrue((runs[0][-1]['recovered'] <= reached).all(), "SIR recovers nodes out of reach")
+        self.assertEqual(len(runs[0]), len(runs[1]), "The runs of a seed are not the same")
+        for first, second in zip(*runs):
+            for key in first:
+                self.assertTrue(np.array_equal(first[key], second[key]), "The runs of a seed are not the same")
+        self.assertRaises(ValueError, SpreadSimulator.fromGraph, graph, model='SEIR')
+
     def test_addDynamic(self):
         ##########################################################
         # Test to add nodes dynamically to an existing graph.
@@ -203,15 +615,42 @@ if __name__ == '__main__':
     testRun = TestGeneralReturns(node_num=2000, edge_num=20000, L=500, K=5000)
     print("Time used to generate the graph from scratch ", datetime.now() - start)
 
+    ## 0, Generate with the vectorized engine
+    start = datetime.now()
+    testRun.test_seededGraph()
+    testRun.test_bulkEngine()
+    print("Time used to generate the graph with the vectorized engine ", datetime.now() - start)
+    start = datetime.now()
+    testRun.test_compactStorage()
+    testRun.test_edgeSet()
+    testRun.test_degreeSampler()
+    testRun.test_mutationJournal()
+    testRun.test_saveLoad()
+    testRun.test_mutationLog()
+    print("Time used to generate the graph in compact storage ", datetime.now() - start)
+
     ## 1, Add nodes
     start = datetime.now()
     testRun.test_addDynamic()
     print("Time used to add new nodes dynamically ", datetime.now() - start)
 
+    testRun.test_Components()
+    testRun.test_distances()
+    testRun.test_queryCache()
+    testRun.test_graphTag()
+    testRun.test_graphStats()
+    testRun.test_timePhases()
+    testRun.test_levelOfDetail()
+    testRun.test_layout()
+    testRun.test_scanPoison()
+    testRun.test_scoreRemovals()
+    testRun.test_spreadSimulator()
+
     ## 2, Del nodes
     start = datetime.now()
     testRun.test_delDynamic()
     print("Time used to delete nodes dynamically ", datetime.now() - start)
+    testRun.test_Components()
 
     ## 3, Add nodes
     start = datetime.now()
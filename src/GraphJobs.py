@@ -0,0 +1,356 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import numpy as np
+
+from src.DynamicGraph.DynamicGraph import GraphSnapshot
+from src.PoisonGrapn import PoisonGraph, SpreadSimulator
+from src.SharedGraph import SharedGraphStore
+
+
+class GraphBusy(Exception):
+    u"""Raised when a job is started on a graph that already has one."""
+
+
+class RecordBuffer():
+    u"""Returns a stand-in for the MutationLog of a graph copy in a job. It
+        keeps the records in memory until they are taken and sent back.
+    """
+    def __init__(self):
+        self.seq = 0
+        self.records = []
+
+    def append(self, op, *arrays):
+        self.seq += 1
+        self.records.append((op, [np.array(a, dtype=np.int32) for a in arrays]))
+        return self.seq
+
+    def take(self):
+        records, self.records = self.records, []
+        return records
+
+
+def _grow(graph, node_number, x, reset=False, cancel=None, chunk=10000):
+    u"""Steps of new_graph and add_nodes: grow the graph to node_number new
+        nodes by tenths, from x nodes already added. A tenth is added chunk
+        nodes at a time and ends early once the cancel event is set."""
+    if reset:
+        graph.resetPoison('InitialPoison', 'infected_nodes')
+    if x >= node_number:
+        yield x
+    interval = max(int(node_number * 0.1), 1)
+    while x < node_number:
+        end = min(x + interval, node_number)
+        while x < end:
+            added = min(chunk, end - x)
+            graph.addDynamic(added, added * 10)
+            x += added
+            if cancel is not None and cancel.is_set():
+                break
+        yield x
+
+
+def _poison(graph, node_number, x, reset=False):
+    u"""Steps of add_poison: mark up to node_number poison nodes by tenths."""
+    if reset:
+        graph.resetPoison('InitialPoison', 'infected_nodes')
+    if x >= node_number:
+        yield x
+    interval = max(int(node_number * 0.1), 1)
+    while x < node_number:
+        if x + interval >= node_number:
+            interval = node_number - x
+        if len(graph.InitialPoison) < node_number:
+            graph.addPoison(interval)
+        x += interval
+        yield x
+
+
+def _scan(graph, node_number):
+    yield graph.scanPoison(node_number)
+
+
+def _delete(graph):
+    u"""Delete the Principals and their infected components if a scan found
+        them, else a random sample of nodes."""
+    if graph.Principals:
+        graph.delPoisonFrom(graph.Principals)
+        graph.resetPoison('Principals')
+    else:
+        graph.delNodesFrom(random.sample(graph.V, random.randint(1, len(graph.V))))
+    yield len(graph.V)
+
+
+def _simulate(snapshot, steps, trace=True, **kwargs):
+    u"""Steps of simulate: the counts of a batch of runs of an epidemic."""
+    return SpreadSimulator.fromGraph(snapshot, **kwargs).run(steps, trace)
+
+
+def _layout(graph):
+    u"""Lay the graph out again from scratch."""
+    if graph.positions is None:
+        graph.trackLayout()
+    else:
+        graph.layoutNodes()
+    yield len(graph.V)
+
+
+def _ready():
+    pass
+
+
+# The shared snapshots attached by this pool process
+_shared = None
+
+
+def _openSnapshot(source):
+    u"""Returns the GraphSnapshot of a ('shared', graph id) or ('file', path)
+        source, mapped without copying it."""
+    global _shared
+    kind, name = source
+    if kind == 'shared':
+        if _shared is None:
+            _shared = SharedGraphStore()
+        snapshot = _shared.attach(name)
+        if snapshot is None:
+            raise KeyError(name)
+        return snapshot
+    return GraphSnapshot.load(name)
+
+
+job_kinds = {'new_graph': _grow, 'add_nodes': _grow, 'add_poison': _poison, 'scan': _scan,
+             'delete': _delete, 'layout': _layout}
+# Jobs reading a graph without changing it: they get the source of a
+# snapshot instead of its arrays and do not keep the graph busy
+read_kinds = {'simulate': _simulate}
+
+
+def runJob(kind, state, params, progress, cancel, timed=False):
+    u"""Run a job in a pool process and put its messages on the progress
+        queue: ('graph', (arrays, meta), []) for a new graph, ('step', value,
+        records) after every step, then ('done', None, []) or ('cancelled',
+        None, []) once the cancel event is set. A timed job also puts
+        ('phases', {phase: [seconds, ...]}, []) before them with the phases
+        of the graph since the last message.
+        :param kind: 'create' or a key of job_kinds or read_kinds.
+        :param state: the (arrays, meta) of the graph, None to create one, or
+        the snapshot source of a read job.
+        :param params: the keyword arguments of the steps, or the node_num
+        of a new graph and whether to lay it out (layout).
+        :param progress: the queue of the messages.
+        :param cancel: the event set to stop the job between two steps.
+        :param timed: report the phases of the graph.
+    """
+    phases = {}
+
+    def observe(phase, seconds):
+        phases.setdefault(phase, []).append(seconds)
+
+    def put(message):
+        if phases:
+            progress.put(('phases', dict(phases), []))
+            phases.clear()
+        progress.put(message)
+
+    if kind == 'create':
+        # The graph is made a chunk of nodes at a time, so it can be cancelled
+        start = time.perf_counter()
+        node_num = params['node_num']
+        chunk = min(node_num, 10000)
+        graph = PoisonGraph(node_num=chunk, edge_num=chunk * 10, engine='numpy', storage='compact')
+        for _ in _grow(graph, node_num, chunk, cancel=cancel, chunk=chunk):
+            if cancel.is_set():
+                progress.put(('cancelled', None, []))
+                return
+        if timed:
+            observe('create', time.perf_counter() - start)
+            graph.timePhases(observe)
+        if params.get('layout'):
+            graph.trackLayout()
+        put(('graph', graph._exportArrays(), []))
+        progress.put(('done', None, []))
+        return
+    if kind in read_kinds:
+        steps, records = read_kinds[kind](_openSnapshot(state), **params), None
+    else:
+        graph = PoisonGraph.fromSnapshot(GraphSnapshot(*state))
+        records = RecordBuffer()
+        graph.logMutations(records)
+        if timed:
+            graph.timePhases(observe)
+        if job_kinds[kind] is _grow:
+            params = dict(params, cancel=cancel)
+        steps = job_kinds[kind](graph, **params)
+    for value in steps:
+        put(('step', value, [] if records is None else records.take()))
+        if cancel.is_set():
+            progress.put(('cancelled', None, []))
+            return
+    progress.put(('done', None, []))
+
+
+class Job():
+    u"""Returns a job submitted to a JobPool, with the queue of its messages
+        and the event cancelling it.
+       :param job_id: the id handed to the client.
+       :param graph_id: the id of the graph of the job.
+       :param kind: the kind of the job.
+       :param progress: the queue of the messages.
+       :param cancel: the event cancelling the job.
+       :param observe: the function given the phases of the graph of a timed
+       job, see runJob.
+    """
+    def __init__(self, job_id, graph_id, kind, progress, cancel, observe=None):
+        self.job_id = job_id
+        self.graph_id = graph_id
+        self.kind = kind
+        self.progress = progress
+        self.cancel_event = cancel
+        self.observe = observe
+        self.future = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def messages(self, timeout=0.1):
+        u"""Returns an iterator of the (kind, value, records) messages of the
+            job until it is done or cancelled. It raises the error of a
+            failed job.
+            :param timeout: the seconds to wait for a message before checking
+            the job failed.
+        """
+        while True:
+            try:
+                message = self.progress.get(timeout=timeout)
+            except queue.Empty:
+                if self.future.done() and self.future.exception() is not None:
+                    raise self.future.exception()
+                continue
+            if message[0] == 'phases':
+                for phase, values in message[1].items():
+                    for seconds in values:
+                        self.observe(phase, seconds)
+                continue
+            yield message
+            if message[0] in ('done', 'cancelled'):
+                return
+
+
+class JobPool():
+    u"""Returns a pool running graph jobs out of the request handlers, so CPU
+        bound generation, scans and deletes do not stall the other requests.
+        Jobs run in a process pool on a copy of the graph and send back the
+        MutationLog records of every step, which the request applies to its
+        graph. A graph has at most one job changing it at a time, next to
+        any number of read jobs.
+       :param workers: the number of pool processes, or 0 to run jobs in a
+       thread of this process.
+       :param context: the multiprocessing start method of the pool.
+       :param observe: the function given the phase names and seconds of the
+       graphs of the jobs, or None not to time them.
+    """
+    def __init__(self, workers=None, context='spawn', observe=None):
+        self.workers = workers
+        self.observe = observe
+        self.context = multiprocessing.get_context(context)
+        self.executor = None
+        self.manager = None
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def _executor(self):
+        if self.executor is None:
+            if self.workers == 0:
+                self.executor = ThreadPoolExecutor(1)
+            else:
+                if self.manager is None:
+                    self.manager = self.context.Manager()
+                workers = self.capacity()
+                self.executor = ProcessPoolExecutor(workers, mp_context=self.context)
+                # Start every process now: each one imports numpy and scipy
+                for _ in range(workers):
+                    self.executor.submit(_ready)
+        return self.executor
+
+    def _channels(self):
+        if self.manager is None:
+            return queue.Queue(), threading.Event()
+        return self.manager.Queue(), self.manager.Event()
+
+    def capacity(self):
+        u"""Returns the number of jobs the pool runs at once.
+            :param None
+        """
+        return 1 if self.workers == 0 else self.workers or os.cpu_count()
+
+    def running(self, graph_id):
+        u"""Returns the jobs changing a graph.
+            :param graph_id: the graph id.
+        """
+        with self.lock:
+            return [job for job in self.jobs.values()
+                    if job.graph_id == graph_id and job.kind not in read_kinds]
+
+    def busy(self, graph_id):
+        return bool(self.running(graph_id))
+
+    def get(self, job_id):
+        u"""Returns the running job of an id, raising KeyError if there is
+            none.
+            :param job_id: the job id.
+        """
+        with self.lock:
+            return self.jobs[job_id]
+
+    @contextmanager
+    def start(self, graph_id, kind, state=None, **params):
+        u"""Returns a context of a job running on a graph. The job is
+            cancelled if the context exits before it is done, and the graph
+            can take another job once the context exits. Raises GraphBusy if
+            the job changes the graph and the graph has such a job.
+            :param graph_id: the graph id.
+            :param kind: 'create' or a key of job_kinds or read_kinds.
+            :param state: the (arrays, meta) of the graph, None to create one,
+            or the snapshot source of a read job.
+            :param params: the keyword arguments of the steps.
+        """
+        with self.lock:
+            if kind not in read_kinds and any(job.graph_id == graph_id and job.kind not in read_kinds
+                                              for job in self.jobs.values()):
+                raise GraphBusy(graph_id)
+            executor = self._executor()
+            job = Job(secrets.token_hex(8), graph_id, kind, *self._channels(), observe=self.observe)
+            self.jobs[job.job_id] = job
+        try:
+            try:
+                job.future = executor.submit(runJob, kind, state, params, job.progress, job.cancel_event,
+                                             self.observe is not None)
+            except BrokenProcessPool:
+                # A pool process died: start a new pool for this job
+                with self.lock:
+                    self.executor = None
+                    executor = self._executor()
+                job.future = executor.submit(runJob, kind, state, params, job.progress, job.cancel_event,
+                                             self.observe is not None)
+            yield job
+        finally:
+            job.cancel()
+            with self.lock:
+                del self.jobs[job.job_id]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.manager is not None:
+            self.manager.shutdown()
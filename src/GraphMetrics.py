@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+
+
+class Metrics():
+    u"""Returns a registry of counters, gauges and histograms rendered in
+        the Prometheus text format. Samples are keyed by their labels. A
+        disabled registry drops every sample, so the calls left in the hot
+        paths cost one attribute check.
+       :param enabled: keep the samples.
+    """
+    second_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    byte_buckets = tuple(1 << shift for shift in range(10, 28, 2))
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.families = OrderedDict()
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, help, buckets=None):
+        u"""Declare a metric before it is used.
+            :param name: the name of the metric.
+            :param kind: 'counter', 'gauge' or 'histogram'.
+            :param help: the text of its HELP line.
+            :param buckets: the upper bounds of the buckets of a histogram.
+        """
+        self.families[name] = (kind, help, buckets, {})
+
+    def collect(self, function):
+        u"""Register a function called before every render, to set the gauges
+            read from elsewhere. Returns the function.
+            :param function: the function, given the registry.
+        """
+        self.collectors.append(function)
+        return function
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        samples = self.families[name][3]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.families[name][3][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        u"""Add a value to a histogram.
+            :param name: the name of the histogram.
+            :param value: the value.
+            :param labels: the labels of the sample.
+        """
+        if not self.enabled:
+            return
+        _, _, buckets, samples = self.families[name]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            sample = samples.get(key)
+            if sample is None:
+                sample = samples[key] = [[0] * (len(buckets) + 1), 0.0]
+            sample[0][bisect.bisect_left(buckets, value)] += 1
+            sample[1] += value
+
+    def timer(self, name, **labels):
+        u"""Returns a context adding the seconds it takes to a histogram.
+            :param name: the name of the histogram.
+            :param labels: the labels of the sample.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name, labels)
+
+    @contextmanager
+    def _timer(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in pairs)
+
+    def render(self):
+        u"""Returns every metric in the Prometheus text format.
+            :param None
+        """
+        if not self.enabled:
+            return ''
+        for function in self.collectors:
+            function(self)
+        lines = []
+        with self.lock:
+            for name, (kind, help, buckets, samples) in self.families.items():
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key, value in samples.items():
+                    if kind != 'histogram':
+                        lines.append('%s%s %r' % (name, self._labels(key), float(value)))
+                        continue
+                    total = 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], value[0]):
+                        total += count
+                        lines.append('%s_bucket%s %d' % (name, self._labels(key, [('le', bound)]), total))
+                    lines.append('%s_sum%s %r' % (name, self._labels(key), value[1]))
+                    lines.append('%s_count%s %d' % (name, self._labels(key), total))
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler():
+    u"""Returns a profiler sampling the stack of one thread from an OS thread
+        of its own, without tracing the calls it samples. Under eventlet it
+        samples the green thread that started it. The stacks are counted in
+        the folded format of flame graphs.
+       :param thread_id: the ident of the OS thread sampled.
+       :param interval: the seconds between two samples.
+    """
+    def __init__(self, thread_id=None, interval=0.005):
+        # Once eventlet patched the threads, sample from an OS thread
+        patcher = sys.modules.get('eventlet.patcher')
+        green = patcher is not None and patcher.is_monkey_patched('thread')
+        threads = patcher.original('threading') if green else threading
+        self.threads = threads
+        self.thread_id = thread_id or threads.get_ident()
+        self.greenlet = None
+        if green:
+            from greenlet import getcurrent
+            self.greenlet = getcurrent()
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.stopping = threads.Event()
+        self.thread = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread = self.threads.Thread(target=self._sample, name='profiler', daemon=True)
+        self.thread.start()
+        return self
+
+    def _frame(self):
+        # A green thread switched out keeps its frame, the one running is
+        # the frame of its OS thread
+        if self.greenlet is not None and (self.greenlet.gr_frame is not None or self.greenlet.dead):
+            return self.greenlet.gr_frame
+        return sys._current_frames().get(self.thread_id)
+
+    def _sample(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+        names = {}
+        while not self.stopping.wait(self.interval):
+            frame = self._frame()
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = names.get(code)
+                if name is None:
+                    path = code.co_filename
+                    path = path[len(root):] if path.startswith(root) else os.path.basename(path)
+                    name = names[code] = '%s (%s:%d)' % (code.co_name, path, code.co_firstlineno)
+                stack.append(name)
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        u"""Stop sampling and returns the profiler.
+            :param None
+        """
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+            self.elapsed = time.perf_counter() - self.started
+        return self
+
+    def folded(self):
+        u"""Returns the stacks sampled, one 'caller;callee count' line each.
+            :param None
+        """
+        return ''.join('%s %d\n' % (stack, count) for stack, count in self.stacks.most_common())
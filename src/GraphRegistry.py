@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class GraphEntry():
+    u"""Returns a registered graph with its id, its lock, its last measured
+        size in bytes, the time it was last used and the number of requests
+        using it.
+       :param graph_id: the id handed to the client.
+       :param graph: the graph.
+    """
+    def __init__(self, graph_id, graph):
+        self.graph_id = graph_id
+        self.graph = graph
+        self.lock = threading.RLock()
+        self.size = 0
+        self.last_used = 0
+        self.users = 0
+
+
+class GraphRegistry():
+    u"""Returns a store of the graphs of every client keyed by a random graph
+        id. Graphs are kept in least recently used order, graphs idle for
+        longer than ttl seconds are dropped and the least recently used ones
+        are evicted while the measured sizes are over max_bytes. A graph in
+        use by a request is never evicted.
+       :param max_bytes: the memory budget of all the graphs.
+       :param ttl: the seconds a graph is kept without being used.
+       :param clock: the function returning the current time in seconds.
+       :param on_evict: the function called with the id of every graph
+       dropped by the ttl or the budget.
+    """
+    def __init__(self, max_bytes=1 << 30, ttl=1800, clock=time.monotonic, on_evict=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.total = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, graph_id):
+        return graph_id in self.entries
+
+    def add(self, graph, graph_id=None):
+        u"""Register a graph and returns its id.
+            :param graph: the graph.
+            :param graph_id: the id of the graph, or None for a new one.
+        """
+        entry = GraphEntry(graph_id or secrets.token_hex(8), graph)
+        entry.size = graph.getMemoryUsage()
+        with self.lock:
+            entry.last_used = self.clock()
+            replaced = self.entries.pop(entry.graph_id, None)
+            if replaced is not None:
+                self.total -= replaced.size
+            self.entries[entry.graph_id] = entry
+            self.total += entry.size
+            evicted = self._evict()
+        self._evicted(evicted)
+        return entry.graph_id
+
+    def get(self, graph_id):
+        u"""Returns the graph of an id, raising KeyError if it is unknown or
+            was evicted.
+            :param graph_id: the graph id.
+        """
+        with self.lock:
+            evicted = self._evict()
+            entry = self.entries.get(graph_id)
+            if entry is not None:
+                self._touch(entry)
+        self._evicted(evicted)
+        if entry is None:
+            raise KeyError(graph_id)
+        return entry.graph
+
+    def remove(self, graph_id):
+        with self.lock:
+            entry = self.entries.pop(graph_id, None)
+            if entry is not None:
+                self.total -= entry.size
+
+    @contextmanager
+    def checkout(self, graph_id):
+        u"""Returns a context of the entry of a graph id that keeps it from
+            being evicted and measures it again when done. Callers hold
+            entry.lock while they read or change the graph. Raises KeyError if
+            the id is unknown or was evicted.
+            :param graph_id: the graph id.
+        """
+        with self.lock:
+            evicted = self._evict()
+            entry = self.entries.get(graph_id)
+            if entry is not None:
+                entry.users += 1
+                self._touch(entry)
+        self._evicted(evicted)
+        if entry is None:
+            raise KeyError(graph_id)
+        try:
+            yield entry
+        finally:
+            with self.lock:
+                entry.users -= 1
+            self.measure(entry)
+
+    def measure(self, entry):
+        u"""Update the size of an entry and evict graphs over the budget.
+            :param entry: the entry of a graph.
+        """
+        with entry.lock:
+            size = entry.graph.getMemoryUsage()
+        with self.lock:
+            if self.entries.get(entry.graph_id) is entry:
+                self.total += size - entry.size
+                self._touch(entry)
+            entry.size = size
+            evicted = self._evict()
+        self._evicted(evicted)
+
+    def _touch(self, entry):
+        entry.last_used = self.clock()
+        self.entries.move_to_end(entry.graph_id)
+
+    def _evict(self):
+        now = self.clock()
+        evicted = []
+        for entry in list(self.entries.values()):
+            if self.total <= self.max_bytes and now - entry.last_used <= self.ttl:
+                break
+            if entry.users == 0:
+                del self.entries[entry.graph_id]
+                self.total -= entry.size
+                self.evicted += 1
+                evicted.append(entry.graph_id)
+        return evicted
+
+    def _evicted(self, graph_ids):
+        if self.on_evict is not None:
+            for graph_id in graph_ids:
+                self.on_evict(graph_id)
+
+    def stats(self):
+        u"""Returns the number of graphs, their bytes, the budget and the
+            number of graphs evicted so far.
+            :param None
+        """
+        with self.lock:
+            return {'graphs': len(self.entries), 'bytes': self.total,
+                    'max_bytes': self.max_bytes, 'evicted': self.evicted}
@@ -3,8 +3,174 @@
 
 import random
 import copy
+import numpy as np
 from src.DynamicGraph import DynamicGraph as DG
 
+def scoreRemovals(graph, candidate_sets):
+    u"""Returns the count of nodes infected in a graph after the nodes of
+        every candidate set are removed from its initial poison nodes, as a
+        numpy array in the order of the sets. A component is saved when all
+        its initial poison nodes are removed, other nodes change nothing.
+        It only reads the graph, a PoisonGraph or a GraphSnapshot of one,
+        and takes a vectorised pass over the poison and candidate nodes.
+        :param graph: the graph.
+        :param candidate_sets: the lists of nodes to be removed.
+    """
+    alive = np.frombuffer(graph.alive, dtype=np.uint8)
+    poison = np.unique(np.asarray(graph.InitialPoison, dtype=np.int64))
+    poison = poison[poison < len(alive)]
+    poison = poison[alive[poison] == 1]
+    if not len(poison):
+        return np.zeros(len(candidate_sets), dtype=np.int64)
+    components, poison_component, poison_counts = np.unique(graph.getComponentIds(poison),
+                                                            return_inverse=True, return_counts=True)
+    sizes = graph.getComponentSizes(poison[np.unique(poison_component, return_index=True)[1]]).astype(np.int64)
+
+    # Every candidate that is a poison node, once per set
+    lengths = np.array([len(nodes) for nodes in candidate_sets], dtype=np.int64)
+    nodes = np.fromiter((v for nodes in candidate_sets for v in nodes), dtype=np.int64, count=lengths.sum())
+    sets = np.repeat(np.arange(len(candidate_sets)), lengths)
+    position = np.minimum(np.searchsorted(poison, nodes), len(poison) - 1)
+    hit = poison[position] == nodes
+    pairs = np.unique(sets[hit] * len(poison) + position[hit])
+    sets, position = pairs // len(poison), pairs % len(poison)
+
+    # A set saves a component when it removes all its poison nodes
+    keys, chosen = np.unique(sets * len(components) + poison_component[position], return_counts=True)
+    sets, component = keys // len(components), keys % len(components)
+    full = chosen == poison_counts[component]
+    saved = np.bincount(sets[full], weights=sizes[component[full]], minlength=len(candidate_sets))
+    return sizes.sum() - saved.astype(np.int64)
+
+
+class SpreadSimulator():
+    u"""Returns a discrete time epidemic spreading from the seed nodes of a
+        graph, for a batch of independent runs at once. Every step an
+        infected node infects each susceptible neighbour with probability
+        beta, and in the SIR and SIS models it recovers with probability
+        gamma, to removed or to susceptible again. The states of the runs
+        are a (runs, nodes) uint8 array next to an int32 array of the
+        infected neighbours of every node, which only changes around the
+        nodes infected or recovered in a step, so a step costs a scan of the
+        counts plus the degrees of the nodes that changed.
+       :param indptr: the CSR offsets of the adjacency.
+       :param indices: the CSR neighbours of the adjacency.
+       :param seeds: the nodes infected at step 0.
+       :param model: 'SI', 'SIR' or 'SIS'.
+       :param beta: the transmission probability of an edge in a step.
+       :param gamma: the recovery probability of an infected node in a step.
+       :param runs: the number of runs.
+       :param seed: the seed of the random generator, None for a fresh one.
+    """
+    S, I, R = 0, 1, 2
+    models = ('SI', 'SIR', 'SIS')
+
+    def __init__(self, indptr, indices, seeds, model='SI', beta=0.1, gamma=0.1, runs=1, seed=None):
+        if model not in self.models:
+            raise ValueError('unknown spread model %r' % (model,))
+        if not (0 <= beta <= 1 and 0 <= gamma <= 1):
+            raise ValueError('beta and gamma should be probabilities')
+        self.adjacency = DG.CSRAdjacency(indptr, indices)
+        self.model = model
+        self.beta = beta
+        self.gamma = gamma if model != 'SI' else 0
+        self.runs = runs
+        self.node_num = len(indptr) - 1
+        self.rng = np.random.default_rng(seed)
+        self.state = np.zeros((runs, self.node_num), dtype=np.uint8)
+        self.pressure = np.zeros((runs, self.node_num), dtype=np.int32)
+        self.infected = np.zeros(runs, dtype=np.int64)
+        self.recovered = np.zeros(runs, dtype=np.int64)
+        self.active = np.empty(0, dtype=np.int64)
+        self.candidates = None
+        self.step_count = 0
+        seeds = np.unique(np.asarray(seeds, dtype=np.int64))
+        seeds = seeds[(seeds >= 0) & (seeds < self.node_num)]
+        self.seeds = (np.arange(runs, dtype=np.int64)[:, None] * self.node_num + seeds).reshape(-1)
+        self._change(self.seeds, np.empty(0, dtype=np.int64))
+
+    @classmethod
+    def fromGraph(cls, graph, **kwargs):
+        u"""Returns a simulator spreading from the alive initial poison nodes
+            of a PoisonGraph or of a GraphSnapshot of one.
+            :param graph: the graph.
+            :param kwargs: the model, beta, gamma, runs and seed.
+        """
+        snapshot = graph if isinstance(graph, DG.GraphSnapshot) else graph.freeze()
+        alive = np.frombuffer(snapshot.alive, dtype=np.uint8)
+        seeds = np.asarray(snapshot.InitialPoison, dtype=np.int64)
+        seeds = seeds[seeds < len(alive)]
+        seeds = seeds[alive[seeds] == 1]
+        return cls(snapshot.neighbours.indptr, snapshot.neighbours.indices, seeds, **kwargs)
+
+    def _spread(self, cells, delta):
+        # Add delta to the counts of the neighbours of the (run, node) cells
+        runs, nodes = np.divmod(cells, self.node_num)
+        neighbours, degrees = self.adjacency.gather(nodes)
+        targets = neighbours + np.repeat(runs * self.node_num, degrees)
+        np.add.at(self.pressure.reshape(-1), targets, delta)
+
+    def _change(self, infected, recovered):
+        state = self.state.reshape(-1)
+        state[infected] = self.I
+        state[recovered] = self.R if self.model == 'SIR' else self.S
+        self._spread(infected, 1)
+        self._spread(recovered, -1)
+        self.infected += np.bincount(infected // self.node_num, minlength=self.runs)
+        self.infected -= np.bincount(recovered // self.node_num, minlength=self.runs)
+        if self.model == 'SIR':
+            self.recovered += np.bincount(recovered // self.node_num, minlength=self.runs)
+        if self.model != 'SI':
+            self.active = np.concatenate((self.active[state[self.active] == self.I], infected))
+
+    def finished(self):
+        u"""Returns True if no run can change any more: no infected node is
+            left, or in SI no infected node has a susceptible neighbour.
+            :param None
+        """
+        if self.model == 'SI':
+            return self.candidates is not None and not self.candidates
+        return not len(self.active)
+
+    def step(self):
+        u"""Advance every run by one step, every change drawn from the states
+            before it, and returns the flat (run * nodes + node) indices of
+            the nodes infected and recovered in it.
+            :param None
+        """
+        state, pressure = self.state.reshape(-1), self.pressure.reshape(-1)
+        candidates = np.flatnonzero(pressure)
+        candidates = candidates[state[candidates] == self.S]
+        self.candidates = len(candidates)
+        chance = 1 - np.power(1 - self.beta, pressure[candidates])
+        infected = candidates[self.rng.random(len(candidates)) < chance]
+        recovered = self.active[self.rng.random(len(self.active)) < self.gamma]
+        self._change(infected, recovered)
+        self.step_count += 1
+        return infected, recovered
+
+    def _counts(self, infected, recovered, trace):
+        # The cells of the first run are its node ids
+        if not trace:
+            infected = recovered = np.empty(0, dtype=np.int64)
+        return {'step': self.step_count, 'infected': self.infected.copy(),
+                'recovered': self.recovered.copy(),
+                'new_infected': infected[infected < self.node_num].astype(np.int32),
+                'new_recovered': recovered[recovered < self.node_num].astype(np.int32)}
+
+    def run(self, steps, trace=True):
+        u"""Returns an iterator of the counts at step 0 and after every step,
+            until steps steps are taken or no run can change: dicts of the
+            step, the infected and recovered counts of every run and, with
+            trace, the nodes infected and recovered in the first run.
+            :param steps: the max number of steps.
+            :param trace: send the changed nodes of the first run.
+        """
+        yield self._counts(self.seeds, np.empty(0, dtype=np.int64), trace)
+        while self.step_count < steps and not self.finished():
+            yield self._counts(*self.step(), trace)
+
+
 class PoisonGraph(DG.ProbGraph):
     u"""Derived class of ProbGraph for a poison network. Anything that can be
         represented by an initial infected nodes list. It returns a class of
@@ -21,43 +187,86 @@ class PoisonGraph(DG.ProbGraph):
        :param empty: If it is True, ProbGraph will be generated by nodes list
        only without any connections.
        If it is False, ProGraph will be generated from scratch.
+       :param engine: the generation engine of ProbGraph, 'python' or 'numpy'.
+       :param storage: the storage of ProbGraph, 'dict' or 'compact'.
        """
-    def __init__(self, node_num, edge_num, poison_number=0, gamma=3, empty=False):
-        self.V = list(range(node_num))
-        self.E = []
+    def __init__(self, node_num, edge_num, poison_number=0, gamma=3, empty=False, engine='python',
+                 storage='dict'):
         self.InitialPoison = list(range(poison_number))
         self.infected_nodes = list(range(poison_number))
         self.Principals = []
         self.deletedNodes = 0
-        self.temp_component = []
-        self.connected_nodes = []
-        self.connected_components = []
-        self.gamma = gamma
-        self.neighbours = {}
-        self.visited = {}
-        self.source = gamma
-        self.isolated_nodes = []
-
-        #############################
-        # Do the initialization
-        #############################
-        if self._initialize(node_num) and not empty:
-            self._createEdges(edge_num)
-            self.updateComponents()
+        DG.ProbGraph.__init__(self, node_num, edge_num, gamma=gamma, empty=empty, engine=engine,
+                              storage=storage)
 
     def __contains__(self, keys):
         if self.__dict__ is None:
             raise TypeError('not indexable')
-        self.new_V = [(key, len(self.neighbours[key])) for key in self.V & self.neighbours.keys()]
-        return dict((key,value) for key, value in self.__dict__.items() if key in keys)
+        self.new_V = self._memo(('degrees',), lambda: [(key, len(self.neighbours[key]))
+                                                       for key in self.V & self.neighbours.keys()])
+        result = dict((key,value) for key, value in self.__dict__.items() if key in keys)
+        if 'E' in result:
+            result['E'] = self.getEdges()
+        return result
+
+    def _exportArrays(self):
+        arrays, meta = DG.ProbGraph._exportArrays(self)
+        for key in ('InitialPoison', 'infected_nodes', 'Principals'):
+            arrays[key] = np.array(getattr(self, key), dtype=np.int32)
+        meta['deletedNodes'] = self.deletedNodes
+        meta['attributes'] = ['InitialPoison', 'infected_nodes', 'Principals', 'deletedNodes']
+        return arrays, meta
 
+    def _loadArrays(self, arrays, meta):
+        DG.ProbGraph._loadArrays(self, arrays, meta)
+        self.InitialPoison = arrays['InitialPoison'].tolist()
+        self.infected_nodes = arrays['infected_nodes'].tolist()
+        self.Principals = arrays['Principals'].tolist()
+        self.deletedNodes = meta['deletedNodes']
+
+    @DG.timed('poison')
     def addPoison(self, node_num):
         u"""Mark new poison nodes to an exiting graph without adding nodes
             :param node_num: the number of newly makred poison nodes.
         """
-        rand_poison = random.sample([v for v in self.V if v not in self.InitialPoison], node_num)
+        healthy = np.frombuffer(self.alive, dtype=np.uint8).astype(bool)
+        healthy[np.array(self.InitialPoison, dtype=np.int64)] = False
+        healthy = np.flatnonzero(healthy)
+        rand_poison = healthy[random.sample(range(len(healthy)), node_num)].tolist()
+        self._changed()
         self.InitialPoison.extend(rand_poison)
         self.infected_nodes.extend(rand_poison)
+        if self.log is not None:
+            self.log.append(DG.MutationLog.ADD_POISON, rand_poison)
+
+    def resetPoison(self, *keys):
+        u"""Empty poison lists of an exiting graph.
+            :param keys: the names of the lists, among InitialPoison,
+            infected_nodes and Principals.
+        """
+        self._changed()
+        for key in keys:
+            getattr(self, key).clear()
+        self._logPoison()
+
+    def _logPoison(self):
+        if self.log is not None:
+            self.log.append(DG.MutationLog.SET_POISON, self.InitialPoison, self.infected_nodes,
+                            self.Principals)
+
+    def _applyRecord(self, op, arrays):
+        if op in (DG.MutationLog.ADD_POISON, DG.MutationLog.SET_POISON):
+            self._changed()
+        if op == DG.MutationLog.ADD_POISON:
+            self.InitialPoison.extend(arrays[0].tolist())
+            self.infected_nodes.extend(arrays[0].tolist())
+        elif op == DG.MutationLog.DEL_POISON:
+            self.deletedNodes = 0
+            self._detachPoison(arrays[0].tolist())
+        elif op == DG.MutationLog.SET_POISON:
+            self.InitialPoison, self.infected_nodes, self.Principals = [a.tolist() for a in arrays]
+        else:
+            DG.ProbGraph._applyRecord(self, op, arrays)
 
     def getPoison(self):
         u"""Returns all poison nodes in an exiting graph
@@ -65,90 +274,119 @@ class PoisonGraph(DG.ProbGraph):
         """
         return self.infected_nodes
 
+    def _detachPoison(self, nodes):
+        u"""Remove infected nodes and their edges from an exiting graph and
+            count them as deleted.
+            :param nodes: the infected nodes, all in the graph
+        """
+        self._detachNodes(nodes)
+        self.deletedNodes += len(nodes)
+        self.infected_nodes[:] = [v for v in self.infected_nodes if self.hasNode(v)]
+        self.InitialPoison[:] = [v for v in self.InitialPoison if self.hasNode(v)]
+
+    @DG.timed('delete_poison')
     def delPoisonFrom(self, nodes):
-        u"""Delete all infected nodes from an exiting graph using a recursive
-            way with dfs algorithm to search nodes by their neighbours.
+        u"""Delete all infected nodes from an exiting graph. The connected
+            component of every node is found by a bfs from the node itself,
+            so only the infected components are visited.
             :param nodes: the initial poison nodes list
         """
         self.deletedNodes = 0
-        for v in [value for value in nodes if value in self.V]:
-            self.V.remove(v)
-            self.deletedNodes += 1
-            self.connected_nodes[:] = (value for value in self.connected_nodes if value != v)
-            self.isolated_nodes[:] = (value for value in self.isolated_nodes if value != v)
-            self.infected_nodes[:] = (value for value in self.infected_nodes if value != v)
-            self.InitialPoison[:] = (value for value in self.InitialPoison if value != v)
-            for n in self.neighbours[v]:
-                self.connected_nodes.remove(n)
-                self.neighbours[n].remove(v)
-                if not self.neighbours[n]:
-                    self.isolated_nodes.append(n)
-                if (n, v) in self.E:
-                    self.E.remove((n, v))
-                else:
-                    self.E.remove((v, n))
-                self.neighbours[v] = []
-
-        sorted_components = sorted(self.connected_components, key=len, reverse=True)
-        p = set(nodes)
-        for i, component in enumerate(sorted_components):
-            s = set(component)
-            if len(tuple(s & p)) > 0:
-                self.connected_components.remove(component)
-                component[:] = (value for value in component if value not in list(tuple(s & p)))
-                if len(component) <= 1:
-                    continue
-                for v in self._dfs_non_recursive(component):
-                    self.V.remove(v)
-                    self.deletedNodes += 1
-                    self.connected_nodes[:] = (value for value in self.connected_nodes if value != v)
-                    self.isolated_nodes[:] = (value for value in self.isolated_nodes if value != v)
-                    self.infected_nodes[:] = (value for value in self.infected_nodes if value != v)
-                    self.InitialPoison[:] = (value for value in self.InitialPoison if value != v)
-                    for n in self.neighbours[v]:
-                        self.connected_nodes.remove(n)
-                        self.neighbours[n].remove(v)
-                        if not self.neighbours[n]:
-                            self.isolated_nodes.append(n)
-                        if (n, v) in self.E:
-                            self.E.remove((n, v))
-                        else:
-                            self.E.remove((v, n))
-                        self.neighbours[v] = []
-                p -= s
-                if len(tuple(p)) == 0:
-                    break
+        targets = [v for v in dict.fromkeys(nodes) if self.hasNode(v)]
+        p = set(targets)
+        seen = set()
+        infected = []
+        for v in targets:
+            if v in seen:
+                continue
+            component = [x for x in self._reach(v, seen) if x not in p]
+            if len(component) > 1:
+                infected.extend(component)
+        self._detachPoison(targets + infected)
+        if self.log is not None:
+            self.log.append(DG.MutationLog.DEL_POISON, targets + infected)
 
+    def evaluateRemovals(self, candidate_sets):
+        u"""Returns the count of nodes infected after the nodes of every
+            candidate set are removed from the initial poison nodes, as a
+            numpy array, without changing the graph. See scoreRemovals.
+            :param candidate_sets: the lists of nodes to be removed.
+        """
+        return scoreRemovals(self, candidate_sets)
 
+    @DG.timed('scan')
     def scanPoison(self, node_num):
-        u""" It return a final count of nodes infected with poison in the entire
-            graph after the spread of poison stops and a list of Principals node
-            that if removed, would minimize scanPoison(InitialPoison).
+        u"""Returns the final count of nodes infected with poison in the entire
+            graph after the spread of poison stops, and the count of nodes
+            saved by removing the Principals: the node_num initial poison
+            nodes that save the most nodes when removed. Removing a poison
+            node saves its component when it is the only initial poison node
+            of the component, so poison nodes are ranked by that size, then
+            by node id. It takes a pass over the component labels of the
+            nodes and over the poison nodes. A scan of a graph unchanged
+            since the same scan returns its cached result.
+            :param node_num: the number of principals poison nodes.
+        """
+        result = self.lastScan(node_num)
+        if result is not None:
+            return result
+        labels = self.disjoint_set.labels()
+        alive = np.zeros(len(labels), dtype=bool)
+        alive[:len(self.alive)] = np.frombuffer(self.alive, dtype=np.uint8).astype(bool)
+        sizes = np.bincount(labels[alive], minlength=len(labels))
+        poison = np.unique(np.array(self.InitialPoison, dtype=np.int64))
+        poison = poison[alive[poison]]
+        poison_labels = labels[poison]
+        poison_counts = np.bincount(poison_labels, minlength=len(labels))
+
+        infected = alive & (poison_counts[labels] > 0)
+        infected[poison] = False
+        self.infected_nodes[:] = self.InitialPoison + np.flatnonzero(infected).tolist()
+
+        saves = np.where(poison_counts[poison_labels] == 1, sizes[poison_labels], 0)
+        principals = poison[np.lexsort((poison, -saves))[:max(node_num, 0)]]
+        self.Principals[:] = principals.tolist()
+        chosen = np.bincount(labels[principals], minlength=len(labels))
+        saved = sizes[(chosen > 0) & (chosen == poison_counts)].sum()
+        self._changed()
+        self._logPoison()
+        result = int(sizes[poison_counts > 0].sum()), int(saved)
+        self.rememberScan(node_num, result)
+        return result
+
+    def lastScan(self, node_num):
+        u"""Returns the result of scanPoison(node_num) if the graph has not
+            changed since that scan, else None. Only graphs caching their
+            queries remember scans.
+            :param node_num: the number of principals poison nodes.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.get(('scanPoison', node_num), self.version)
+
+    def rememberScan(self, node_num, result):
+        u"""Keep the result of a scan at the version of the poison lists it
+            set, for a scan made here or on a copy whose changes were
+            applied here.
             :param node_num: the number of principals poison nodes.
-            the length should be between 1 and len(InitialPoison) - 1
+            :param result: the result of scanPoison(node_num).
+        """
+        if self.cache is not None:
+            self.cache.put(('scanPoison', node_num), self.version, tuple(result))
+
+    def getPoisonDistances(self, max_depth=None):
+        u"""Returns the hops from the nearest initial poison node to every
+            node id as an int32 numpy array, -1 if no poison reaches it, by
+            one bfs from all the alive initial poison nodes.
+            :param max_depth: the max hops searched, None for no limit.
+        """
+        return self.getDistances([v for v in self.InitialPoison if self.hasNode(v)], max_depth)
+
+    def simulateSpread(self, steps, **kwargs):
+        u"""Returns the counts of every step of an epidemic spreading from the
+            initial poison nodes, without changing the graph. See
+            SpreadSimulator.
+            :param steps: the max number of steps.
+            :param kwargs: the model, beta, gamma, runs and seed.
         """
-        self.infected_nodes.clear()
-        self.Principals.clear()
-        if node_num > len(self.InitialPoison) - 1:
-            return len(self.InitialPoison), self.InitialPoison
-        sorted_components = sorted(self.connected_components, key=len, reverse=True)
-        counted = 0
-        p = set(self.InitialPoison)
-        self.infected_nodes.extend(self.InitialPoison)
-        for i, v in enumerate(sorted_components):
-            s = set(v)
-            if len(tuple(s & p)) > 0:
-                counted += len(v)
-                self.infected_nodes.extend(list(tuple(s - p)))
-                if len(self.Principals) < node_num:
-                    self.Principals.append(random.choice(tuple(s & p)))
-                p -= s
-                if len(tuple(p)) == 0:
-                    break
-        counted += len(p)
-        if len(self.Principals) < node_num:
-            if len(tuple(p)) > 0:
-                self.Principals.extend(random.sample(p, node_num - len(principals)))
-            else:
-                self.Principals = random.sample(self.InitialPoison, node_num)
-        return counted
\ No newline at end of file
+        return list(SpreadSimulator.fromGraph(self, **kwargs).run(steps))
@@ -0,0 +1,253 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+from src.DynamicGraph.DynamicGraph import GraphSnapshot
+
+
+class SharedGraphStore():
+    u"""Returns a store of read-only graph snapshots in shared memory, so
+        every worker process reads the same copy of a graph. A graph id has a
+        small pointer segment holding the current version and the pid of its
+        owner, and every version of the graph is one segment holding a packed
+        GraphSnapshot. Writers claim the graph while they change it, publish
+        a new version and become its owner. Readers attach to the current
+        version without copying it.
+       :param prefix: the prefix of the segment and lock file names.
+       :param lock_dir: the directory of the lock files.
+       :param max_attached: the max number of snapshots kept attached.
+    """
+    pointer = struct.Struct('<qq')
+    claimant = struct.Struct('<q')
+    lock_stripes = 64
+
+    def __init__(self, prefix='dg', lock_dir=None, max_attached=64):
+        self.prefix = prefix
+        self.lock_dir = lock_dir or tempfile.gettempdir()
+        self.max_attached = max_attached
+        self.attached = OrderedDict()
+        self.published = {}
+        self.claims = {}
+
+    def _name(self, graph_id, version=None):
+        if version is None:
+            return '%s_%s' % (self.prefix, graph_id)
+        return '%s_%s_%d' % (self.prefix, graph_id, version)
+
+    def _claimName(self, graph_id):
+        return '%s_%s_claim' % (self.prefix, graph_id)
+
+    @staticmethod
+    def _open(name, size=0):
+        # Segments outlive the process that made them: the owner unlinks them
+        if size:
+            segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+    def current(self, graph_id):
+        u"""Returns the (version, owner pid) of a graph id, or None if it was
+            never published.
+            :param graph_id: the graph id.
+        """
+        try:
+            segment = self._open(self._name(graph_id))
+        except FileNotFoundError:
+            return None
+        try:
+            return self.pointer.unpack_from(segment.buf)
+        finally:
+            segment.close()
+
+    @contextmanager
+    def lock(self, graph_id, poll=0.01):
+        u"""Returns a context holding the cross-process lock of a graph id.
+            Graph ids share a fixed set of lock files, so no file is left
+            behind per graph. It polls instead of blocking so green threads
+            keep running.
+            :param graph_id: the graph id.
+            :param poll: the seconds between two tries.
+        """
+        stripe = zlib.crc32(graph_id.encode('utf-8')) % self.lock_stripes
+        path = os.path.join(self.lock_dir, '%s_lock_%d' % (self.prefix, stripe))
+        with open(path, 'a') as handle:
+            while True:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    time.sleep(poll)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def publish(self, graph_id, graph):
+        u"""Freeze a graph into a new version segment and make this process
+            its owner. Callers hold the lock of the graph id. Returns the new
+            version.
+            :param graph_id: the graph id.
+            :param graph: the graph.
+        """
+        snapshot = graph.freeze()
+        current = self.current(graph_id)
+        version = 1 if current is None else current[0] + 1
+        segment = self._open(self._name(graph_id, version), snapshot.nbytes())
+        try:
+            snapshot.pack_into(segment.buf)
+        finally:
+            segment.close()
+        try:
+            pointer = self._open(self._name(graph_id))
+        except FileNotFoundError:
+            pointer = self._open(self._name(graph_id), self.pointer.size)
+        try:
+            self.pointer.pack_into(pointer.buf, 0, version, os.getpid())
+        finally:
+            pointer.close()
+        if current is not None:
+            self._unlink(self._name(graph_id, current[0]))
+        self.published[graph_id] = version
+        return version
+
+    def owns(self, graph_id):
+        u"""Returns True if this process published the current version.
+            :param graph_id: the graph id.
+        """
+        current = self.current(graph_id)
+        return current is not None and current == (self.published.get(graph_id), os.getpid())
+
+    def attach(self, graph_id):
+        u"""Returns the current GraphSnapshot of a graph id as read-only views
+            of its segment, or None if it was never published.
+            :param graph_id: the graph id.
+        """
+        current = self.current(graph_id)
+        if current is None:
+            return None
+        cached = self.attached.get(graph_id)
+        if cached is not None and cached[0] == current[0]:
+            self.attached.move_to_end(graph_id)
+            return cached[1]
+        try:
+            segment = self._open(self._name(graph_id, current[0]))
+        except FileNotFoundError:
+            # A newer version replaced it in the meantime
+            return self.attach(graph_id)
+        try:
+            # The views hold a mapping of their own, which goes away with the
+            # last of them: a segment closed under its views raises BufferError
+            mapping = mmap.mmap(segment._fd, segment.size, access=mmap.ACCESS_READ)
+        finally:
+            segment.close()
+        snapshot = GraphSnapshot.frombuffer(mapping)
+        self.attached.pop(graph_id, None)
+        self.attached[graph_id] = (current[0], snapshot)
+        while len(self.attached) > self.max_attached:
+            self.attached.popitem(last=False)
+        return snapshot
+
+    def _claimant(self, graph_id):
+        # The pid of the live process changing a graph, else 0
+        try:
+            segment = self._open(self._claimName(graph_id))
+        except FileNotFoundError:
+            return 0
+        try:
+            pid = self.claimant.unpack_from(segment.buf)[0]
+        finally:
+            segment.close()
+        if pid and pid != os.getpid():
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return 0
+            except PermissionError:
+                pass
+        return pid
+
+    def claimed(self, graph_id):
+        u"""Returns True if another live process is changing a graph.
+            :param graph_id: the graph id.
+        """
+        return self._claimant(graph_id) not in (0, os.getpid())
+
+    def claim(self, graph_id):
+        u"""Mark a graph as changed by this process until it is released, so
+            the other processes refuse to change it instead of waiting for
+            it. Callers hold the lock of the graph id. Returns False if
+            another live process has it.
+            :param graph_id: the graph id.
+        """
+        if self.claimed(graph_id):
+            return False
+        if not self.claims.get(graph_id):
+            name = self._claimName(graph_id)
+            try:
+                segment = self._open(name)
+            except FileNotFoundError:
+                segment = self._open(name, self.claimant.size)
+            try:
+                self.claimant.pack_into(segment.buf, 0, os.getpid())
+            finally:
+                segment.close()
+        self.claims[graph_id] = self.claims.get(graph_id, 0) + 1
+        return True
+
+    def release(self, graph_id):
+        u"""End a claim of this process on a graph. Callers hold the lock of
+            the graph id.
+            :param graph_id: the graph id.
+        """
+        count = self.claims.pop(graph_id, 0) - 1
+        if count > 0:
+            self.claims[graph_id] = count
+        elif count == 0:
+            self._unlink(self._claimName(graph_id))
+
+    @staticmethod
+    def _unlink(name):
+        try:
+            segment = SharedGraphStore._open(name)
+        except FileNotFoundError:
+            return
+        segment.close()
+        # unlink() unregisters the name from the resource tracker
+        resource_tracker.register(segment._name, 'shared_memory')
+        segment.unlink()
+
+    def discard(self, graph_id):
+        u"""Remove the segments of a graph id.
+            :param graph_id: the graph id.
+        """
+        current = self.current(graph_id)
+        self.attached.pop(graph_id, None)
+        self.published.pop(graph_id, None)
+        if current is not None:
+            self._unlink(self._name(graph_id, current[0]))
+            self._unlink(self._name(graph_id))
+
+    def close(self):
+        u"""Remove the segments of every graph this process still owns and
+            its claims.
+            :param None
+        """
+        for graph_id in list(self.published):
+            if self.owns(graph_id):
+                self.discard(graph_id)
+        for graph_id in list(self.claims):
+            self._unlink(self._claimName(graph_id))
+        self.claims.clear()
+        self.attached.clear()
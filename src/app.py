@@ -1,14 +1,84 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, Response, request, render_template, abort
+from flask import Flask, Response, g, request, render_template, abort
+import atexit
+import base64
 import json
-import random
+import os
+import re
+import secrets
+import struct
+import tempfile
+import threading
 import time
-import queue
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager, nullcontext
+import numpy as np
 from src.PoisonGrapn import *
+from src.GraphRegistry import GraphRegistry
+from src.SharedGraph import SharedGraphStore
+from src.GraphJobs import GraphBusy, JobPool
+from src.GraphMetrics import Metrics, SamplingProfiler
 
 app = Flask(__name__)
-graph_gen = queue.Queue()
-poison_map = ['new_V', 'E', 'Principals','deletedNodes', 'InitialPoison', 'infected_nodes']
+app.config.setdefault('GRAPH_MEMORY_BUDGET', 1 << 30)
+app.config.setdefault('GRAPH_TTL', 1800)
+app.config.setdefault('GRAPH_SHARED_MEMORY', True)
+app.config.setdefault('GRAPH_LOG_DIR', None)
+app.config.setdefault('GRAPH_LOG_COMPACT', 64 << 20)
+app.config.setdefault('GRAPH_JOB_WORKERS', None)
+app.config.setdefault('GRAPH_QUERY_CACHE', 256)
+app.config.setdefault('GRAPH_PAYLOAD_CACHE', 16)
+app.config.setdefault('GRAPH_SPREAD_MAX_RUNS', 256)
+app.config.setdefault('GRAPH_SPREAD_MAX_STEPS', 1000)
+app.config.setdefault('GRAPH_LOD_BUDGET', 5000)
+app.config.setdefault('GRAPH_LOD_SMALL', 16)
+app.config.setdefault('GRAPH_LAYOUT', True)
+app.config.setdefault('GRAPH_METRICS', True)
+app.config.setdefault('GRAPH_PROFILE', False)
+app.config.setdefault('GRAPH_PROFILE_INTERVAL', 0.005)
+app.config.setdefault('GRAPH_PROFILES', 16)
+shared = SharedGraphStore() if app.config['GRAPH_SHARED_MEMORY'] else None
+
+def evicted(graph_id):
+    # Only the owner removes the shared copy of an evicted graph
+    if shared is not None and shared.owns(graph_id):
+        shared.discard(graph_id)
+
+graphs = GraphRegistry(max_bytes=app.config['GRAPH_MEMORY_BUDGET'], ttl=app.config['GRAPH_TTL'],
+                       on_evict=evicted)
+if shared is not None:
+    atexit.register(shared.close)
+metrics = Metrics(app.config['GRAPH_METRICS'])
+metrics.describe('graph_phase_seconds', 'histogram', 'Seconds of the phases of the graphs and the streams.',
+                 Metrics.second_buckets)
+metrics.describe('graph_requests_total', 'counter', 'Requests answered by endpoint and status.')
+metrics.describe('graph_request_seconds', 'histogram', 'Seconds of the requests until their answer is sent.',
+                 Metrics.second_buckets)
+metrics.describe('graph_sse_event_bytes', 'histogram', 'Bytes of the events sent by stream.', Metrics.byte_buckets)
+metrics.describe('graph_streams_in_flight', 'gauge', 'Event streams being sent.')
+metrics.describe('graph_graphs', 'gauge', 'Graphs held by this worker.')
+metrics.describe('graph_graph_bytes', 'gauge', 'Measured bytes of the graphs held by this worker.')
+metrics.describe('graph_nodes', 'gauge', 'Nodes of the graphs held by this worker.')
+metrics.describe('graph_edges', 'gauge', 'Edges of the graphs held by this worker.')
+metrics.describe('graph_jobs', 'gauge', 'Jobs running in the pool for this worker.')
+metrics.describe('graph_cache_hits', 'gauge', 'Hits of the payload and query caches.')
+metrics.describe('graph_cache_misses', 'gauge', 'Misses of the payload and query caches.')
+metrics.describe('graph_cache_evictions', 'gauge', 'Evictions of the payload and query caches.')
+
+def observePhase(phase, seconds):
+    metrics.observe('graph_phase_seconds', seconds, phase=phase)
+
+jobs = JobPool(app.config['GRAPH_JOB_WORKERS'], observe=observePhase if metrics.enabled else None)
+atexit.register(jobs.close)
+poison_lists = ['InitialPoison', 'infected_nodes']
+restoring = threading.Lock()
+# The serialised answers of the read endpoints, for the current version of
+# every graph
+payloads = DG.QueryCache(app.config['GRAPH_PAYLOAD_CACHE'], per_component=False)
+payloads_lock = threading.Lock()
+# The stacks sampled from the requests asking for a profile, by profile id
+profiles = OrderedDict()
+profiles_lock = threading.Lock()
 
 class ServerSentEvent(object):
     def __init__(self, data, event_id=0):
@@ -16,106 +86,760 @@ class ServerSentEvent(object):
         self.event = None
         self.event_id = event_id
         self.desc_map = {
-            self.data : 'data',
-            self.event : 'event',
-            self.event_id : 'id'
+            'data': self.data,
+            'event': self.event,
+            'id': self.event_id
         }
 
     def encode(self):
         if not self.data:
             return ''
         lines = []
-        new_V = [(key,len(self.data.neighbours[key])) for key in self.data.V & self.data.neighbours.keys()]
-        graph_map = {
-            str([list(row) for row in new_V]): 'new_V',
-            str([list(row) for row in self.data.E]): 'E',
-            str(self.data.Principals): 'Principals',
-            str(self.data.deletedNodes): 'deletedNodes',
-            str(self.data.InitialPoison): 'InitialPoison',
-            str(self.data.infected_nodes): 'infected_nodes'
-        }
         for k, v in self.desc_map.items():
-            if v == 'data':
-                header = '%s:{' % v
-                body = []
-                for m, n in graph_map.items():
-                    body.append('"%s":%s' % (n, m))
-                lines.append(header + ','.join(body) + '}')
-            elif k:
-                lines.append('%s: %s' % (v, k))
+            if k == 'data':
+                lines.append('data:%s' % encodeFrame(v))
+            elif v:
+                lines.append('%s: %s' % (k, v))
         return '%s\n\n' % '\n'.join(lines)
 
+def keyframe(graph, graph_id):
+    u"""Returns the whole graph as int32 columns with the journal cursor it
+        was taken at, so the client can ask for deltas from there. A graph
+        laid out has the positions of the nodes (x, y)."""
+    columns = graph.getColumns()
+    positions = graph.getPositions(columns['V'])
+    if positions is not None:
+        columns['x'], columns['y'] = positions[:, 0], positions[:, 1]
+    for key in poison_lists + ['Principals']:
+        columns[key] = np.array(getattr(graph, key), dtype=np.int32)
+    return {'type': 'keyframe', 'graph': graph_id, 'cursor': graph.getCursor(),
+            'deletedNodes': graph.deletedNodes, 'columns': columns}
+
+def delta(graph, graph_id, changes, sent):
+    u"""Returns the changes of the graph since the client cursor as int32
+        columns. The poison lists are sent as the items added and removed
+        since the last event of the stream, or in full (reset) on the first
+        one. A graph laid out has the positions of the added nodes (add_x,
+        add_y) and of the other nodes moved (move_V, move_x, move_y)."""
+    columns = {
+        'del_V': changes['del_V'],
+        'add_V': changes['add_V'][:, 0], 'add_degrees': changes['add_V'][:, 1],
+        'del_src': changes['del_E'][:, 0], 'del_tgt': changes['del_E'][:, 1],
+        'add_src': changes['add_E'][:, 0], 'add_tgt': changes['add_E'][:, 1],
+        'deg_V': changes['degrees'][:, 0], 'deg_values': changes['degrees'][:, 1],
+        'Principals': np.array(graph.Principals, dtype=np.int32),
+    }
+    positions = graph.getPositions(changes['add_V'][:, 0])
+    if positions is not None:
+        columns['add_x'], columns['add_y'] = positions[:, 0], positions[:, 1]
+        moved = graph.getPositions(changes['moved'])
+        columns['move_V'], columns['move_x'], columns['move_y'] = changes['moved'], moved[:, 0], moved[:, 1]
+    reset = []
+    for key in poison_lists:
+        current = np.unique(np.array(getattr(graph, key), dtype=np.int32))
+        if key not in sent:
+            reset.append(key)
+            sent[key] = np.empty(0, dtype=np.int32)
+        columns[key + '_add'] = np.setdiff1d(current, sent[key], assume_unique=True)
+        columns[key + '_del'] = np.setdiff1d(sent[key], current, assume_unique=True)
+        sent[key] = current
+    return {'type': 'delta', 'graph': graph_id, 'cursor': changes['cursor'],
+            'since': changes['since'], 'deletedNodes': graph.deletedNodes, 'reset': reset,
+            'columns': columns}
+
+def changeSize(changes):
+    return sum(len(value) for key, value in changes.items() if key not in ('cursor', 'since'))
+
+def graphFrame(graph, graph_id, cursor, sent):
+    u"""Returns a delta since the client cursor, or a keyframe when there is
+        no cursor, its records are gone or the delta is bigger than the
+        graph. sent keeps the poison lists the client has."""
+    changes = None if cursor is None else graph.getMutations(cursor)
+    if changes is None or changeSize(changes) > len(graph.V) + len(graph.E):
+        frame = keyframe(graph, graph_id)
+        sent.clear()
+        sent.update((key, np.unique(frame['columns'][key])) for key in poison_lists)
+        return frame
+    return delta(graph, graph_id, changes, sent)
+
+def detailFrame(graph, graph_id, budget):
+    u"""Returns the LevelOfDetail view of a graph in budget nodes: the nodes
+        and super-nodes shown and the edges between them with their counts,
+        and their positions in a graph laid out. The poison lists are cut to
+        the nodes shown, with the number of the others in every super-node
+        (key_super)."""
+    lod = graph.getLevelOfDetail(budget, app.config['GRAPH_LOD_SMALL'])
+    columns = dict(lod.view())
+    for key in poison_lists + ['Principals']:
+        columns[key], columns[key + '_super'] = lod.count(getattr(graph, key))
+    return {'type': 'lod', 'graph': graph_id, 'cursor': graph.getCursor(), 'budget': budget,
+            'nodes': len(graph.V), 'deletedNodes': graph.deletedNodes, 'columns': columns}
+
+def viewFrame(graph, graph_id, cursor, sent, budget):
+    u"""Returns the frame of a graph for a client drawing up to budget nodes:
+        the LevelOfDetail view of a bigger graph, else a delta or a keyframe,
+        see graphFrame. A budget of 0 or None always sends the whole graph."""
+    if budget and len(graph.V) > budget:
+        sent.clear()
+        return detailFrame(graph, graph_id, budget)
+    return graphFrame(graph, graph_id, cursor, sent)
+
+def packColumn(values):
+    return np.ascontiguousarray(values, dtype='<i4').tobytes()
+
+def encodeFrame(frame):
+    u"""Returns a frame as JSON with every column packed as base64 of
+        little-endian int32, for SSE events and JSON responses."""
+    body = dict((key, value) for key, value in frame.items() if key != 'columns')
+    body['encoding'] = 'int32-base64'
+    body['columns'] = dict((key, base64.b64encode(packColumn(value)).decode('ascii'))
+                           for key, value in frame['columns'].items())
+    return json.dumps(body, separators=(',', ':'))
+
+def binaryFrame(frame):
+    u"""Returns a frame as one binary buffer: a little-endian uint32 header
+        length, the JSON header padded to 4 bytes, then every column as
+        packed little-endian int32 in the order listed by the header."""
+    body = dict((key, value) for key, value in frame.items() if key != 'columns')
+    body['columns'] = [[key, len(value)] for key, value in frame['columns'].items()]
+    header = json.dumps(body, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 4)
+    return b''.join([struct.pack('<I', len(header)), header] +
+                    [packColumn(value) for value in frame['columns'].values()])
+
 @app.route('/')
 def get_index():
     return render_template('index.html')
 
+def validId(graph_id):
+    u"""Returns True if a graph id has the form of the ids we hand out."""
+    return re.fullmatch('[0-9a-f]+', graph_id or '') is not None
+
+def logPath(graph_id):
+    u"""Returns the path of the mutation log of a graph, or None if graphs
+        are not logged or the id is not one we hand out."""
+    if app.config['GRAPH_LOG_DIR'] is None or not validId(graph_id):
+        return None
+    return os.path.join(app.config['GRAPH_LOG_DIR'], '%s.log' % graph_id)
+
+def openLog(graph, graph_id, seq=0):
+    path = logPath(graph_id)
+    if path is not None:
+        graph.logMutations(DG.MutationLog(path, seq))
+
+def removeLog(graph_id):
+    path = logPath(graph_id)
+    for name in ([] if path is None else [path, path + '.snap']):
+        if os.path.exists(name):
+            os.remove(name)
+
+def register(graph, graph_id):
+    u"""Registers a graph of this worker, caching its repeated queries and
+        keeping its statistics."""
+    if app.config['GRAPH_QUERY_CACHE']:
+        graph.cacheQueries(app.config['GRAPH_QUERY_CACHE'])
+    if metrics.enabled:
+        graph.timePhases(observePhase)
+    graph.trackStats()
+    graphs.add(graph, graph_id)
+
+def held(graph_id):
+    return graph_id in graphs or (shared is not None and shared.current(graph_id) is not None)
+
+def restore(graph_id):
+    u"""Rebuild a graph held by no worker from its mutation log, after a
+        restart or the loss of the worker that held it."""
+    path = logPath(graph_id)
+    if path is None or held(graph_id) or not os.path.exists(path + '.snap'):
+        return
+    with restoring, (shared.lock(graph_id) if shared is not None else nullcontext()):
+        if held(graph_id):
+            return
+        log = DG.MutationLog(path)
+        graph = log.restore(PoisonGraph)
+        if graph is None:
+            log.close()
+            return
+        register(graph, graph_id)
+        if shared is not None:
+            shared.publish(graph_id, graph)
+
+def exists(graph_id):
+    restore(graph_id)
+    return held(graph_id)
+
+def compact(graph):
+    if graph.log is not None and graph.log.size() > app.config['GRAPH_LOG_COMPACT']:
+        graph.log.compact(graph)
+
+def latest(graph_id):
+    u"""Returns True if this worker holds the latest state of a graph."""
+    if graph_id not in graphs:
+        return False
+    return shared is None or shared.current(graph_id) is None or shared.owns(graph_id)
+
+def changing(graph_id):
+    u"""Returns True if a job of this worker or another worker is changing
+        a graph."""
+    return jobs.busy(graph_id) or (shared is not None and shared.claimed(graph_id))
+
+@contextmanager
+def writable(graph_id):
+    u"""Returns a context of the registry entry of a graph for a change. With
+        shared memory the change claims the graph, so the other workers
+        answer it is busy, a worker that is not the owner first rebuilds the
+        graph from the shared snapshot, and the graph is published when done
+        if it changed. The graph lock is only held to claim, rebuild and
+        publish it. A graph gone from every worker is rebuilt from its
+        mutation log, and the log is compacted once it is over
+        GRAPH_LOG_COMPACT bytes. Raises KeyError if the graph is gone, and
+        GraphBusy if another worker is changing it."""
+    restore(graph_id)
+    if shared is None:
+        with graphs.checkout(graph_id) as entry:
+            try:
+                yield entry
+            finally:
+                with entry.lock:
+                    compact(entry.graph)
+        return
+    with shared.lock(graph_id):
+        if not shared.claim(graph_id):
+            raise GraphBusy(graph_id)
+        try:
+            if not latest(graph_id) and shared.current(graph_id) is not None:
+                graphs.remove(graph_id)
+                snapshot = shared.attach(graph_id)
+                graph = PoisonGraph.fromSnapshot(snapshot)
+                openLog(graph, graph_id, snapshot.meta['log_seq'] or 0)
+                register(graph, graph_id)
+        except BaseException:
+            shared.release(graph_id)
+            raise
+    try:
+        with graphs.checkout(graph_id) as entry:
+            with entry.lock:
+                tag = entry.graph.getTag()
+            try:
+                yield entry
+            finally:
+                with entry.lock:
+                    compact(entry.graph)
+                    changed = entry.graph.getTag() != tag
+                with shared.lock(graph_id), entry.lock:
+                    if changed or shared.current(graph_id) is None:
+                        shared.publish(graph_id, entry.graph)
+    finally:
+        with shared.lock(graph_id):
+            shared.release(graph_id)
+
+@contextmanager
+def readable(graph_id):
+    u"""Returns a context of a graph for reading: the local graph when this
+        worker owns it, else the read-only snapshot shared by the owner.
+        Raises KeyError if the graph is gone."""
+    restore(graph_id)
+    if latest(graph_id):
+        with graphs.checkout(graph_id) as entry, entry.lock:
+            yield entry.graph
+        return
+    if shared is None:
+        raise KeyError(graph_id)
+    snapshot = shared.attach(graph_id)
+    if snapshot is None:
+        raise KeyError(graph_id)
+    yield snapshot
+
+def conditional(graph_id, graph, query, build, mimetype=None):
+    u"""Returns the answer of a read endpoint for a graph, with an ETag of
+        the graph id and version: a 304 when the client sends the ETag in
+        If-None-Match, else the payload built once per version.
+        :param query: the endpoint and the arguments of the payload.
+        :param build: the function serialising the payload."""
+    tag = '%s-%s' % (graph_id, graph.getTag())
+    if request.if_none_match.contains(tag):
+        response = Response(status=304)
+    else:
+        key = (graph_id,) + query
+        with payloads_lock:
+            payload = payloads.get(key, tag)
+        if payload is None:
+            with metrics.timer('graph_phase_seconds', phase='payload'):
+                payload = build()
+            with payloads_lock:
+                payloads.put(key, tag, payload)
+        response = Response(payload, mimetype=mimetype)
+    response.set_etag(tag)
+    # Browsers keep the answer but check the ETag before using it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def lodBudget():
+    u"""Returns the node budget of the client: ?budget=, else
+        GRAPH_LOD_BUDGET."""
+    budget = request.args.get('budget', app.config['GRAPH_LOD_BUDGET'], type=int)
+    if budget is not None and budget < 0:
+        abort(400, {'message': 'The Budget Should Be A Positive Number Of Nodes.'})
+    return budget
+
+def missing():
+    abort(404, {'message': 'Your Graph Is Empty. Generate A Graph First!'})
+
+def busy():
+    abort(409, {'message': 'Your Graph Is Busy. Wait For It Or Cancel It First!'})
+
+def create(graph_id, node_num):
+    u"""Generates a new graph of node_num nodes in the job pool and
+        registers it under graph_id."""
+    with jobs.start(graph_id, 'create', node_num=node_num, layout=app.config['GRAPH_LAYOUT']) as job:
+        graph = None
+        for kind, value, _ in job.messages():
+            if kind == 'graph':
+                graph = PoisonGraph.fromSnapshot(DG.GraphSnapshot(*value))
+    if graph is None:
+        # Cancelled before the graph was made
+        raise KeyError(graph_id)
+    graph.trackMutations()
+    register(graph, graph_id)
+    openLog(graph, graph_id)
+    if graph.log is not None:
+        graph.log.compact(graph)
+
+@contextmanager
+def graphJob(entry, kind, replace=False, **params):
+    u"""Returns a context of a job of a kind running in the pool on a copy
+        of the graph of an entry. Raises GraphBusy if the graph has a job,
+        unless replace cancels it."""
+    if replace:
+        for job in jobs.running(entry.graph_id):
+            job.cancel()
+        while jobs.busy(entry.graph_id):
+            time.sleep(0.01)
+    with entry.lock:
+        state = entry.graph._exportArrays()
+    with jobs.start(entry.graph_id, kind, state, **params) as job:
+        yield job
+
+def applied(entry, job):
+    u"""Returns an iterator of the step values of a job, applying the
+        changes of every step to the graph of the entry first."""
+    for kind, value, records in job.messages():
+        if records:
+            with entry.lock:
+                entry.graph.applyRecords(records)
+        if kind == 'step':
+            yield value
+
+def eventId(graph_id, x, cursor):
+    return '%s:%d:%s' % (graph_id, x, cursor)
+
+def relay(events, stream):
+    u"""Returns an iterator of the text of the ServerSentEvents of a stream,
+        measuring the encoding and the bytes of every event, the time the
+        server takes to send it and the streams in flight."""
+    metrics.inc('graph_streams_in_flight', 1, stream=stream)
+    try:
+        for event in events:
+            with metrics.timer('graph_phase_seconds', phase='encode'):
+                text = event.encode()
+            metrics.observe('graph_sse_event_bytes', len(text), stream=stream)
+            start = time.perf_counter()
+            yield text
+            metrics.observe('graph_phase_seconds', time.perf_counter() - start, phase='send')
+    finally:
+        metrics.inc('graph_streams_in_flight', -1, stream=stream)
+
+def lastEvent():
+    u"""Returns the (graph id, progress, cursor) of the Last-Event-ID sent by
+        a reconnecting EventSource, or None."""
+    match = re.fullmatch(r'([0-9a-f]+):(\d+):(\d+)', request.headers.get('Last-Event-ID', ''))
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2)), int(match.group(3))
+
 @app.route('/api/<string:action_type>/<int:node_number>')
 def generate(action_type, node_number):
-    def gen():
+    u"""Streams the graph as it is generated or grown. A reconnecting
+        EventSource resumes the stream of its Last-Event-ID: the graph is
+        not made again and it gets the changes since its cursor."""
+    graph_id = request.args.get('graph')
+    cursor = request.args.get('cursor', type=int)
+    resume = lastEvent()
+    if resume is not None:
+        graph_id, x, cursor = resume
+        if not exists(graph_id):
+            missing()
+    elif action_type in ['add_nodes', 'add_poison']:
+        if not exists(graph_id):
+            missing()
+        if changing(graph_id):
+            busy()
+        x = 0
+    else: #action_type in ['new_graph']:
+        if graph_id is not None and not validId(graph_id):
+            abort(400, {'message': 'Unknown Graph Id.'})
+        if graph_id is not None:
+            graphs.remove(graph_id)
+            if shared is not None:
+                shared.discard(graph_id)
+            removeLog(graph_id)
+        x = int(node_number * 0.1)
+        graph_id, cursor = secrets.token_hex(8), None
+    budget = lodBudget()
+
+    def gen(x, cursor):
+        # The work runs in the job pool: this only relays its steps, and
+        # closing the stream cancels the job
+        sent = {}
         try:
-            if action_type in ['add_nodes', 'add_poison']:
-                graph = graph_gen.get(None)
-                graph.InitialPoison.clear()
-                graph.infected_nodes.clear()
-                x = 0
-            else: #action_type in ['new_graph']:
-                graph_gen.queue.clear()
-                x = int(node_number * 0.1)
-                graph = PoisonGraph(node_num=x, edge_num=x * 10)
-            interval = int(node_number * 0.1)
-            while x < node_number:
-                if x + interval >= node_number:
-                    interval = node_number - x
-                if action_type in ['new_graph', 'add_nodes']:
-                    graph.addDynamic(interval, interval * 10)
-                elif len(graph.InitialPoison) < node_number:
-                    graph.addPoison(interval)
-                x += interval
-                ev = ServerSentEvent(graph, x)
-                yield ev.encode()
-                graph_gen.put(graph)
-        except queue.Empty:
-            raise StopIteration
-        except GeneratorExit:
-            graph_gen.queue.clear()
-    return Response(gen(), mimetype="text/event-stream")
+            if action_type == 'new_graph' and resume is None:
+                create(graph_id, x)
+            with writable(graph_id) as entry, \
+                    graphJob(entry, action_type, replace=resume is not None, node_number=node_number, x=x,
+                             reset=action_type != 'new_graph' and resume is None) as job:
+                for x in applied(entry, job):
+                    with entry.lock, metrics.timer('graph_phase_seconds', phase='frame'):
+                        frame = viewFrame(entry.graph, graph_id, cursor, sent, budget)
+                    frame['job'] = job.job_id
+                    cursor = frame['cursor']
+                    graphs.measure(entry)
+                    yield ServerSentEvent(frame, eventId(graph_id, x, cursor))
+        except (KeyError, GraphBusy):
+            return
+    return Response(relay(gen(x, cursor), action_type), mimetype="text/event-stream")
 
 @app.route('/api/scan/<int:node_number>', methods=['POST'])
 def scan(node_number):
+    u"""Scans the graph for the node_number Principals and returns the graph,
+        or its view in ?budget= nodes. A scan of a graph unchanged since the
+        same scan is not made again, and is a 304 for a client with the ETag
+        of the graph."""
+    budget = lodBudget()
+    try:
+        with writable(request.args.get('graph')) as entry:
+            with entry.lock:
+                scanned = entry.graph.lastScan(node_number) is not None
+            if not scanned:
+                with graphJob(entry, 'scan', node_number=node_number) as job:
+                    for result in applied(entry, job):
+                        with entry.lock:
+                            entry.graph.rememberScan(node_number, result)
+            with entry.lock:
+                return conditional(entry.graph_id, entry.graph, ('view', budget),
+                                   lambda: encodeFrame(viewFrame(entry.graph, entry.graph_id, None, {}, budget)))
+    except KeyError:
+        missing()
+    except GraphBusy:
+        busy()
+
+@app.route('/api/evaluate', methods=['POST'])
+def evaluate():
+    u"""Scores candidate removal sets of poison nodes without changing the
+        graph. The body is {"candidates": [[node, ...], ...]} and the answer
+        has the nodes infected now and after removing every set."""
+    body = request.get_json(silent=True) or {}
+    candidates = body.get('candidates')
+    if not isinstance(candidates, list) or not all(isinstance(nodes, list) and
+                                                   all(isinstance(v, int) for v in nodes)
+                                                   for nodes in candidates):
+        abort(400, {'message': 'Candidates Should Be Lists Of Nodes.'})
     try:
-        graph = graph_gen.get(None)
-        graph.scanPoison(node_number)
-        graph_gen.put(graph)
-    except queue.Empty:
-        abort(404, {'message': 'Your Graph Is Empty. Generate A Graph First!'})
-    return json.dumps(graph.__contains__(poison_map))
+        with readable(request.args.get('graph')) as graph:
+            infected = scoreRemovals(graph, [[]] + candidates)
+    except KeyError:
+        missing()
+    return json.dumps({'infected': int(infected[0]), 'candidates': infected[1:].tolist(),
+                       'result': 200})
+
+def spreadParams(model):
+    u"""Returns the simulator arguments of the query string, or a 400."""
+    beta = request.args.get('beta', 0.1, type=float)
+    gamma = request.args.get('gamma', 0.05, type=float)
+    steps = request.args.get('steps', 100, type=int)
+    runs = request.args.get('runs', 64, type=int)
+    if model not in SpreadSimulator.models:
+        abort(400, {'message': 'The Model Should Be One Of %s.' % ', '.join(SpreadSimulator.models)})
+    if not (0 <= beta <= 1 and 0 <= gamma <= 1):
+        abort(400, {'message': 'Beta And Gamma Should Be Between 0 And 1.'})
+    if not (0 < steps <= app.config['GRAPH_SPREAD_MAX_STEPS'] and 0 < runs <= app.config['GRAPH_SPREAD_MAX_RUNS']):
+        abort(400, {'message': 'Up To %d Steps And %d Runs.' % (app.config['GRAPH_SPREAD_MAX_STEPS'],
+                                                                 app.config['GRAPH_SPREAD_MAX_RUNS'])})
+    return {'model': model, 'beta': beta, 'gamma': gamma, 'steps': steps, 'runs': runs,
+            'seed': request.args.get('seed', type=int)}
+
+@contextmanager
+def snapshotSource(graph_id):
+    u"""Returns a context of the source pool processes map a graph from:
+        its shared memory snapshot, else a snapshot file removed when done.
+        Raises KeyError if the graph is gone."""
+    if shared is not None and shared.current(graph_id) is not None:
+        yield ('shared', graph_id)
+        return
+    handle, path = tempfile.mkstemp(suffix='.snap')
+    os.close(handle)
+    try:
+        with readable(graph_id) as graph:
+            graph.save(path)
+        yield ('file', path)
+    finally:
+        os.remove(path)
+
+def spreadSteps(batches):
+    u"""Returns an iterator of the step values of jobs running batches of
+        runs, merged step by step, and whether the first batch took the
+        step. A batch that stopped early keeps its last counts."""
+    streams = [(value for kind, value, _ in job.messages() if kind == 'step') for job in batches]
+    last = [None] * len(streams)
+    while True:
+        values = [next(stream, None) for stream in streams]
+        if all(value is None for value in values):
+            return
+        last = [last[i] if value is None else value for i, value in enumerate(values)]
+        yield last, values[0] is not None
+
+@app.route('/api/simulate/<string:model>')
+def simulate(model):
+    u"""Streams an epidemic spreading from the initial poison nodes of the
+        graph, in the SI, SIR or SIS model with the ?beta= transmission and
+        ?gamma= recovery probabilities, for ?steps= steps of ?runs= runs.
+        The runs are split in batches over the job pool, and every event has
+        the infected and recovered counts of every run after a step and the
+        nodes infected and recovered in the first run. The graph does not
+        change."""
+    params = spreadParams(model)
+    graph_id = request.args.get('graph')
+    if not exists(graph_id):
+        missing()
+    runs = params.pop('runs')
+    seed = params.pop('seed')
+    sizes = [len(batch) for batch in np.array_split(np.arange(runs), min(runs, jobs.capacity()))]
+
+    def gen():
+        try:
+            with snapshotSource(graph_id) as source, ExitStack() as stack:
+                batches = [stack.enter_context(jobs.start(graph_id, 'simulate', source, runs=size, trace=i == 0,
+                                                          seed=None if seed is None else seed + i, **params))
+                           for i, size in enumerate(sizes)]
+                frame = None
+                for values, first in spreadSteps(batches):
+                    infected = np.concatenate([value['infected'] for value in values])
+                    recovered = np.concatenate([value['recovered'] for value in values])
+                    frame = {'type': 'spread', 'graph': graph_id, 'model': model, 'runs': runs,
+                             'step': max(value['step'] for value in values), 'done': False,
+                             'jobs': [job.job_id for job in batches],
+                             'mean_infected': float(infected.mean()), 'mean_recovered': float(recovered.mean()),
+                             'columns': {'infected': infected, 'recovered': recovered,
+                                         'new_infected': values[0]['new_infected'] if first else [],
+                                         'new_recovered': values[0]['new_recovered'] if first else []}}
+                    yield ServerSentEvent(frame, 'spread:%d' % frame['step'])
+                if frame is not None:
+                    frame['done'] = True
+                    frame['columns']['new_infected'] = frame['columns']['new_recovered'] = []
+                    yield ServerSentEvent(frame, 'spread:%d' % frame['step'])
+        except KeyError:
+            return
+    return Response(relay(gen(), 'simulate'), mimetype="text/event-stream")
 
 @app.route('/api/delete', methods=['POST'])
 def delete():
+    budget = lodBudget()
+    try:
+        with writable(request.args.get('graph')) as entry:
+            with entry.lock:
+                if not entry.graph.Principals and not entry.graph.V:
+                    abort(404, {'message': 'Your Graph Is Empty.'})
+            with graphJob(entry, 'delete') as job:
+                for _ in applied(entry, job):
+                    pass
+            with entry.lock:
+                return encodeFrame(viewFrame(entry.graph, entry.graph_id, None, {}, budget))
+    except KeyError:
+        missing()
+    except GraphBusy:
+        busy()
+
+@app.route('/api/layout', methods=['POST'])
+def layout():
+    u"""Lays the graph out again from scratch in the job pool and returns
+        it, or its view in ?budget= nodes. Nodes added later keep being
+        placed next to the others."""
+    budget = lodBudget()
+    try:
+        with writable(request.args.get('graph')) as entry:
+            with graphJob(entry, 'layout') as job:
+                for _ in applied(entry, job):
+                    pass
+            with entry.lock:
+                return encodeFrame(viewFrame(entry.graph, entry.graph_id, None, {}, budget))
+    except KeyError:
+        missing()
+    except GraphBusy:
+        busy()
+
+@app.route('/api/jobs/<string:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    u"""Cancels a job of this worker. It stops after its current step."""
+    try:
+        jobs.get(job_id).cancel()
+    except KeyError:
+        abort(404, {'message': 'No Such Job.'})
+    return json.dumps({'result': 200})
+
+@app.route('/api/graph')
+def fetch_graph():
+    u"""Returns the graph of ?graph= as a binary frame: the changes since
+        ?cursor= when they are still kept, else the whole graph, or its view
+        in ?budget= nodes. The answer has an ETag of the graph version, see
+        conditional."""
+    graph_id = request.args.get('graph')
+    cursor = request.args.get('cursor', type=int)
+    budget = lodBudget()
+    try:
+        with readable(graph_id) as graph:
+            return conditional(graph_id, graph, ('graph', cursor, budget),
+                               lambda: binaryFrame(viewFrame(graph, graph_id, cursor, {}, budget)),
+                               'application/octet-stream')
+    except KeyError:
+        missing()
+
+@app.route('/api/expand/<int(signed=True):super_id>')
+def expand(super_id):
+    u"""Returns a page of the nodes of a super-node of the view of ?graph=
+        in ?budget= nodes from ?offset=, with all their edges and the ids
+        their ends are shown with in the view, see LevelOfDetail.expand. The
+        page has up to ?limit= nodes, the budget by default, and next is the
+        offset of the following page, null after the last. The answer has an
+        ETag of the graph version, see conditional."""
+    graph_id = request.args.get('graph')
+    budget = lodBudget()
+    offset = request.args.get('offset', 0, type=int)
+    if not budget or offset < 0:
+        abort(400, {'message': 'Expanding Needs A Budget And A Positive Offset.'})
+    limit = max(1, min(request.args.get('limit', budget, type=int), budget))
+
+    def build():
+        lod = graph.getLevelOfDetail(budget, app.config['GRAPH_LOD_SMALL'])
+        try:
+            columns, following = lod.expand(super_id, offset, limit)
+        except KeyError:
+            abort(404, {'message': 'No Such Super-Node.'})
+        for key in poison_lists + ['Principals']:
+            columns[key] = np.intersect1d(np.array(getattr(graph, key), dtype=np.int64), columns['V'])
+        return encodeFrame({'type': 'expand', 'graph': graph_id, 'cursor': graph.getCursor(), 'super': super_id,
+                            'offset': offset, 'next': following, 'columns': columns})
+    try:
+        with readable(graph_id) as graph:
+            return conditional(graph_id, graph, ('expand', budget, super_id, offset, limit), build,
+                               'application/json')
+    except KeyError:
+        missing()
+
+def cacheStats():
+    u"""Returns the counters of the payload cache and the summed counters of
+        the query caches of the graphs of this worker."""
+    with payloads_lock:
+        cached = payloads.stats()
+    with graphs.lock:
+        caches = [entry.graph.cache for entry in graphs.entries.values() if entry.graph.cache is not None]
+    queries = {}
+    for cache in caches:
+        for key, value in cache.stats().items():
+            queries[key] = queries.get(key, 0) + value
+    return {'payloads': cached, 'queries': queries}
+
+@metrics.collect
+def collectGraphs(metrics):
+    registry = graphs.stats()
+    with graphs.lock:
+        kept = [entry.graph for entry in graphs.entries.values()]
+    metrics.set('graph_graphs', registry['graphs'])
+    metrics.set('graph_graph_bytes', registry['bytes'])
+    metrics.set('graph_nodes', sum(len(graph.V) for graph in kept))
+    metrics.set('graph_edges', sum(len(graph.E) for graph in kept))
+    metrics.set('graph_jobs', len(jobs.jobs))
+    for cache, counters in cacheStats().items():
+        for key in ('hits', 'misses', 'evictions'):
+            metrics.set('graph_cache_' + key, counters.get(key, 0), cache=cache)
+
+@app.before_request
+def startRequest():
+    g.started = time.perf_counter()
+    if app.config['GRAPH_PROFILE'] and request.headers.get('X-Graph-Profile'):
+        g.profiler = SamplingProfiler(interval=app.config['GRAPH_PROFILE_INTERVAL']).start()
+
+@app.after_request
+def endRequest(response):
+    u"""Counts and times a request once its answer is sent, streams
+        included, and keeps the profile it asked for with the X-Graph-Profile
+        header. The answer has the id of the profile in that header."""
+    profiler = g.pop('profiler', None)
+    if not metrics.enabled and profiler is None:
+        return response
+    endpoint, status, started = request.endpoint or 'unknown', response.status_code, g.get('started')
+    profile_id = None
+    if profiler is not None:
+        profile_id = secrets.token_hex(8)
+        response.headers['X-Graph-Profile'] = profile_id
+
+    def closed():
+        metrics.inc('graph_requests_total', endpoint=endpoint, status=status)
+        if started is not None:
+            metrics.observe('graph_request_seconds', time.perf_counter() - started, endpoint=endpoint)
+        if profiler is not None:
+            with profiles_lock:
+                profiles[profile_id] = profiler.stop()
+                while len(profiles) > app.config['GRAPH_PROFILES']:
+                    profiles.popitem(last=False)
+    response.call_on_close(closed)
+    return response
+
+@app.route('/metrics')
+def get_metrics():
+    u"""Returns the metrics of this worker in the Prometheus text format."""
+    if not metrics.enabled:
+        abort(404, {'message': 'Metrics Are Off.'})
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profile/<string:profile_id>')
+def get_profile(profile_id):
+    u"""Returns the stacks sampled from a request sent with the
+        X-Graph-Profile header, in the folded format of flame graphs, once
+        its answer is sent."""
+    with profiles_lock:
+        profiler = profiles.get(profile_id)
+    if profiler is None:
+        abort(404, {'message': 'No Such Profile.'})
+    response = Response(profiler.folded(), mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(profiler.samples)
+    response.headers['X-Profile-Seconds'] = '%.3f' % profiler.elapsed
+    return response
+
+@app.route('/api/stats')
+def stats():
+    u"""Returns the statistics of the graph of ?graph=, kept up to date as
+        it changes, with an ETag of its version, see conditional. Without a
+        graph it returns the counters of the graphs, jobs and caches of this
+        worker."""
+    graph_id = request.args.get('graph')
+    if graph_id is None:
+        return json.dumps(dict(cacheStats(), graphs=graphs.stats(), jobs=len(jobs.jobs), result=200))
     try:
-        graph = graph_gen.get(None)
-        if graph.Principals:
-            graph.delPoisonFrom(graph.Principals)
-            graph.Principals.clear()
-        elif graph.V:
-            delNum = random.randint(1, int(len(graph.V)))
-            delNodes = random.sample(graph.V, delNum)
-            graph.delNodesFrom(delNodes)
-            graph_gen.put(graph)
-        else:
-            raise Exception
-    except queue.Empty:
-        abort(404, {'message': 'Your Graph Is Empty. Generate A Graph First!'})
-    except Exception:
-        abort(404, {'message': 'Your Graph Is Empty.'})
-    return json.dumps(graph.__contains__(poison_map))
+        with readable(graph_id) as graph:
+            return conditional(graph_id, graph, ('stats',),
+                               lambda: json.dumps(dict(graph.getStats(), result=200)), 'application/json')
+    except KeyError:
+        missing()
 
+@app.errorhandler(400)
 @app.errorhandler(404)
+@app.errorhandler(409)
 def error_handler(error):
     if 'message' in error.description:
-        return json.dumps({'message': error.description['message'], 'result': error.code})
+        message = error.description['message']
     else:
-        return json.dumps({'message': error.description, 'result': error.code })
+        message = error.description
+    return (json.dumps({'message': message, 'result': error.code}), error.code,
+            {'Content-Type': 'application/json'})
 
 if __name__ == '__main__':
     app.run(port=8080,debug=True)
\ No newline at end of file
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+u"""Headless benchmarks of the hot paths of the graphs over a ladder of node
+counts and gamma values, with fixed seeds. Every case builds a PoisonGraph
+and runs the operations on it in order, once timed and once more under
+tracemalloc for the peak memory of every operation. The results are saved
+as JSON and compared with a stored baseline, and the growth of every
+operation from one size to the next is checked for superlinear cliffs.
+
+    python -m src.benchmark --sizes 1000,10000 --output results.json
+    python -m src.benchmark --save-baseline
+
+Without --baseline the results are compared with src/benchmark_baseline.json
+when it exists. It exits with 1 when an operation regressed or scales badly.
+"""
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from src.DynamicGraph.DynamicGraph import ForceLayout
+from src.PoisonGrapn import PoisonGraph
+from src.app import ServerSentEvent, keyframe
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+def _build(nodes, gamma, options):
+    graph = PoisonGraph(nodes, nodes * 10, poison_number=max(nodes // 100, 1), gamma=gamma,
+                        engine=options.engine, storage=options.storage)
+    if options.tracked:
+        graph.trackMutations()
+        graph.cacheQueries()
+        graph.trackStats()
+    return graph
+
+
+def _bfsearch(graph, nodes, options):
+    graph.bfsearch(max(graph.getComponents(), key=len, default=graph.V)[0])
+
+
+def _encode(graph, nodes, options):
+    ServerSentEvent(keyframe(graph, 'benchmark'), 1).encode()
+
+
+# The operations of a case in the order they run, each given the graph
+# built by 'construct'
+operations = [
+    ('construct', None),
+    ('bfsearch', _bfsearch),
+    ('scanPoison', lambda graph, nodes, options: graph.scanPoison(10)),
+    ('encode', _encode),
+    ('updateComponents', lambda graph, nodes, options: graph.updateComponents()),
+    ('addPoison', lambda graph, nodes, options: graph.addPoison(max(nodes // 100, 1))),
+    ('addDynamic', lambda graph, nodes, options: graph.addDynamic(max(nodes // 10, 1), nodes)),
+    ('delNodesFrom', lambda graph, nodes, options: graph.delNodesFrom(random.sample(graph.V, max(nodes // 100, 1)))),
+    ('delPoisonFrom', lambda graph, nodes, options: graph.delPoisonFrom(graph.Principals)),
+    ('trackLayout', lambda graph, nodes, options: graph.trackLayout(ForceLayout(seed=options.seed))),
+]
+
+
+def runCase(nodes, gamma, options, memory=False, skip=()):
+    u"""Returns the seconds, or the peak bytes with memory, of every
+        operation of a case by name, None for a skipped one.
+        :param nodes: the number of nodes of the graph.
+        :param gamma: the gamma of the graph.
+        :param options: the parsed command line.
+        :param memory: measure the peak bytes instead of the seconds.
+        :param skip: the names of the operations not run.
+    """
+    random.seed(options.seed)
+    np.random.seed(options.seed)
+    measured = {}
+    graph = None
+    gc.collect()
+    for name, run in operations:
+        if name in skip or (graph is None and name != 'construct'):
+            measured[name] = None
+            continue
+        if memory:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        if run is None:
+            graph = _build(nodes, gamma, options)
+        else:
+            run(graph, nodes, options)
+        seconds = time.perf_counter() - start
+        if memory:
+            measured[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            measured[name] = seconds
+    return measured
+
+
+def runSuite(options, log=print):
+    u"""Returns the results of every case of the ladder as a list of dicts
+        of the operation, nodes, gamma, seconds and peak bytes. An operation
+        is not run on a size it would take longer than options.budget
+        seconds on, going by its growth over the smaller sizes.
+        :param options: the parsed command line.
+        :param log: the function printing the progress.
+    """
+    results = []
+    for gamma in options.gammas:
+        last = {}
+        for nodes in sorted(options.sizes):
+            skip = set(name for name, expected in
+                       ((name, _expected(points, nodes)) for name, points in last.items())
+                       if expected > options.budget)
+            seconds = runCase(nodes, gamma, options, skip=skip)
+            peaks = runCase(nodes, gamma, options, memory=True, skip=skip) if options.memory else {}
+            for name, _ in operations:
+                results.append({'op': name, 'nodes': nodes, 'gamma': gamma, 'seconds': seconds[name],
+                                'peak_bytes': peaks.get(name)})
+                if seconds[name] is not None:
+                    log('%-18s nodes=%-8d gamma=%-2d %9.4fs %10s' % (
+                        name, nodes, gamma, seconds[name],
+                        '' if peaks.get(name) is None else '%.1fMB' % (peaks[name] / 2 ** 20)))
+                    last.setdefault(name, []).append((nodes, seconds[name]))
+                else:
+                    log('%-18s nodes=%-8d gamma=%-2d skipped' % (name, nodes, gamma))
+    return results
+
+
+def _expected(points, nodes):
+    # The seconds on nodes growing at least linearly from the last two sizes
+    if len(points) < 2:
+        return points[-1][1] * nodes / points[-1][0]
+    (small, before), (large, after) = points[-2:]
+    slope = max(math.log(max(after, 1e-9) / max(before, 1e-9)) / math.log(large / small), 1.0)
+    return after * (nodes / large) ** slope
+
+
+def compare(results, baseline, threshold=1.5, memory_threshold=1.5, floor=0.05, memory_floor=1 << 20):
+    u"""Returns the regressions of the results against a baseline: the
+        operations at least threshold times slower and floor seconds slower,
+        or memory_threshold times and memory_floor bytes bigger.
+        :param results: the results of runSuite.
+        :param baseline: the results of a previous run.
+    """
+    base = dict(((r['op'], r['nodes'], r['gamma']), r) for r in baseline)
+    regressions = []
+    for result in results:
+        old = base.get((result['op'], result['nodes'], result['gamma']))
+        if old is None:
+            continue
+        for key, ratio, margin in (('seconds', threshold, floor), ('peak_bytes', memory_threshold, memory_floor)):
+            if result[key] is None or old[key] is None:
+                continue
+            if result[key] > old[key] * ratio and result[key] - old[key] > margin:
+                regressions.append(dict(result, metric=key, baseline=old[key],
+                                        ratio=result[key] / max(old[key], 1e-9)))
+    return regressions
+
+
+def scaling(results, max_slope=1.5, floor=0.05):
+    u"""Returns the operations growing faster than nodes ** max_slope from a
+        size to the next, once they take floor seconds.
+        :param results: the results of runSuite.
+    """
+    series = {}
+    for result in results:
+        if result['seconds'] is not None:
+            series.setdefault((result['op'], result['gamma']), []).append(result)
+    cliffs = []
+    for points in series.values():
+        points.sort(key=lambda r: r['nodes'])
+        for small, large in zip(points, points[1:]):
+            if large['seconds'] < floor:
+                continue
+            slope = math.log(large['seconds'] / max(small['seconds'], 1e-9)) / \
+                math.log(large['nodes'] / small['nodes'])
+            if slope > max_slope:
+                cliffs.append(dict(large, slope=slope, from_nodes=small['nodes']))
+    return cliffs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        type=lambda value: [int(v) for v in value.split(',')])
+    parser.add_argument('--gammas', default='2,3,4', type=lambda value: [int(v) for v in value.split(',')])
+    parser.add_argument('--engine', default='python', choices=['python', 'numpy'])
+    parser.add_argument('--storage', default='dict', choices=['dict', 'compact'])
+    parser.add_argument('--tracked', action='store_true',
+                        help='keep the journal, query cache and statistics as the app does')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--no-memory', dest='memory', action='store_false')
+    parser.add_argument('--budget', default=60.0, type=float,
+                        help='seconds after which an operation is not run on larger sizes')
+    parser.add_argument('--output', help='the JSON file of the results')
+    parser.add_argument('--baseline', default=default_baseline if os.path.exists(default_baseline) else None,
+                        help='the JSON file of the results to compare with')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the baseline instead of comparing with it')
+    parser.add_argument('--threshold', default=1.5, type=float)
+    parser.add_argument('--memory-threshold', default=1.5, type=float)
+    parser.add_argument('--max-slope', default=1.5, type=float)
+    options = parser.parse_args(argv)
+
+    results = runSuite(options)
+    report = {'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                       'machine': platform.machine(), 'engine': options.engine, 'storage': options.storage,
+                       'tracked': options.tracked, 'seed': options.seed, 'time': time.time()},
+              'results': results}
+    for path in (options.output, default_baseline if options.save_baseline else None):
+        if path:
+            with open(path, 'w') as handle:
+                json.dump(report, handle, indent=1)
+
+    failed = False
+    if options.baseline and not options.save_baseline:
+        with open(options.baseline) as handle:
+            baseline = json.load(handle)
+        if (baseline['meta']['engine'], baseline['meta']['storage']) != (options.engine, options.storage):
+            print('The baseline is of the %s engine and %s storage' % (baseline['meta']['engine'],
+                                                                       baseline['meta']['storage']))
+        for r in compare(results, baseline['results'], options.threshold, options.memory_threshold):
+            failed = True
+            print('REGRESSION %s nodes=%d gamma=%d %s %.4g -> %.4g (x%.2f)' % (
+                r['op'], r['nodes'], r['gamma'], r['metric'], r['baseline'], r[r['metric']], r['ratio']))
+    for r in scaling(results, options.max_slope):
+        failed = True
+        print('SCALING %s gamma=%d nodes %d -> %d grows as nodes ** %.2f' % (
+            r['op'], r['gamma'], r['from_nodes'], r['nodes'], r['slope']))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
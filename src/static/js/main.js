@@ -8,7 +8,7 @@ var dynamicGraph = {};
         },
         poison_graph: {
             required: ['dynamic_graph_p', 'dynamic_graph_x'],
-            buttons: ['generate-button', 'scan-button', 'del-button']
+            buttons: ['generate-button', 'scan-button', 'del-button', 'spread-button']
         }
     };
 
@@ -21,20 +21,38 @@ var dynamicGraph = {};
         node.setAttributeNS(null, 'class', node.getAttribute('class').replace(/(\s|^)muted(\s|$)/g, '$2'));
     };
 
+    // Graph id, journal cursor and poison lists of the plotted graph, and
+    // the offset of the next page of every super-node of a view
+    dynamicGraph.state = {graph: null, cursor: null, poison: {}, supers: {}};
+
+    // The graph id of the session, and its cursor when asking for deltas
+    dynamicGraph.graphQuery = function (withCursor) {
+        var state = dynamicGraph.state;
+        if (state.graph === null) return "";
+        return "?graph=" + state.graph + (withCursor ? "&cursor=" + state.cursor : "");
+    };
+
     dynamicGraph.request = function (svg, action_type, nodes_number) {
+        // A new graph replaces the graph of the session on the server
+        var url = "/api/" + action_type + "/" + nodes_number +
+            dynamicGraph.graphQuery(action_type != "new_graph");
         if (!!window.EventSource) {
-          var source = new EventSource("/api/" + action_type + "/" + nodes_number);
+          var source = new EventSource(url);
         }
+        // The job doing the work on the server, stopped by the cancel button
+        var job = null;
         source.addEventListener('message', function(e) {
-          json  = JSON.parse(e.data);
+          json  = dynamicGraph.decodeColumns(JSON.parse(e.data));
+          job = json.job;
           dynamicGraph.plotGraph(svg, json);
 
-          if (Number(e.lastEventId) >= nodes_number ) {
+          // Event ids are graph:progress:cursor, sent back on reconnection
+          var loaded = Number(e.lastEventId.split(':')[1]);
+          if (loaded >= nodes_number ) {
              dynamicGraph.show_alert(`Generation Process In ${action_type} of ${nodes_number} Nodes Completed.`, "success");
              source.close(); // stop retry
           }
           // Get the loaded amount and total filesize (bytes)
-          var loaded = Number(e.lastEventId);
           var total = nodes_number;
           // Calculate percent completed
           var percent_complete = (loaded / total) * 100;
@@ -44,6 +62,8 @@ var dynamicGraph = {};
         }, false);
         // error handler
         source.addEventListener("error", function (e) {
+          // A dropped stream reconnects by itself and resumes where it was
+          if (source.readyState == EventSource.CONNECTING) return;
           dynamicGraph.show_alert(`Your Graph Is Empty. Generate A Graph First!`, "warning");
           dynamicGraph.reset();
           if (e.readyState == EventSource.CLOSED) {
@@ -56,61 +76,285 @@ var dynamicGraph = {};
            dynamicGraph.show_alert(`Generation cancelled`, "danger");
            dynamicGraph.reset();
            source.close();
+           if (job !== null) fetch("/api/jobs/" + job + "/cancel", {method: "POST"});
         }, false);
     };
 
-    dynamicGraph.plotGraph = function (svg, json) {
-        console.log("json", json);
-        if (json.result == 404) {
-            dynamicGraph.show_alert(json.message, "warning");
-            return true;
+    // Colors of the nodes infected and recovered in the first run
+    dynamicGraph.spreadColors = {infected: '#d9534f', recovered: '#999', susceptible: '#008cc2'};
+
+    // Animate an epidemic from the initial poison nodes: every event is a
+    // step with the counts of every run and the nodes that changed in the
+    // first run. The graph itself does not change
+    dynamicGraph.simulate = function (svg, model, steps) {
+        var colors = dynamicGraph.spreadColors;
+        var source = new EventSource("/api/simulate/" + model + dynamicGraph.graphQuery(false) +
+            "&steps=" + steps);
+        var jobs = [];
+        source.addEventListener('message', function (e) {
+          var json = dynamicGraph.decodeColumns(JSON.parse(e.data)), c = json.columns, i, node;
+          jobs = json.jobs;
+          for (i = 0; i < c.new_infected.length; i++) {
+            node = svg.graph.nodes(c.new_infected[i]);
+            if (node) node.color = colors.infected;
+          }
+          for (i = 0; i < c.new_recovered.length; i++) {
+            node = svg.graph.nodes(c.new_recovered[i]);
+            if (node) node.color = model == 'SIS' ? colors.susceptible : colors.recovered;
+          }
+          svg.refresh();
+          progress.setAttribute("style", `width: ${Math.floor(json.step / steps * 100)}%`);
+          progress_status.innerText = `Step ${json.step}: ${json.mean_infected.toFixed(1)} infected,
+            ${json.mean_recovered.toFixed(1)} recovered on average of ${json.runs} runs`;
+          if (json.done) {
+            dynamicGraph.show_alert(`${model} Spread Stopped After ${json.step} Steps.`, "success");
+            source.close();
+          }
+        }, false);
+        source.addEventListener("error", function (e) {
+          // A new stream would start the simulation over
+          dynamicGraph.show_alert(`Your Graph Is Empty. Generate A Graph First!`, "warning");
+          dynamicGraph.reset();
+          source.close();
+        }, false);
+        cancel_btn.addEventListener("click", function (e) {
+           dynamicGraph.reset();
+           source.close();
+           jobs.forEach(function (job) { fetch("/api/jobs/" + job + "/cancel", {method: "POST"}); });
+        }, false);
+    };
+
+    // Columns are packed little-endian int32, as base64 in JSON frames or
+    // back to back after a JSON header in binary ones
+    dynamicGraph.decodeColumns = function (json) {
+        var columns = {};
+        $.each(json.columns, function (key, packed) {
+            var raw = atob(packed), bytes = new Uint8Array(raw.length);
+            for (var i = 0; i < raw.length; i++) bytes[i] = raw.charCodeAt(i);
+            columns[key] = new Int32Array(bytes.buffer);
+        });
+        json.columns = columns;
+        return json;
+    };
+
+    dynamicGraph.decodeBinary = function (buffer) {
+        var length = new DataView(buffer).getUint32(0, true);
+        var json = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, length)));
+        var offset = 4 + length, columns = {};
+        json.columns.forEach(function (column) {
+            columns[column[0]] = new Int32Array(buffer, offset, column[1]);
+            offset += 4 * column[1];
+        });
+        json.columns = columns;
+        return json;
+    };
+
+    dynamicGraph.fetchGraph = function (svg) {
+        return fetch("/api/graph" + dynamicGraph.graphQuery(true)).then(function (response) {
+            if (!response.ok) return response.json();
+            return response.arrayBuffer().then(dynamicGraph.decodeBinary);
+        }).then(function (json) {
+            dynamicGraph.plotGraph(svg, json);
+        });
+    };
+
+    dynamicGraph.edgeId = function (source, target) {
+        return Math.min(source, target) + '-' + Math.max(source, target);
+    };
+
+    // The position of a node the server has not placed
+    dynamicGraph.missing = -2147483648;
+
+    // Nodes go where the server laid them out, else anywhere
+    dynamicGraph.addNode = function (svg, id, size, x, y) {
+        var placed = x !== undefined && x != dynamicGraph.missing;
+        node = {};
+        node.id = id;
+        node.label = 'Node ' + node.id;
+        node.x = placed ? x : Math.random();
+        node.y = placed ? y : Math.random();
+        node.size = size;
+        node.color = '#008cc2';
+        svg.graph.addNode(node);
+        return node;
+    };
+
+    dynamicGraph.addEdge = function (svg, source, target) {
+        edge = {};
+        edge.id = dynamicGraph.edgeId(source, target);
+        edge.source = source;
+        edge.target = target;
+        edge.size = Math.random();
+        edge.color = '#ccc';
+        svg.graph.addEdge(edge);
+        return edge;
+    };
+
+    dynamicGraph.superColor = '#f0ad4e';
+
+    // A super-node stands for the collapsed nodes of a graph over the node
+    // budget: the periphery of a component or small components of a size
+    dynamicGraph.addSuper = function (svg, id, nodes, components, poison, x, y) {
+        var node = dynamicGraph.addNode(svg, id, 8 * Math.log2(nodes + 1), x, y);
+        node.color = dynamicGraph.superColor;
+        node.nodes = nodes;
+        node.label = `${nodes} nodes in ${components} components, ${poison} poison`;
+        node.isSuper = true;
+        return node;
+    };
+
+    // Plot the view of a graph over the node budget. Deltas need the whole
+    // graph, so the next frames come whole too
+    dynamicGraph.plotDetail = function (svg, json) {
+        var state = dynamicGraph.state, c = json.columns, i;
+        state.graph = json.graph;
+        state.cursor = null;
+        state.poison = {
+            InitialPoison: new Set(c.InitialPoison),
+            infected_nodes: new Set(c.infected_nodes)
         };
+        state.supers = {};
         svg.graph.clear();
+        for (i = 0; i < c.V.length; i++) {
+            dynamicGraph.addNode(svg, c.V[i], c.degrees[i], c.x && c.x[i], c.y && c.y[i]);
+        }
+        for (i = 0; i < c.super.length; i++) {
+            dynamicGraph.addSuper(svg, c.super[i], c.super_nodes[i], c.super_components[i], c.InitialPoison_super[i],
+                                  c.super_x && c.super_x[i], c.super_y && c.super_y[i]);
+            state.supers[c.super[i]] = 0;
+        }
+        for (i = 0; i < c.src.length; i++) {
+            dynamicGraph.addEdge(svg, c.src[i], c.tgt[i]).size = Math.log2(c.weight[i] + 1);
+        }
+        dynamicGraph.markPoison(svg, json);
+        svg.refresh();
+    };
 
-        var nodes = $.map(json.new_V, function (n, i) {
-            node = {};
-            node.id = n[0];
-            node.label = 'Node ' + node.id;
-            node.x = Math.random();
-            node.y = Math.random();
-            node.size = n[1];
-            node.color = '#008cc2';
-            svg.graph.addNode(node);
-            return node;
+    // Show the next page of the nodes of a super-node, with their edges to
+    // the nodes shown or else to the super-nodes holding them
+    dynamicGraph.expand = function (svg, id) {
+        var state = dynamicGraph.state, offset = state.supers[id];
+        if (offset === undefined) return;
+        fetch("/api/expand/" + id + dynamicGraph.graphQuery(false) + "&offset=" + offset).then(function (response) {
+            return response.json();
+        }).then(function (json) {
+            if (json.result !== undefined) {
+                dynamicGraph.show_alert(json.message, "warning");
+                return;
+            }
+            var c = dynamicGraph.decodeColumns(json).columns, node = svg.graph.nodes(id), i, source, target;
+            for (i = 0; i < c.V.length; i++) {
+                dynamicGraph.addNode(svg, c.V[i], c.degrees[i], c.x && c.x[i], c.y && c.y[i]);
+            }
+            for (i = 0; i < c.src.length; i++) {
+                source = svg.graph.nodes(c.src[i]) ? c.src[i] : c.src_view[i];
+                target = svg.graph.nodes(c.tgt[i]) ? c.tgt[i] : c.tgt_view[i];
+                if (source != target && !svg.graph.edges(dynamicGraph.edgeId(source, target)))
+                    dynamicGraph.addEdge(svg, source, target);
+            }
+            c.infected_nodes.forEach(function (v) { state.poison.infected_nodes.add(v); });
+            if (json.next === null) {
+                svg.graph.dropNode(id);
+                delete state.supers[id];
+            } else {
+                node.nodes -= c.V.length;
+                node.size = 8 * Math.log2(node.nodes + 1);
+                state.supers[id] = json.next;
+            }
+            dynamicGraph.markPoison(svg, json);
+            svg.refresh();
         });
+    };
 
-        //var nodes = json.V.reduce((acc, current, index) => {
-        //    node = {};
-        //    node.id = current;
-        //    node.label = 'Node ' + current;
-        //    node.x = Math.random();
-        //    node.y = Math.random();
-        //    node.size = Math.random();
-        //    node.color = '#008cc2';
-        //    svg.graph.addNode(node);
-        //    return node;
-        //}, [])
-        var edges = $.map(json.E, function (e, i) {
-            edge = {};
-            edge.id = i;
-            edge.source = e[0];
-            edge.target = e[1];
-            edge.size = Math.random();
-            edge.color = '#ccc';
-            svg.graph.addEdge(edge);
-            return edge;
-        });
+    dynamicGraph.markPoison = function (svg, json) {
+        var state = dynamicGraph.state;
+        var principals = new Set(json.columns.Principals);
         svg.graph.nodes().forEach(function(n) {
-          if ("infected_nodes" in json && json.infected_nodes.indexOf(n.id) >= 0) {
+          if (state.poison.infected_nodes.has(n.id)) {
              n.size = 36;
           }
         });
         svg.graph.nodes().forEach(function(n) {
-          if ("Principals" in json && json.Principals.indexOf(n.id) >= 0) {
+          if (principals.has(n.id)) {
              n.size = 72;
              n.color = "#red";
           }
         });
+    };
+
+    // Apply the changes since the last event in place: removals first,
+    // then the added nodes and edges, the new degrees and the nodes moved
+    dynamicGraph.patchGraph = function (svg, json) {
+        var state = dynamicGraph.state, c = json.columns, i, id, node;
+        for (i = 0; i < c.del_V.length; i++) {
+          if (svg.graph.nodes(c.del_V[i])) svg.graph.dropNode(c.del_V[i]);
+        }
+        for (i = 0; i < c.del_src.length; i++) {
+          id = dynamicGraph.edgeId(c.del_src[i], c.del_tgt[i]);
+          if (svg.graph.edges(id)) svg.graph.dropEdge(id);
+        }
+        for (i = 0; i < c.add_V.length; i++) {
+          dynamicGraph.addNode(svg, c.add_V[i], c.add_degrees[i], c.add_x && c.add_x[i], c.add_y && c.add_y[i]);
+        }
+        for (i = 0; i < c.add_src.length; i++) {
+          if (!svg.graph.edges(dynamicGraph.edgeId(c.add_src[i], c.add_tgt[i])))
+            dynamicGraph.addEdge(svg, c.add_src[i], c.add_tgt[i]);
+        }
+        for (i = 0; i < c.deg_V.length; i++) {
+          node = svg.graph.nodes(c.deg_V[i]);
+          if (node) node.size = c.deg_values[i];
+        }
+        for (i = 0; c.move_V && i < c.move_V.length; i++) {
+          node = svg.graph.nodes(c.move_V[i]);
+          if (node) {
+            node.x = c.move_x[i];
+            node.y = c.move_y[i];
+          }
+        }
+        $.each(state.poison, function (key, values) {
+          if (json.reset.indexOf(key) >= 0) values.clear();
+          c[key + '_del'].forEach(function (v) { values.delete(v); });
+          c[key + '_add'].forEach(function (v) { values.add(v); });
+        });
+        dynamicGraph.markPoison(svg, json);
+    };
+
+    dynamicGraph.plotGraph = function (svg, json) {
+        if (json.result >= 400) {
+            dynamicGraph.show_alert(json.message, "warning");
+            return true;
+        };
+        var state = dynamicGraph.state, c = json.columns, i;
+        if (json.type == "lod") {
+            dynamicGraph.plotDetail(svg, json);
+            return;
+        }
+        if (json.type == "delta") {
+            if (json.graph != state.graph || json.since != state.cursor) {
+                // Missed an event: resync from the fetch endpoint
+                dynamicGraph.fetchGraph(svg);
+                return;
+            }
+            dynamicGraph.patchGraph(svg, json);
+            state.cursor = json.cursor;
+            svg.refresh();
+            return;
+        }
+        state.graph = json.graph;
+        state.cursor = json.cursor;
+        state.supers = {};
+        state.poison = {
+            InitialPoison: new Set(c.InitialPoison),
+            infected_nodes: new Set(c.infected_nodes)
+        };
+        svg.graph.clear();
+        for (i = 0; i < c.V.length; i++) {
+            dynamicGraph.addNode(svg, c.V[i], c.degrees[i], c.x && c.x[i], c.y && c.y[i]);
+        }
+        for (i = 0; i < c.src.length; i++) {
+            dynamicGraph.addEdge(svg, c.src[i], c.tgt[i]);
+        }
+        dynamicGraph.markPoison(svg, json);
         svg.refresh();
     };
 
@@ -170,6 +414,10 @@ jQuery(function ($) {
       freeStyle: true
     });
 
+    svg.bind('clickNode', function (e) {
+          if (e.data.node.isSuper) dynamicGraph.expand(svg, e.data.node.id);
+    });
+
     svg.bind('clickStage', function() {
           $('.sigma-node, .sigma-edge').each(function() {
                dynamicGraph.unmute(this);
@@ -224,21 +472,23 @@ jQuery(function ($) {
             data[$input.attr('name')] = $input.val();
         });
         $.ajax({
-            url: "/api/scan/" + data['X'],
+            url: "/api/scan/" + data['X'] + dynamicGraph.graphQuery(false),
             type: "POST",
             cache: false,
             data: JSON.stringify(data),
             contentType: "application/json; charset=utf-8",
             dataType: "json",
             success: function (json) {
+                if (json.result != 404) json = dynamicGraph.decodeColumns(json);
                 dynamicGraph.plotGraph(svg, json);
                 if (json.result != 404) {
-                    dynamicGraph.show_alert(`Poison Scan Completed. ${json.infected_nodes.length} poison nodes found.
-                    Principals nodes of [${json.Principals.sort()}] that if removed, would minimize the impact of infection.`, "success");
+                    dynamicGraph.show_alert(`Poison Scan Completed. ${json.columns.infected_nodes.length} poison nodes found.
+                    Principals nodes of [${Array.from(json.columns.Principals).sort()}] that if removed, would minimize the impact of infection.`, "success");
                 };
             },
             error: function (xhr, textStatus, errorThrown) {
-                dynamicGraph.show_alert(`Initialization of Poison Nodes Is NOT Completed. Please wait a while and try it again.`, "danger");
+                if (xhr.responseJSON) dynamicGraph.show_alert(xhr.responseJSON.message, "warning");
+                else dynamicGraph.show_alert(`Initialization of Poison Nodes Is NOT Completed. Please wait a while and try it again.`, "danger");
             },
             complete: function () {
             }
@@ -256,20 +506,21 @@ jQuery(function ($) {
             data[$input.attr('name')] = $input.val();
         });
         $.ajax({
-            url: "/api/delete",
+            url: "/api/delete" + dynamicGraph.graphQuery(false),
             type: "POST",
             cache: false,
             data: JSON.stringify(data),
             contentType: "application/json; charset=utf-8",
             dataType: "json",
             success: function (json) {
+                if (json.result != 404) json = dynamicGraph.decodeColumns(json);
                 dynamicGraph.plotGraph(svg, json);
                 if (json.result != 404 && json.deletedNodes > 0 ) {
                     dynamicGraph.show_alert(` ${json.deletedNodes} infected nodes are removed from the graph.`, "success");
                 };
             },
             error: function (xhr, textStatus, errorThrown) {
-                dynamicGraph.show_alert(`Your Graph Is Empty. Generate A Graph First!`, "warning");
+                dynamicGraph.show_alert(xhr.responseJSON ? xhr.responseJSON.message : `Your Graph Is Empty. Generate A Graph First!`, "warning");
             },
             complete: function () {
             }
@@ -277,6 +528,14 @@ jQuery(function ($) {
         return false;
     });
 
+    $('#spread-button').click(function () {
+        dynamicGraph.show_alert(`Spreading Poison From The Initial Poison Nodes...`, "warning");
+        progress_wrapper.classList.remove("d-none");
+        cancel_btn.classList.remove("d-none");
+        dynamicGraph.simulate(svg, 'SIR', 100);
+        return false;
+    });
+
     var $graphTypeInput = $('#graph-type'),
         $params = $('#params > div'),
         $paramsInputs = $params.find('input');
@@ -0,0 +1,336 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of the server side of the graph: the registry of the client graphs,
+the shared snapshots, the job pool and the api. Run from the repository root
+with python -m src.test_server
+"""
+
+from unittest import TestCase
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+from src.DynamicGraph.DynamicGraph import GraphSnapshot, ProbGraph
+from src.GraphJobs import GraphBusy, JobPool
+from src.GraphMetrics import SamplingProfiler
+from src.GraphRegistry import GraphRegistry
+from src.SharedGraph import SharedGraphStore
+from src import app as server
+
+
+class TestServer(TestCase):
+    def __init__(self, node_num, edge_num):
+        TestCase.__init__(self)
+        self.node_num = node_num
+        self.edge_num = edge_num
+        server.jobs.workers = 0
+        self.client = server.app.test_client()
+
+    def events(self, url):
+        # Returns the frames of an event stream with their columns decoded
+        body = self.client.get(url).get_data(as_text=True)
+        frames = [json.loads(line[5:]) for line in body.split('\n') if line.startswith('data:')]
+        for frame in frames:
+            frame['columns'] = dict((key, np.frombuffer(base64.b64decode(value), dtype='<i4'))
+                                    for key, value in frame['columns'].items())
+        return frames
+
+    def newGraph(self, node_num):
+        # Returns the id of a graph made through the api
+        return self.events('/api/new_graph/%d?budget=0' % node_num)[-1]['graph']
+
+    def _infected(self, graph, poison):
+        # The nodes of the components of the poison nodes, by bfs
+        reached = set()
+        for v in poison:
+            if v not in reached:
+                reached.update(graph.bfsearch(v))
+        return len(reached)
+
+    def test_graphRegistry(self):
+        ##########################################################
+        # Test the registry evicts the least recently used graphs
+        # over the budget and the graphs idle for longer than the
+        # ttl, but never a graph checked out by a request
+        ##########################################################
+        now = [0]
+        evicted = []
+        graph = ProbGraph(node_num=self.node_num, edge_num=self.edge_num)
+        size = graph.getMemoryUsage()
+        registry = GraphRegistry(max_bytes=2 * size, ttl=60, clock=lambda: now[0],
+                                 on_evict=evicted.append)
+        first = registry.add(graph)
+        second = registry.add(graph)
+        now[0] += 1
+        registry.get(first)
+        third = registry.add(graph)
+        self.assertEqual(evicted, [second], "The least recently used graph is not evicted")
+        self.assertRaises(KeyError, registry.get, second)
+        with registry.checkout(first) as entry:
+            self.assertIs(entry.graph, graph, "The graph checked out is not correct")
+            now[0] += 1
+            registry.add(graph, 'fourth')
+            self.assertEqual(evicted, [second, third], "A graph checked out is evicted")
+            now[0] += 61
+            self.assertRaises(KeyError, registry.get, 'fourth')
+            self.assertTrue(first in registry, "A graph checked out is dropped by the ttl")
+        now[0] += 61
+        self.assertRaises(KeyError, registry.get, first)
+        self.assertEqual(registry.stats(), {'graphs': 0, 'bytes': 0, 'max_bytes': 2 * size, 'evicted': 4},
+                         "The stats of the registry are not correct")
+
+    def test_sharedGraphStore(self):
+        ##########################################################
+        # Test readers attach to the current version of a graph,
+        # that views of an older version stay readable once it is
+        # replaced or discarded, and that closing the store while
+        # views are in use leaves no error at exit
+        ##########################################################
+        store = SharedGraphStore(prefix='dgtest%d' % os.getpid())
+        graph = ProbGraph(node_num=self.node_num, edge_num=self.edge_num)
+        self.assertIsNone(store.attach('ab'), "A graph never published is attached")
+        self.assertEqual(store.publish('ab', graph), 1, "The first version is not correct")
+        first = store.attach('ab')
+        self.assertEqual(first.V.tolist(), sorted(graph.V), "The nodes attached are not correct")
+        self.assertIs(store.attach('ab'), first, "The snapshot attached is not kept")
+        graph.addDynamic(self.node_num // 4, self.edge_num // 4)
+        self.assertEqual(store.publish('ab', graph), 2, "The second version is not correct")
+        self.assertEqual(store.current('ab'), (2, os.getpid()), "The current version is not correct")
+        self.assertTrue(store.owns('ab'), "The publisher does not own the graph")
+        second = store.attach('ab')
+        self.assertEqual(second.V.tolist(), sorted(graph.V), "The nodes attached are not correct")
+        self.assertEqual(len(first.V), self.node_num, "The older version is changed")
+        store.discard('ab')
+        self.assertIsNone(store.current('ab'), "The graph discarded is still published")
+        self.assertIsNone(store.attach('ab'), "The graph discarded is attached")
+        self.assertEqual(len(second.V), len(graph.V), "The views of a graph discarded are changed")
+        store.close()
+        script = '\n'.join([
+            'from src.SharedGraph import SharedGraphStore',
+            'from src.DynamicGraph.DynamicGraph import ProbGraph',
+            'store = SharedGraphStore(prefix="dgexit%d")' % os.getpid(),
+            'store.publish("ab", ProbGraph(node_num=%d, edge_num=%d))' % (self.node_num, self.edge_num),
+            'snapshot = store.attach("ab")',
+            'store.close()'])
+        done = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual((done.returncode, done.stderr), (0, ''), "Closing the store leaves an error at exit")
+
+    def test_jobPool(self):
+        ##########################################################
+        # Test a job sends its graph and its steps, that a graph
+        # takes one job changing it at a time, that cancelled
+        # jobs stop within a chunk of nodes, graphs being created
+        # included, and that the pool takes no job once closed
+        ##########################################################
+        for workers in (0, 1):
+            pool = JobPool(workers)
+            with pool.start('ab', 'create', node_num=self.node_num) as job:
+                messages = list(job.messages())
+            self.assertEqual([kind for kind, _, _ in messages], ['graph', 'done'], "The messages are not correct")
+            state = messages[0][1]
+            self.assertEqual(len(GraphSnapshot(*state).V), self.node_num, "The graph created is not correct")
+            with pool.start('ab', 'add_nodes', state, node_number=self.node_num, x=0) as job:
+                self.assertRaises(GraphBusy, pool.start('ab', 'delete', state).__enter__)
+                steps = [value for kind, value, _ in job.messages() if kind == 'step']
+            self.assertEqual(steps, list(range(self.node_num // 10, self.node_num + 1, self.node_num // 10)),
+                             "The steps are not correct")
+            self.assertFalse(pool.busy('ab'), "The graph is busy once its job is done")
+            with pool.start('ab', 'add_poison', state, node_number=5, x=0) as job:
+                steps = [value for kind, value, _ in job.messages() if kind == 'step']
+            self.assertEqual(steps, [1, 2, 3, 4, 5], "The steps of a few poison nodes are not correct")
+            with pool.start('ab', 'add_nodes', state, node_number=self.node_num * 10, x=0,
+                            chunk=self.node_num // 10) as job:
+                job.cancel()
+                messages = list(job.messages())
+            self.assertEqual(messages[-1][0], 'cancelled', "The job is not cancelled")
+            self.assertTrue(all(value < self.node_num * 10 for kind, value, _ in messages if kind == 'step'),
+                            "The job cancelled is not stopped")
+            with pool.start('ab', 'create', node_num=self.node_num * 100) as job:
+                job.cancel()
+                messages = list(job.messages())
+            self.assertEqual([kind for kind, _, _ in messages], ['cancelled'], "The graph created is not cancelled")
+            pool.close()
+            self.assertRaises(RuntimeError, pool.executor.submit, print)
+
+    def test_evaluate(self):
+        ##########################################################
+        # Test the infected counts of candidate removal sets from
+        # the api against a bfs from the poison nodes left
+        ##########################################################
+        graph_id = self.newGraph(self.node_num)
+        self.client.get('/api/add_poison/%d?graph=%s&budget=0' % (self.node_num // 20, graph_id)).get_data()
+        graph = server.graphs.get(graph_id)
+        poison = list(graph.InitialPoison)
+        healthy = next(v for v in graph.V if v not in poison)
+        candidates = [[healthy], poison[:1], poison[:len(poison) // 2], poison + [healthy]]
+        response = self.client.post('/api/evaluate?graph=%s' % graph_id, json={'candidates': candidates})
+        expected = [self._infected(graph, set(poison) - set(nodes)) for nodes in [[]] + candidates]
+        self.assertEqual(json.loads(response.get_data()), {'infected': expected[0], 'candidates': expected[1:], 'result': 200},
+                         "The infected counts are not correct")
+        response = self.client.post('/api/evaluate?graph=%s' % graph_id, json={'candidates': [1]})
+        self.assertEqual(response.status_code, 400, "The candidates are not checked")
+
+    def test_simulate(self):
+        ##########################################################
+        # Test the infected counts of SI never go down, that SIR
+        # ends with no infected node, that a seed gives the same
+        # stream and that an unknown model is refused
+        ##########################################################
+        graph_id = self.newGraph(self.node_num)
+        self.client.get('/api/add_poison/%d?graph=%s&budget=0' % (self.node_num // 100, graph_id)).get_data()
+        url = '/api/simulate/%s?graph=' + graph_id + '&beta=0.3&gamma=0.2&runs=4&steps=1000&seed=7'
+        frames = self.events(url % 'SI')
+        infected = np.array([frame['columns']['infected'] for frame in frames])
+        self.assertTrue((np.diff(infected, axis=0) >= 0).all(), "The infected count of SI goes down")
+        frames = self.events(url % 'SIR')
+        self.assertTrue(frames[-1]['done'], "The last frame is not done")
+        self.assertFalse(frames[-1]['columns']['infected'].any(), "SIR ends with infected nodes")
+        again = self.events(url % 'SIR')
+        self.assertEqual([(frame['step'], frame['columns']['infected'].tolist(), frame['columns']['recovered'].tolist())
+                          for frame in frames],
+                         [(frame['step'], frame['columns']['infected'].tolist(), frame['columns']['recovered'].tolist())
+                          for frame in again], "The streams of a seed are not the same")
+        self.assertEqual(self.client.get(url % 'SEIR').status_code, 400, "An unknown model is not refused")
+
+    def test_conditional(self):
+        ##########################################################
+        # Test a read endpoint is a 304 for a client sending the
+        # ETag of the graph, and that a change of the graph gives
+        # a new ETag and the payload again
+        ##########################################################
+        graph_id = self.newGraph(self.node_num)
+        for url in ('/api/graph?graph=%s' % graph_id, '/api/stats?graph=%s' % graph_id):
+            response = self.client.get(url)
+            tag = response.headers['ETag']
+            self.assertEqual(response.status_code, 200, "The payload is not sent")
+            response = self.client.get(url, headers={'If-None-Match': tag})
+            self.assertEqual((response.status_code, response.get_data()), (304, b''), "The ETag is not matched")
+            self.assertEqual(response.headers['ETag'], tag, "The ETag of a 304 is not correct")
+        self.events('/api/add_nodes/%d?graph=%s&budget=0' % (self.node_num // 10, graph_id))
+        for url in ('/api/graph?graph=%s' % graph_id, '/api/stats?graph=%s' % graph_id):
+            response = self.client.get(url, headers={'If-None-Match': tag})
+            self.assertEqual(response.status_code, 200, "The payload of a changed graph is not sent")
+            self.assertNotEqual(response.headers['ETag'], tag, "The ETag does not change with the graph")
+
+    def test_changingGraph(self):
+        ##########################################################
+        # Test a graph changed by an open stream of this worker or
+        # claimed by another worker is busy for the other changes
+        # without waiting for it, and not once the claim is gone
+        ##########################################################
+        graph_id = self.newGraph(self.node_num)
+        stream = self.client.get('/api/add_nodes/%d?graph=%s&budget=0' % (self.node_num * 10, graph_id),
+                                 buffered=False)
+        next(iter(stream.response))
+        start = time.perf_counter()
+        self.assertEqual(self.client.post('/api/scan/1?graph=%s' % graph_id).status_code, 409,
+                         "A graph with an open stream is not busy")
+        self.assertLess(time.perf_counter() - start, 1, "A change waits for the open stream")
+        stream.close()
+        script = '\n'.join([
+            'import sys',
+            'from src.SharedGraph import SharedGraphStore',
+            'store = SharedGraphStore(prefix=%r)' % server.shared.prefix,
+            'with store.lock(%r):' % graph_id,
+            '    store.claim(%r)' % graph_id,
+            'print("claimed", flush=True)',
+            'sys.stdin.read()'])
+        other = subprocess.Popen([sys.executable, '-c', script], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        other.stdout.readline()
+        for method, url in [('post', '/api/scan/1?graph=%s' % graph_id), ('post', '/api/delete?graph=%s' % graph_id),
+                            ('get', '/api/add_nodes/10?graph=%s' % graph_id)]:
+            self.assertEqual(getattr(self.client, method)(url).status_code, 409,
+                             "A graph claimed by another worker is not busy")
+        self.assertEqual(self.client.get('/api/stats?graph=%s' % graph_id).status_code, 200,
+                         "A graph claimed by another worker is not readable")
+        other.stdin.close()
+        other.wait()
+        self.assertEqual(self.client.post('/api/scan/1?graph=%s' % graph_id).status_code, 200,
+                         "The claim of a worker gone is kept")
+
+    def test_unsharedReads(self):
+        ##########################################################
+        # Test the read endpoints of a graph gone are a 404 when
+        # the workers share no memory
+        ##########################################################
+        shared, server.shared = server.shared, None
+        try:
+            for url in ('/api/graph?graph=ab', '/api/stats?graph=ab'):
+                self.assertEqual(self.client.get(url).status_code, 404, "A graph gone is not a 404")
+            self.assertEqual(self.client.post('/api/evaluate?graph=ab', json={'candidates': []}).status_code, 404,
+                             "A graph gone is not a 404")
+        finally:
+            server.shared = shared
+
+    def test_samplingProfiler(self):
+        ##########################################################
+        # Test the profiler samples the stacks of the thread that
+        # started it, and the green thread that started it once
+        # eventlet patched the threads
+        ##########################################################
+        profiler = SamplingProfiler(interval=0.001).start()
+        end = time.perf_counter() + 0.1
+        while time.perf_counter() < end:
+            pass
+        profiler.stop()
+        self.assertGreater(profiler.samples, 0, "No stack is sampled")
+        self.assertIn('test_samplingProfiler (src/test_server.py', profiler.folded(), "The stacks are not correct")
+
+        def switchedOut():
+            yield
+        waiting = switchedOut()
+        next(waiting)
+        green = types.SimpleNamespace(gr_frame=waiting.gi_frame, dead=False)
+        sys.modules['eventlet.patcher'] = types.SimpleNamespace(is_monkey_patched=lambda module: True,
+                                                                original=lambda module: threading)
+        sys.modules['greenlet'], modules = types.SimpleNamespace(getcurrent=lambda: green), sys.modules.get('greenlet')
+        try:
+            profiler = SamplingProfiler(interval=0.001)
+        finally:
+            del sys.modules['eventlet.patcher']
+            if modules is None:
+                del sys.modules['greenlet']
+            else:
+                sys.modules['greenlet'] = modules
+        profiler.start()
+        time.sleep(0.1)
+        profiler.stop()
+        self.assertIn('switchedOut (src/test_server.py', profiler.folded(), "The green thread is not sampled")
+        self.assertNotIn('test_samplingProfiler', profiler.folded(), "The OS thread is sampled instead")
+
+    def test_apiErrors(self):
+        ##########################################################
+        # Test the errors of the api have their status and a json
+        # body with the message
+        ##########################################################
+        for method, url, status in [('get', '/api/new_graph/100?graph=../ab', 400),
+                                    ('post', '/api/layout?graph=ab', 404),
+                                    ('get', '/api/simulate/SI?graph=%s&beta=2' % self.newGraph(self.node_num), 400)]:
+            response = getattr(self.client, method)(url)
+            self.assertEqual((response.status_code, response.content_type), (status, 'application/json'),
+                             "The status of the error is not correct")
+            self.assertEqual(response.get_json()['result'], status, "The body of the error is not correct")
+
+
+if __name__ == '__main__':
+    testRun = TestServer(node_num=2000, edge_num=20000)
+    testRun.test_graphRegistry()
+    testRun.test_sharedGraphStore()
+    testRun.test_jobPool()
+    testRun.test_evaluate()
+    testRun.test_simulate()
+    testRun.test_conditional()
+    testRun.test_changingGraph()
+    testRun.test_unsharedReads()
+    testRun.test_samplingProfiler()
+    testRun.test_apiErrors()